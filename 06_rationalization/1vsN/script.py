@@ -1,59 +1,148 @@
 import os
+import argparse
+import cProfile
+import csv
+import hashlib
+import html
+import json
+import sqlite3
+import sys
+import time
+import zlib
 import fitz  # PyMuPDF for analyzing structure and layout
 from datetime import datetime
-from collections import defaultdict
-import pandas as pd
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 import concurrent.futures
 import traceback
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, PatternFill
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then left out of the run metrics
+    resource = None
 import re
 
+# Cosine similarity above which two text blocks are reported as a match
+SIMILARITY_THRESHOLD = 0.1
+# Number of query rows multiplied against the corpus per sparse batch
+SIMILARITY_BATCH_SIZE = 1024
+# MinHash/LSH settings: BANDS * ROWS permutations per signature. More bands raise recall,
+# more rows per band raise precision; pairs with Jaccard above about (1/BANDS) ** (1/ROWS)
+# are likely to become candidates.
+LSH_BANDS = 32
+LSH_ROWS = 4
+LSH_SHINGLE_SIZE = 2
+MINHASH_PRIME = np.uint64((1 << 61) - 1)
+# Text blocks with fewer words than this are not compared
+MIN_BLOCK_WORDS = 10
+# Version of normalize_text; change it whenever normalization changes so cached extractions are refreshed
+NORMALIZER_VERSION = "lower-strip-drop-xxxxx-v1"
+# Text extraction modes: "blocks" reads PyMuPDF's block-level text, "dict" joins the spans of the
+# full text dictionary (the original extractor) and "layout" is "blocks" that also keeps the
+# bounding box of every block for the results store
+EXTRACTION_MODES = ("blocks", "dict", "layout")
+# Default extraction mode: the span dictionary, so existing runs and caches keep their blocks. The
+# faster "blocks" mode is opt-in, since it can split words whose spans change style differently.
+DEFAULT_EXTRACTION_MODE = "dict"
+# PyMuPDF text flags of every extraction mode: the dictionary defaults without image decoding,
+# since image blocks are dropped anyway
+EXTRACTION_TEXT_FLAGS = fitz.TEXTFLAGS_BLOCKS
+# Pages per extraction task; large PDFs are split into page ranges spread over the process pool
+PAGES_PER_TASK = 50
+# Rows per page of the HTML report
+HTML_ROWS_PER_PAGE = 5000
+# Excel holds at most 1,048,576 rows per sheet, including the header row
+EXCEL_MAX_ROWS_PER_SHEET = 1048576
+# Sheets per workbook before the Excel export continues in a new workbook
+EXCEL_MAX_SHEETS_PER_WORKBOOK = 8
+# Size limit of the on-disk extraction cache before the least recently used entries are evicted
+EXTRACTION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# SQLite results store of all runs, kept in the result folder unless --results-db is given
+RESULTS_DB_NAME = "results.sqlite"
+# Number of slowest PDFs listed in the extraction metrics of the run manifest
+SLOWEST_PDFS_REPORTED = 10
+
 # Helper function to normalize text for comparison
 def normalize_text(text):
     text = text.lower().strip()
     text = re.sub(r'\b[xX]{5,}\b', '', text)  # Remove long patterns like xxxxxxx
     return text
 
-# Function to validate PDF files
-def validate_pdf(file_path):
+# Function to validate a PDF file and count its pages; returns None for unusable files
+def pdf_page_count(file_path):
     try:
         with fitz.open(file_path) as doc:
             if doc.is_encrypted:
                 print(f"PDF {file_path} is encrypted. Skipping...")
-                return False
-            return True
+                return None
+            return len(doc)
     except Exception as e:
         print(f"Error opening {file_path}: {e}. Skipping...")
         with open("error_log.txt", 'a') as log_file:
             log_file.write(f"Error opening {file_path}: {e}\n")
-        return False
+        return None
+
+# Function to validate PDF files
+def validate_pdf(file_path):
+    return pdf_page_count(file_path) is not None
+
+# Helper function to read the raw text and bounding box of every text block of a page
+def page_text_blocks(page, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    if extraction_mode == "dict":
+        blocks = page.get_text("dict", flags=EXTRACTION_TEXT_FLAGS)["blocks"]
+        return [("\n".join([span["text"] for line in block["lines"] for span in line["spans"]]), block["bbox"])
+                for block in blocks if "lines" in block]
+    # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 1 marks image blocks
+    blocks = page.get_text("blocks", flags=EXTRACTION_TEXT_FLAGS)
+    return [(block[4], block[:4]) for block in blocks if block[6] == 0]
+
+# Helper function to extract the normalized text blocks of a range of pages of an open PDF. The
+# "layout" mode also returns the bounding box of every block in block_boxes.
+def extract_page_blocks(doc, start_page, end_page, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    text_blocks = []
+    block_pages = []
+    block_boxes = []
+    for page_number in range(start_page, min(end_page, len(doc))):
+        page = doc.load_page(page_number)
+        for block_text, bbox in page_text_blocks(page, extraction_mode):
+            block_text = normalize_text(block_text.strip())
+
+            # Filter out small blocks of text less than MIN_BLOCK_WORDS words
+            if len(block_text.split()) >= MIN_BLOCK_WORDS:
+                text_blocks.append(block_text)
+                block_pages.append(page_number)
+                block_boxes.append([round(value, 1) for value in bbox])
+    page_range = {"text_blocks": text_blocks, "block_pages": block_pages}
+    if extraction_mode == "layout":
+        page_range["block_boxes"] = block_boxes
+    return page_range
+
+# Function to analyze a range of pages of a PDF; used as one task of a page-range split. The
+# result also carries the time the task took in seconds.
+def analyze_pdf_pages(file_path, start_page, end_page, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    start = time.perf_counter()
+    with fitz.open(file_path) as doc:
+        page_range = extract_page_blocks(doc, start_page, end_page, extraction_mode)
+    page_range["seconds"] = time.perf_counter() - start
+    return page_range
 
 # Function to analyze a single PDF structure (text)
-def analyze_pdf(file_path):
+def analyze_pdf(file_path, extraction_mode=DEFAULT_EXTRACTION_MODE):
     try:
         with fitz.open(file_path) as doc:
             if doc.is_encrypted:
                 print(f"PDF {file_path} is encrypted. Skipping...")
                 return None
 
-            text_blocks = []
-            for page_number in range(len(doc)):
-                page = doc.load_page(page_number)
-                blocks = page.get_text("dict")["blocks"]
-                for block in blocks:
-                    if "lines" in block:
-                        block_text = "\n".join([span["text"] for line in block["lines"] for span in line["spans"]]).strip()
-                        block_text = normalize_text(block_text)
-
-                        # Filter out small blocks of text less than 10 words
-                        if len(block_text.split()) >= 10:
-                            text_blocks.append(block_text)
-
-            return {"text_blocks": text_blocks}
+            report = extract_page_blocks(doc, 0, len(doc), extraction_mode)
+            report["page_count"] = len(doc)
+            return report
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         traceback.print_exc()
@@ -61,29 +150,313 @@ def analyze_pdf(file_path):
             log_file.write(f"Error processing {file_path}: {e}\n")
         return None
 
-# Function to compare PDFs and find common elements with similarity percentages
-def compare_pdf_structures(pdf_reports, single_pdf_report):
-    common_elements = {"text_blocks": defaultdict(list)}
-    all_text_blocks = single_pdf_report["text_blocks"] + [block for report in pdf_reports.values() for block in report["text_blocks"]]
-    pdf_names = ["Single PDF"] * len(single_pdf_report["text_blocks"]) + [pdf_name for pdf_name, report in pdf_reports.items() for _ in report["text_blocks"]]
+# Helper function to merge page-range results of a PDF back into one report in page order
+def merge_page_ranges(page_ranges, page_count):
+    report = {"text_blocks": [], "block_pages": [], "page_count": page_count}
+    for start_page in sorted(page_ranges):
+        report["text_blocks"].extend(page_ranges[start_page]["text_blocks"])
+        report["block_pages"].extend(page_ranges[start_page]["block_pages"])
+        if "block_boxes" in page_ranges[start_page]:
+            report.setdefault("block_boxes", []).extend(page_ranges[start_page]["block_boxes"])
+    return report
 
-    vectorizer = TfidfVectorizer().fit_transform(all_text_blocks)
-    similarity_matrix = cosine_similarity(vectorizer)
+# Helper function to hash a file's content without reading it into memory at once
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    for i in range(len(single_pdf_report["text_blocks"])):
-        for j in range(len(single_pdf_report["text_blocks"]), len(all_text_blocks)):
-            similarity = similarity_matrix[i, j]
-            if similarity > 0.1:
-                common_elements["text_blocks"][single_pdf_report["text_blocks"][i]].append((pdf_names[j], round(similarity * 100, 2)))
+# Helper function to describe the extractor settings that change the extracted text blocks
+def extraction_settings(extraction_mode=DEFAULT_EXTRACTION_MODE):
+    report_fields = ["text_blocks", "block_pages", "page_count"] + (["block_boxes"] if extraction_mode == "layout" else [])
+    return {"normalizer": NORMALIZER_VERSION, "min_words": MIN_BLOCK_WORDS, "extraction_mode": extraction_mode,
+            "report_fields": report_fields}
 
-    return common_elements
+# Helper function to build the cache entry path for a PDF content hash and extractor settings
+def extraction_cache_path(cache_dir, content_hash, settings):
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{content_hash}_{settings_hash}.json")
 
-# Function to generate HTML report for common elements in tabular format
-def generate_comparison_html_report(common_elements, output_folder):
-    html_content = f"""
+# Function to load a cached extraction; returns None on a cache miss
+def load_cached_extraction(cache_dir, content_hash, settings):
+    cache_path = extraction_cache_path(cache_dir, content_hash, settings)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            report = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+    # Touch the entry so eviction removes the least recently used entries first
+    os.utime(cache_path)
+    return report
+
+# Function to save an extraction to the cache and evict old entries beyond the size limit
+def store_cached_extraction(cache_dir, content_hash, settings, report, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = extraction_cache_path(cache_dir, content_hash, settings)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as cache_file:
+        json.dump(report, cache_file)
+    os.replace(temp_path, cache_path)
+    evict_extraction_cache(cache_dir, max_bytes)
+
+# Function to delete the least recently used cache entries until the cache fits in max_bytes
+def evict_extraction_cache(cache_dir, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+
+# Function to load the cached extractions of a list of PDFs. Returns the cached reports keyed
+# by PDF name and the content hash of every PDF so new extractions can be stored afterwards.
+def load_cached_reports(pdf_files, cache_dir, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    pdf_reports = {}
+    content_hashes = {}
+    settings = extraction_settings(extraction_mode)
+    for pdf in pdf_files:
+        content_hashes[pdf] = file_content_hash(pdf)
+        report = load_cached_extraction(cache_dir, content_hashes[pdf], settings)
+        if report is not None:
+            pdf_reports[os.path.basename(pdf)] = report
+    return pdf_reports, content_hashes
+
+# Function to remove cached extractions for the given PDFs, or the whole cache when none are given
+def invalidate_extraction_cache(cache_dir, pdf_files=None):
+    if not os.path.isdir(cache_dir):
+        return 0
+    prefixes = None if not pdf_files else tuple(f"{file_content_hash(pdf)}_" for pdf in pdf_files)
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json") and (prefixes is None or entry.name.startswith(prefixes)):
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+# Helper function to keep only the top-k highest scoring pairs of each query row
+def keep_top_k_pairs(rows, cols, scores, top_k):
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    _, first_index, counts = np.unique(rows, return_index=True, return_counts=True)
+    rank = np.arange(len(rows)) - np.repeat(first_index, counts)
+    keep = rank < top_k
+    return rows[keep], cols[keep], scores[keep]
+
+# Function to find block pairs above a similarity threshold in vectorized row batches.
+# TF-IDF rows are L2-normalized, so the sparse product of two rows is their cosine
+# similarity; only one batch of products is held in memory at a time, and each batch
+# yields (rows, cols, scores) arrays sorted by (row, col).
+def find_similar_pairs(query_matrix, corpus_matrix, threshold=SIMILARITY_THRESHOLD, top_k=None,
+                       batch_size=SIMILARITY_BATCH_SIZE, upper_triangle=False):
+    corpus_t = corpus_matrix.T.tocsr()
+    for start in range(0, query_matrix.shape[0], batch_size):
+        products = (query_matrix[start:start + batch_size] @ corpus_t).tocoo()
+        rows, cols, scores = products.row.astype(np.int64) + start, products.col.astype(np.int64), products.data
+        keep = scores > threshold
+        if upper_triangle:
+            keep &= cols > rows
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        if top_k is not None:
+            rows, cols, scores = keep_top_k_pairs(rows, cols, scores, top_k)
+        order = np.lexsort((cols, rows))
+        yield rows[order], cols[order], scores[order]
+
+# Helper function to hash the word shingles of a text block to 32-bit integers
+def shingle_hashes(text, shingle_size=LSH_SHINGLE_SIZE):
+    words = text.split()
+    shingles = {" ".join(words[k:k + shingle_size]) for k in range(max(1, len(words) - shingle_size + 1))}
+    return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+# Function to compute MinHash signatures over word shingles for a list of text blocks
+def minhash_signatures(text_blocks, num_perm, shingle_size=LSH_SHINGLE_SIZE, seed=1):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+    signatures = np.empty((len(text_blocks), num_perm), dtype=np.uint64)
+    for index, text in enumerate(text_blocks):
+        hashes = shingle_hashes(text, shingle_size)
+        signatures[index] = ((hashes[:, None] * a + b) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+# Function to propose candidate pairs whose signatures collide in at least one LSH band.
+# With split set, only pairs between a query row (< split) and a corpus row (>= split) are kept.
+def lsh_candidate_pairs(signatures, bands, rows, split=None):
+    count = signatures.shape[0]
+    band_weights = np.random.default_rng(0).integers(1, 1 << 63, rows, dtype=np.uint64)
+    candidates = []
+    for band in range(bands):
+        # Colliding keys from different band values only add extra candidates, which are
+        # filtered out by the exact cosine scoring afterwards
+        keys = (signatures[:, band * rows:(band + 1) * rows] * band_weights).sum(axis=1)
+        _, bucket_ids = np.unique(keys, return_inverse=True)
+        order = np.argsort(bucket_ids, kind="stable")
+        bucket_sizes = np.bincount(bucket_ids)
+        bucket_starts = np.concatenate(([0], np.cumsum(bucket_sizes)[:-1]))
+        for bucket in np.flatnonzero(bucket_sizes > 1):
+            members = order[bucket_starts[bucket]:bucket_starts[bucket] + bucket_sizes[bucket]]
+            if split is None:
+                left, right = np.triu_indices(len(members), 1)
+                candidates.append(members[left] * count + members[right])
+            else:
+                queries, corpus = members[members < split], members[members >= split]
+                if len(queries) and len(corpus):
+                    candidates.append((queries[:, None] * count + corpus).ravel())
+
+    if not candidates:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pair_keys = np.unique(np.concatenate(candidates))
+    return pair_keys // count, pair_keys % count
+
+# Function to score candidate pairs with exact TF-IDF cosine similarity in row batches.
+# Candidates must be sorted by query row; yields the same (rows, cols, scores) batches as
+# find_similar_pairs.
+def score_candidate_pairs(query_matrix, corpus_matrix, rows, cols, threshold=SIMILARITY_THRESHOLD,
+                          top_k=None, batch_size=SIMILARITY_BATCH_SIZE):
+    for start in range(0, query_matrix.shape[0], batch_size):
+        low, high = np.searchsorted(rows, [start, start + batch_size])
+        if low == high:
+            continue
+        batch_rows, batch_cols = rows[low:high], cols[low:high]
+        scores = np.asarray(query_matrix[batch_rows].multiply(corpus_matrix[batch_cols]).sum(axis=1)).ravel()
+        keep = scores > threshold
+        batch_rows, batch_cols, scores = batch_rows[keep], batch_cols[keep], scores[keep]
+        if top_k is not None:
+            batch_rows, batch_cols, scores = keep_top_k_pairs(batch_rows, batch_cols, scores, top_k)
+            order = np.lexsort((batch_cols, batch_rows))
+            batch_rows, batch_cols, scores = batch_rows[order], batch_cols[order], scores[order]
+        yield batch_rows, batch_cols, scores
+
+# Helper function to summarize how many block comparisons a similarity mode performed
+def comparison_stats(similarity_mode, total_pairs, compared_pairs, duplicate_blocks=0):
+    avoided = total_pairs - compared_pairs
+    return {
+        "similarity_mode": similarity_mode,
+        "total_pairs": total_pairs,
+        "compared_pairs": compared_pairs,
+        "avoided_pairs": avoided,
+        "avoided_percentage": round(avoided / total_pairs * 100, 2) if total_pairs else 0,
+        "exact_duplicate_blocks": duplicate_blocks,
+    }
+
+# Function to group identical normalized blocks. Returns the distinct texts in order of first
+# appearance and, for each of them, the indices of all its occurrences.
+def group_identical_blocks(text_blocks):
+    groups = {}
+    for index, text in enumerate(text_blocks):
+        groups.setdefault(text, []).append(index)
+    return list(groups), list(groups.values())
+
+# Function to vectorize distinct blocks so that each row equals the TF-IDF vector a TfidfVectorizer
+# fitted on every occurrence would produce: document frequencies are weighted by occurrence counts
+def weighted_tfidf_matrix(unique_texts, occurrence_counts):
+    counts = CountVectorizer().fit_transform(unique_texts)
+    presence = counts.copy()
+    presence.data[:] = 1
+    document_frequency = presence.T @ occurrence_counts
+    idf = idf_weights(document_frequency, occurrence_counts.sum())
+    return l2_normalize_rows(counts.astype(np.float64) @ sparse.diags(idf))
+
+# Function to compare a batch of query PDFs against the corpus in one pass: all query and corpus
+# blocks share one TF-IDF vectorization and one sparse product, and the matches are then split
+# by query PDF. Returns common elements keyed by query PDF name.
+def compare_query_batch(pdf_reports, query_reports, threshold=SIMILARITY_THRESHOLD, top_k=None, similarity_mode="sparse",
+                        lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE, run_metrics=None):
+    batch_elements = {query_name: {"text_blocks": defaultdict(list)} for query_name in query_reports}
+    query_text_blocks = [block for report in query_reports.values() for block in report["text_blocks"]]
+    query_names = [query_name for query_name, report in query_reports.items() for _ in report["text_blocks"]]
+    corpus_text_blocks = [block for report in pdf_reports.values() for block in report["text_blocks"]]
+    pdf_names = [pdf_name for pdf_name, report in pdf_reports.items() for _ in report["text_blocks"]]
+    query_count = len(query_text_blocks)
+    total_pairs = query_count * len(corpus_text_blocks)
+
+    # Identical blocks are reported as 100% matches straight away; only one representative of
+    # each group goes through the fuzzy similarity stage
+    unique_texts, occurrences = group_identical_blocks(query_text_blocks + corpus_text_blocks)
+    corpus_occurrences = [[index - query_count for index in indices if index >= query_count] for indices in occurrences]
+    query_ids = [unique_id for unique_id, indices in enumerate(occurrences) if indices[0] < query_count]
+    corpus_ids = [unique_id for unique_id, indices in enumerate(corpus_occurrences) if indices]
+    query_owners = {unique_id: list(dict.fromkeys(query_names[index] for index in occurrences[unique_id] if index < query_count))
+                    for unique_id in query_ids}
+
+    # Helper to add matches of a distinct query block to every query PDF that contains it
+    def add_matches(query_id, matches):
+        for query_name in query_owners[query_id]:
+            batch_elements[query_name]["text_blocks"][unique_texts[query_id]].extend(matches)
+
+    for unique_id in query_ids:
+        if corpus_occurrences[unique_id]:
+            add_matches(unique_id, [(pdf_names[j], 100.0) for j in corpus_occurrences[unique_id]])
+
+    duplicate_blocks = query_count + len(corpus_text_blocks) - len(unique_texts)
+    unique_pairs = len(query_ids) * len(corpus_ids)
+    stats = comparison_stats(similarity_mode, total_pairs, unique_pairs, duplicate_blocks)
+    if unique_pairs > 0:
+        with measure_stage(run_metrics, "vectorization") as stage:
+            tfidf_matrix = weighted_tfidf_matrix(unique_texts, np.array([len(indices) for indices in occurrences]))
+            query_matrix, corpus_matrix = tfidf_matrix[query_ids], tfidf_matrix[corpus_ids]
+            stage.update(blocks=query_count + len(corpus_text_blocks), distinct_blocks=len(unique_texts), features=tfidf_matrix.shape[1])
+
+        with measure_stage(run_metrics, "similarity") as stage:
+            if similarity_mode == "lsh":
+                signatures = minhash_signatures([unique_texts[unique_id] for unique_id in query_ids + corpus_ids], lsh_bands * lsh_rows, shingle_size)
+                candidate_rows, candidate_cols = lsh_candidate_pairs(signatures, lsh_bands, lsh_rows, split=len(query_ids))
+                stats = comparison_stats(similarity_mode, total_pairs, len(candidate_rows), duplicate_blocks)
+                pair_batches = score_candidate_pairs(query_matrix, corpus_matrix, candidate_rows, candidate_cols - len(query_ids), threshold, top_k)
+            else:
+                pair_batches = find_similar_pairs(query_matrix, corpus_matrix, threshold, top_k)
+
+            # A match with a representative is a match with every corpus occurrence of its group
+            for rows, cols, scores in pair_batches:
+                for i, j, similarity in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+                    query_id, corpus_id = query_ids[i], corpus_ids[j]
+                    if query_id != corpus_id:
+                        similarity = round(similarity * 100, 2)
+                        add_matches(query_id, [(pdf_names[k], similarity) for k in corpus_occurrences[corpus_id]])
+            stage.update(compared_pairs=stats["compared_pairs"],
+                         report_rows=sum(len(matches) for common_elements in batch_elements.values()
+                                         for matches in common_elements["text_blocks"].values()))
+
+    for common_elements in batch_elements.values():
+        common_elements["comparison_stats"] = stats
+    return batch_elements
+
+# Function to compare PDFs and find common elements with similarity percentages
+def compare_pdf_structures(pdf_reports, single_pdf_report, threshold=SIMILARITY_THRESHOLD, top_k=None, similarity_mode="sparse",
+                           lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE, run_metrics=None):
+    return compare_query_batch(pdf_reports, {"Single PDF": single_pdf_report}, threshold, top_k, similarity_mode,
+                               lsh_bands, lsh_rows, shingle_size, run_metrics)["Single PDF"]
+
+# Helper function to yield the report rows (type, content, found in PDF, similarity) of the common elements
+def iter_report_rows(common_elements):
+    for item, matches in common_elements["text_blocks"].items():
+        for pdf_name, similarity in matches:
+            yield "Text Block", item, pdf_name, similarity
+
+# Helper function to name the file of an HTML report page; the first page keeps the original report name
+def html_report_page_name(page_number):
+    if page_number == 1:
+        return "template_reusability_report.html"
+    return f"template_reusability_report_page_{page_number}.html"
+
+# Helper function to write the head of an HTML report page up to the opening of the table body
+def write_html_page_header(html_file, page_number, generated_on):
+    previous_link = f'<a href="{html_report_page_name(page_number - 1)}">&laquo; Previous</a> | ' if page_number > 1 else ""
+    html_file.write(f"""
     <html>
     <head>
-        <title>Template Reusability Report</title>
+        <meta charset="utf-8">
+        <title>Template Reusability Report - Page {page_number}</title>
         <style>
             body {{ font-family: Arial, sans-serif; margin: 20px; }}
             h1 {{ color: #333; }}
@@ -96,7 +469,8 @@ def generate_comparison_html_report(common_elements, output_folder):
     </head>
     <body>
         <h1>Template Reusability Report</h1>
-        <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        <p>Generated on {generated_on}</p>
+        <p>{previous_link}Page {page_number} | <a href="template_reusability_report_pages.html">All pages</a></p>
         <table>
             <thead>
                 <tr>
@@ -107,127 +481,1148 @@ def generate_comparison_html_report(common_elements, output_folder):
                 </tr>
             </thead>
             <tbody>
-    """
+    """)
+
+# Helper function to close the table of an HTML report page, linking the next page when there is one
+def write_html_page_footer(html_file, next_page_number=None):
+    next_link = f'<p><a href="{html_report_page_name(next_page_number)}">Next &raquo;</a></p>' if next_page_number else ""
+    html_file.write(f"""
+            </tbody>
+        </table>
+        {next_link}
+    </body>
+    </html>
+    """)
+
+# Function to stream report rows into linked HTML pages of at most rows_per_page rows each.
+# Rows are written to disk as they are produced, so memory use does not depend on the number
+# of matches. Returns the number of pages written.
+def write_html_report_pages(rows, output_folder, rows_per_page=HTML_ROWS_PER_PAGE):
+    generated_on = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    page_row_counts = []
+    html_file = None
+    try:
+        for element_type, content, pdf_name, similarity in rows:
+            if not page_row_counts or page_row_counts[-1] == rows_per_page:
+                if html_file:
+                    write_html_page_footer(html_file, len(page_row_counts) + 1)
+                    html_file.close()
+                page_row_counts.append(0)
+                html_file = open(os.path.join(output_folder, html_report_page_name(len(page_row_counts))), "w", encoding="utf-8")
+                write_html_page_header(html_file, len(page_row_counts), generated_on)
 
-    for item, matches in common_elements["text_blocks"].items():
-        for match in matches:
-            pdf_name, similarity = match
             highlight_class = "highlight-green" if similarity == 100 else "highlight-yellow"
-            html_content += f"""
+            html_file.write(f"""
             <tr class="{highlight_class}">
-                <td>Text Block</td>
-                <td>{item}</td>
-                <td>{pdf_name}</td>
+                <td>{html.escape(element_type)}</td>
+                <td>{html.escape(content)}</td>
+                <td>{html.escape(pdf_name)}</td>
                 <td>{similarity}%</td>
             </tr>
-            """
+            """)
+            page_row_counts[-1] += 1
 
-    html_content += """
-            </tbody>
-        </table>
+        if html_file is None:
+            page_row_counts.append(0)
+            html_file = open(os.path.join(output_folder, html_report_page_name(1)), "w", encoding="utf-8")
+            write_html_page_header(html_file, 1, generated_on)
+        write_html_page_footer(html_file)
+    finally:
+        if html_file:
+            html_file.close()
+
+    with open(os.path.join(output_folder, "template_reusability_report_pages.html"), "w", encoding="utf-8") as index_file:
+        index_file.write(f"""
+    <html>
+    <head><meta charset="utf-8"><title>Template Reusability Report - Pages</title></head>
+    <body style="font-family: Arial, sans-serif; margin: 20px;">
+        <h1>Template Reusability Report</h1>
+        <p>Generated on {generated_on}: {sum(page_row_counts)} rows in {len(page_row_counts)} pages</p>
+        <ul>
+    """)
+        row_start = 1
+        for page_number, row_count in enumerate(page_row_counts, 1):
+            index_file.write(f'<li><a href="{html_report_page_name(page_number)}">Page {page_number}</a> '
+                             f'(rows {row_start}-{row_start + row_count - 1})</li>\n')
+            row_start += row_count
+        index_file.write("""
+        </ul>
     </body>
     </html>
-    """
+    """)
+    return len(page_row_counts)
+
+# Function to generate HTML report for common elements in tabular format
+def generate_comparison_html_report(common_elements, output_folder, rows_per_page=HTML_ROWS_PER_PAGE):
+    page_count = write_html_report_pages(iter_report_rows(common_elements), output_folder, rows_per_page)
+    html_filename = os.path.join(output_folder, html_report_page_name(1))
+    print(f"Template reusability report generated: {html_filename} ({page_count} pages)")
+
+# Helper function to name the workbook of an Excel report part; the first part keeps the original name
+def excel_report_filename(output_folder, current_time, part_number):
+    suffix = "" if part_number == 1 else f"_part{part_number}"
+    return os.path.join(output_folder, f"template_reusability_report_{current_time}{suffix}.xlsx")
+
+# Function to stream report rows into write-only Excel workbooks. Cell styles are created once per
+# sheet and shared by every row; a full sheet rolls over to a new sheet, and a workbook with
+# max_sheets_per_workbook sheets rolls over to a new workbook. Returns the workbook paths.
+def write_excel_report(rows, output_folder, max_rows_per_sheet=EXCEL_MAX_ROWS_PER_SHEET,
+                       max_sheets_per_workbook=EXCEL_MAX_SHEETS_PER_WORKBOOK):
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    header = ["Type", "Content (Paragraph)", "Found in PDF", "Similarity Percentage"]
+    alignment = Alignment(wrap_text=True, vertical='top')
+    fills = {
+        True: PatternFill(start_color="D4EDDA", end_color="D4EDDA", fill_type="solid"),
+        False: PatternFill(start_color="FFF3CD", end_color="FFF3CD", fill_type="solid"),
+    }
 
-    html_filename = os.path.join(output_folder, "template_reusability_report.html")
-    with open(html_filename, "w", encoding="utf-8") as html_file:
-        html_file.write(html_content)
+    excel_filenames = []
+    workbook = None
+    worksheet = None
+    row_cells = None
+    sheet_count = 0
+    total_sheet_count = 0
+    sheet_row_count = max_rows_per_sheet
+    rows = iter(rows)
+    while True:
+        row = next(rows, None)
+        if sheet_row_count == max_rows_per_sheet and (row is not None or workbook is None):
+            if workbook is None or sheet_count == max_sheets_per_workbook:
+                if workbook is not None:
+                    excel_filenames.append(excel_report_filename(output_folder, current_time, len(excel_filenames) + 1))
+                    workbook.save(excel_filenames[-1])
+                workbook = Workbook(write_only=True)
+                sheet_count = 0
+            sheet_count += 1
+            total_sheet_count += 1
+            title = "Template Reusability Report" + ("" if total_sheet_count == 1 else f" {total_sheet_count}")
+            worksheet = workbook.create_sheet(title)
 
-    print(f"Template reusability report generated: {html_filename}")
+            header_cells = [WriteOnlyCell(worksheet, value=value) for value in header]
+            for cell in header_cells:
+                cell.alignment = alignment
+            worksheet.append(header_cells)
+
+            # Write-only rows are serialized on append, so the same styled cells are reused for every row
+            row_cells = {}
+            for is_exact_match, fill in fills.items():
+                row_cells[is_exact_match] = [WriteOnlyCell(worksheet) for _ in header]
+                for column_index, cell in enumerate(row_cells[is_exact_match], 1):
+                    cell.alignment = alignment
+                    if column_index in (2, 4):
+                        cell.fill = fill
+            sheet_row_count = 1
+
+        if row is None:
+            break
+        cells = row_cells[float(row[3]) == 100]
+        for cell, value in zip(cells, row):
+            cell.value = value
+        worksheet.append(cells)
+        sheet_row_count += 1
+
+    excel_filenames.append(excel_report_filename(output_folder, current_time, len(excel_filenames) + 1))
+    workbook.save(excel_filenames[-1])
+    return excel_filenames
 
 # Function to generate Excel report with wrapped text and highlighting
 def generate_comparison_excel_report(common_elements, output_folder):
-    rows = []
-    for item, matches in common_elements["text_blocks"].items():
-        for match in matches:
-            pdf_name, similarity = match
-            rows.append(["Text Block", item, pdf_name, similarity])
+    for excel_filename in write_excel_report(iter_report_rows(common_elements), output_folder):
+        print(f"Excel report generated: {excel_filename}")
 
-    df = pd.DataFrame(rows, columns=["Type", "Content (Paragraph)", "Found in PDF", "Similarity Percentage"])
+# Helper function to read the peak resident set size in bytes of this process and of its largest
+# finished child process (the extraction workers); None where the resource module is unavailable
+def peak_rss_bytes():
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Template Reusability Report"
+# Helper function to read the CPU time of this process and of its finished child processes
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
 
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
-        for c_idx, value in enumerate(row, 1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=value)
-            cell.alignment = Alignment(wrap_text=True, vertical='top')
+# Function to start collecting the metrics of a run
+def start_run_metrics(kind, settings):
+    return {"kind": kind, "started_at": datetime.now().isoformat(), "settings": settings, "stages": {}}
 
-            if r_idx > 1:
-                if c_idx == 4:
-                    similarity = float(value)
-                    fill = PatternFill(start_color="D4EDDA", end_color="D4EDDA", fill_type="solid") if similarity == 100 else PatternFill(start_color="FFF3CD", end_color="FFF3CD", fill_type="solid")
-                    ws.cell(row=r_idx, column=2).fill = fill
-                    ws.cell(row=r_idx, column=4).fill = fill
+# Context manager to record the wall time, CPU time and peak RSS of a stage in the run metrics. The
+# yielded dict takes the item counts of the stage; without run metrics nothing is recorded.
+@contextmanager
+def measure_stage(run_metrics, name):
+    stage = {}
+    wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+    try:
+        yield stage
+    finally:
+        if run_metrics is not None:
+            peak_rss, peak_worker_rss = peak_rss_bytes()
+            run_metrics["stages"][name] = dict(stage, wall_seconds=round(time.perf_counter() - wall_start, 4),
+                                               cpu_seconds=round(cpu_seconds() - cpu_start, 4),
+                                               peak_rss_bytes=peak_rss, peak_worker_rss_bytes=peak_worker_rss)
 
-    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    excel_filename = os.path.join(output_folder, f"template_reusability_report_{current_time}.xlsx")
-    wb.save(excel_filename)
+# Function to summarize per-PDF extraction latency: totals, percentiles and the slowest PDFs
+def extraction_latency_summary(extraction_times):
+    if not extraction_times:
+        return {"pdfs": 0}
+    seconds = np.array([times["seconds"] for times in extraction_times.values()])
+    slowest = sorted(extraction_times.items(), key=lambda item: item[1]["seconds"], reverse=True)[:SLOWEST_PDFS_REPORTED]
+    return {
+        "pdfs": len(seconds),
+        "total_seconds": round(float(seconds.sum()), 4),
+        "mean_seconds": round(float(seconds.mean()), 4),
+        "median_seconds": round(float(np.median(seconds)), 4),
+        "p95_seconds": round(float(np.percentile(seconds, 95)), 4),
+        "max_seconds": round(float(seconds.max()), 4),
+        "slowest": [dict(pdf=pdf_name, **times, seconds_per_page=round(times["seconds"] / max(times["pages"], 1), 4))
+                    for pdf_name, times in slowest],
+    }
+
+# Function to write the run metrics to run_manifest.json in the report folder
+def write_run_manifest(run_metrics, output_folder, extraction_times=None, **results):
+    finished_at = datetime.now()
+    run_metrics.update(results)
+    run_metrics["finished_at"] = finished_at.isoformat()
+    run_metrics["wall_seconds"] = round((finished_at - datetime.fromisoformat(run_metrics["started_at"])).total_seconds(), 4)
+    run_metrics["pdf_extraction"] = extraction_latency_summary(extraction_times)
+    manifest_path = os.path.join(output_folder, "run_manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(run_metrics, manifest_file, indent=2)
+    print(f"Run manifest saved: {manifest_path}")
+
+# Function to extract the text blocks of a list of PDFs in a process pool. Each PDF is split into
+# page-range tasks and the largest files are scheduled first, so wall-clock time depends on the
+# total number of pages rather than on the biggest file. Cached extractions are reused when a
+# cache folder is given. Returns the reports keyed by PDF name and the content hash of every PDF
+# looked up in the cache. When an extraction_times dict is given, it is filled with the pages, tasks
+# and summed task seconds of every PDF extracted in this call.
+def extract_pdf_reports(pdf_files, base_output_folder, cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+                        pages_per_task=PAGES_PER_TASK, extraction_times=None, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    pdf_reports, content_hashes = {}, {}
+    if cache_dir:
+        pdf_reports, content_hashes = load_cached_reports(pdf_files, cache_dir, extraction_mode)
+        print(f"Loaded {len(pdf_reports)} of {len(pdf_files)} PDFs from the extraction cache.")
+
+    page_counts = {}
+    for pdf in pdf_files:
+        if os.path.basename(pdf) not in pdf_reports:
+            page_count = pdf_page_count(pdf)
+            if page_count is not None:
+                page_counts[pdf] = page_count
+
+    page_ranges = defaultdict(dict)
+    pending_tasks = {}
+    failed_pdfs = set()
+    processed_count = len(pdf_reports)
+    total_pdfs = processed_count + len(page_counts)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = {}
+        for pdf in sorted(page_counts, key=page_counts.get, reverse=True):
+            start_pages = range(0, max(page_counts[pdf], 1), pages_per_task)
+            pending_tasks[pdf] = len(start_pages)
+            for start_page in start_pages:
+                futures[executor.submit(analyze_pdf_pages, pdf, start_page, start_page + pages_per_task,
+                                        extraction_mode)] = (pdf, start_page)
+
+        for future in concurrent.futures.as_completed(futures):
+            pdf, start_page = futures[future]
+            pending_tasks[pdf] -= 1
+            try:
+                page_ranges[pdf][start_page] = future.result()
+            except Exception as exc:
+                if pdf not in failed_pdfs:
+                    failed_pdfs.add(pdf)
+                    print(f"PDF {pdf} generated an exception: {exc}")
+                    with open(os.path.join(base_output_folder, "processing_log.txt"), 'a') as log_file:
+                        log_file.write(f"{pdf} failed with error: {exc}\n")
+                with open("error_log.txt", 'a') as log_file:
+                    log_file.write(f"PDF {pdf} generated an exception: {exc}\n")
+
+            if pending_tasks[pdf] == 0:
+                ranges = page_ranges.pop(pdf, {})
+                if pdf in failed_pdfs:
+                    continue
+                if extraction_times is not None:
+                    extraction_times[os.path.basename(pdf)] = {
+                        "pages": page_counts[pdf],
+                        "tasks": len(ranges),
+                        "seconds": round(sum(page_range["seconds"] for page_range in ranges.values()), 4),
+                    }
+                report = merge_page_ranges(ranges, page_counts[pdf])
+                pdf_reports[os.path.basename(pdf)] = report
+                if cache_dir:
+                    store_cached_extraction(cache_dir, content_hashes[pdf], extraction_settings(extraction_mode), report, cache_max_bytes)
+                processed_count += 1
+                print(f"Processed {processed_count}/{total_pdfs} PDFs...")
+
+    return pdf_reports, content_hashes
+
+# Helper function to count the TF-IDF terms of text blocks as a sparse matrix. Unknown terms are
+# added to the vocabulary when extend_vocabulary is set; otherwise they are only counted per row
+# in the returned out-of-vocabulary array.
+def count_block_terms(text_blocks, vocabulary, extend_vocabulary=True):
+    analyzer = TfidfVectorizer().build_analyzer()
+    indptr, indices, data = [0], [], []
+    oov_counts = []
+    for text in text_blocks:
+        oov_count = 0
+        for term, count in Counter(analyzer(text)).items():
+            column = vocabulary.get(term)
+            if column is None:
+                if not extend_vocabulary:
+                    oov_count += count
+                    continue
+                column = vocabulary[term] = len(vocabulary)
+            indices.append(column)
+            data.append(count)
+        indptr.append(len(indices))
+        oov_counts.append(oov_count)
 
-    print(f"Excel report generated: {excel_filename}")
+    counts = sparse.csr_matrix((np.array(data, dtype=np.int32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+                               shape=(len(text_blocks), len(vocabulary)))
+    counts.sort_indices()
+    return counts, np.array(oov_counts, dtype=np.float64)
 
-# Main function to process the PDF analysis and comparison
-def analyze_single_vs_all(single_pdf_folder, all_pdf_folder, base_output_folder):
+# Helper function to compute smoothed IDF weights the way TfidfVectorizer does
+def idf_weights(document_frequency, document_count):
+    return np.log((1 + document_count) / (1 + np.asarray(document_frequency, dtype=np.float64))) + 1
+
+# Helper function to scale the rows of a sparse matrix to unit length. extra_square_norms adds
+# the squared weight of terms that are not columns of the matrix to each row's norm.
+def l2_normalize_rows(weights, extra_square_norms=0):
+    row_norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel() + extra_square_norms)
+    row_norms[row_norms == 0] = 1
+    return (sparse.diags((1 / row_norms).astype(weights.dtype)) @ weights).tocsr()
+
+# Helper function to save an array next to the index files without leaving a half-written file behind
+def save_index_array(index_dir, name, array):
+    temp_path = os.path.join(index_dir, f"{name}.tmp.npy")
+    np.save(temp_path, array)
+    os.replace(temp_path, os.path.join(index_dir, f"{name}.npy"))
+
+# Function to build or incrementally update the persistent corpus index of the allpdf folder.
+# The index keeps the raw term counts of every corpus block so PDFs can be added, changed or
+# removed without re-extracting or re-tokenizing the rest of the library; only the IDF weights
+# and the normalized block matrix are recomputed from the counts.
+def update_corpus_index(all_pdf_folder, index_dir, base_output_folder, cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+                        extraction_mode=DEFAULT_EXTRACTION_MODE):
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["settings"] != extraction_settings(extraction_mode):
+            print("Extractor settings changed since the corpus index was built. Rebuilding it.")
+            manifest = None
+    else:
+        manifest = None
+
+    is_new_index = manifest is None
+    if is_new_index:
+        manifest = {"settings": extraction_settings(extraction_mode), "pdfs": []}
+        vocabulary = {}
+        counts = sparse.csr_matrix((0, 0), dtype=np.int32)
+    else:
+        with open(os.path.join(index_dir, "vocabulary.json"), "r", encoding="utf-8") as vocabulary_file:
+            vocabulary = {term: column for column, term in enumerate(json.load(vocabulary_file))}
+        counts = sparse.csr_matrix((np.load(os.path.join(index_dir, "counts_data.npy")),
+                                    np.load(os.path.join(index_dir, "counts_indices.npy")),
+                                    np.load(os.path.join(index_dir, "counts_indptr.npy"))),
+                                   shape=(manifest["block_count"], len(vocabulary)))
+
+    # PDFs whose size and modification time are unchanged are not hashed again
+    indexed = {entry["name"]: entry for entry in manifest["pdfs"]}
+    current = {}
+    changed_pdf_files = []
+    for file_name in sorted(os.listdir(all_pdf_folder)):
+        if not file_name.lower().endswith('.pdf'):
+            continue
+        pdf = os.path.join(all_pdf_folder, file_name)
+        stat = os.stat(pdf)
+        entry = indexed.get(file_name)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            current[file_name] = entry
+            continue
+        content_hash = file_content_hash(pdf)
+        if entry and entry["content_hash"] == content_hash:
+            current[file_name] = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+            continue
+        changed_pdf_files.append(pdf)
+        current[file_name] = {"name": file_name, "content_hash": content_hash, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    changed_names = {os.path.basename(pdf) for pdf in changed_pdf_files}
+    kept = [entry for entry in manifest["pdfs"] if entry["name"] in current and entry["name"] not in changed_names]
+    removed_names = [entry["name"] for entry in manifest["pdfs"] if entry["name"] not in current]
+    if not is_new_index and not changed_pdf_files and not removed_names:
+        manifest["pdfs"] = [current[entry["name"]] | {"block_start": entry["block_start"], "block_count": entry["block_count"]}
+                            for entry in kept]
+        with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file)
+        print(f"Corpus index is up to date ({len(kept)} PDFs, {manifest['block_count']} blocks).")
+        return
+
+    print(f"Updating corpus index: {len(changed_pdf_files)} new or changed PDFs, {len(removed_names)} removed.")
+    pdf_reports, _ = extract_pdf_reports(changed_pdf_files, base_output_folder, cache_dir, cache_max_bytes,
+                                         extraction_mode=extraction_mode)
+
+    # Keep the count rows of unchanged PDFs and append the rows of new or changed ones
+    kept_rows = [np.arange(entry["block_start"], entry["block_start"] + entry["block_count"]) for entry in kept]
+    counts = counts[np.concatenate(kept_rows)] if kept_rows else counts[:0]
+    pdf_entries = []
+    block_start = 0
+    for entry in kept:
+        pdf_entries.append(current[entry["name"]] | {"block_start": block_start, "block_count": entry["block_count"]})
+        block_start += entry["block_count"]
+
+    new_text_blocks = []
+    for pdf_name, report in sorted(pdf_reports.items()):
+        pdf_entries.append(current[pdf_name] | {"block_start": block_start, "block_count": len(report["text_blocks"])})
+        block_start += len(report["text_blocks"])
+        new_text_blocks.extend(report["text_blocks"])
+
+    new_counts, _ = count_block_terms(new_text_blocks, vocabulary)
+    counts.resize((counts.shape[0], len(vocabulary)))
+    counts = sparse.vstack([counts, new_counts], format="csr", dtype=np.int32)
+
+    document_frequency = np.bincount(counts.indices, minlength=len(vocabulary))
+    idf = idf_weights(document_frequency, counts.shape[0])
+    tfidf_matrix = l2_normalize_rows(counts.astype(np.float32) @ sparse.diags(idf.astype(np.float32))).tocsc()
+
+    # Blocks are stored column-major so a query multiplies straight against the stored arrays.
+    # Index arrays share one dtype so scipy does not copy the memory-mapped arrays on load.
+    index_dtype = np.int32 if max(counts.nnz, len(vocabulary), counts.shape[0]) < 2 ** 31 else np.int64
+    os.makedirs(index_dir, exist_ok=True)
+    save_index_array(index_dir, "counts_data", counts.data.astype(np.int32))
+    save_index_array(index_dir, "counts_indices", counts.indices.astype(index_dtype))
+    save_index_array(index_dir, "counts_indptr", counts.indptr.astype(index_dtype))
+    save_index_array(index_dir, "idf", idf)
+    save_index_array(index_dir, "matrix_data", tfidf_matrix.data.astype(np.float32))
+    save_index_array(index_dir, "matrix_indices", tfidf_matrix.indices.astype(index_dtype))
+    save_index_array(index_dir, "matrix_indptr", tfidf_matrix.indptr.astype(index_dtype))
+    with open(os.path.join(index_dir, "vocabulary.json"), "w", encoding="utf-8") as vocabulary_file:
+        json.dump(sorted(vocabulary, key=vocabulary.get), vocabulary_file)
+
+    manifest["pdfs"] = pdf_entries
+    manifest["block_count"] = counts.shape[0]
+    manifest["vocabulary_size"] = len(vocabulary)
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file)
+    print(f"Corpus index saved to {index_dir} ({len(pdf_entries)} PDFs, {counts.shape[0]} blocks).")
+
+# Function to load the corpus index; the block matrix is memory-mapped rather than read into memory
+def load_corpus_index(index_dir):
+    with open(os.path.join(index_dir, "manifest.json"), "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    with open(os.path.join(index_dir, "vocabulary.json"), "r", encoding="utf-8") as vocabulary_file:
+        vocabulary = {term: column for column, term in enumerate(json.load(vocabulary_file))}
+
+    matrix = sparse.csc_matrix((np.load(os.path.join(index_dir, "matrix_data.npy"), mmap_mode="r"),
+                                np.load(os.path.join(index_dir, "matrix_indices.npy"), mmap_mode="r"),
+                                np.load(os.path.join(index_dir, "matrix_indptr.npy"), mmap_mode="r")),
+                               shape=(manifest["block_count"], len(vocabulary)), copy=False)
+    block_pdf = np.repeat(np.arange(len(manifest["pdfs"])), [entry["block_count"] for entry in manifest["pdfs"]])
+    return {
+        "manifest": manifest,
+        "vocabulary": vocabulary,
+        "idf": np.load(os.path.join(index_dir, "idf.npy")),
+        "matrix": matrix,
+        "pdf_names": [entry["name"] for entry in manifest["pdfs"]],
+        "block_pdf": block_pdf,
+    }
+
+# Function to vectorize query blocks with the vocabulary and IDF weights of the corpus index.
+# Terms unknown to the corpus are weighted like terms no corpus block contains, so they still
+# lower the similarity of a query block the way they would in a joint TF-IDF fit.
+def vectorize_query_blocks(corpus_index, text_blocks):
+    counts, oov_counts = count_block_terms(text_blocks, corpus_index["vocabulary"], extend_vocabulary=False)
+    idf = corpus_index["idf"]
+    weights = counts.astype(np.float64) @ sparse.diags(idf)
+    oov_idf = idf_weights(0, corpus_index["manifest"]["block_count"])
+    return l2_normalize_rows(weights, (oov_counts * oov_idf) ** 2)
+
+# Function to compare a batch of query PDFs against the corpus index; distinct query blocks are
+# vectorized once and multiplied against the index in one sparse product. Returns common
+# elements keyed by query PDF name.
+def compare_query_batch_with_corpus_index(corpus_index, query_reports, threshold=SIMILARITY_THRESHOLD, top_k=None, run_metrics=None):
+    batch_elements = {query_name: {"text_blocks": defaultdict(list)} for query_name in query_reports}
+    query_text_blocks = [block for report in query_reports.values() for block in report["text_blocks"]]
+    query_names = [query_name for query_name, report in query_reports.items() for _ in report["text_blocks"]]
+    unique_texts, occurrences = group_identical_blocks(query_text_blocks)
+    total_pairs = len(query_text_blocks) * corpus_index["manifest"]["block_count"]
+    compared_pairs = len(unique_texts) * corpus_index["manifest"]["block_count"]
+    stats = comparison_stats("index", total_pairs, compared_pairs, len(query_text_blocks) - len(unique_texts))
+
+    if compared_pairs > 0:
+        with measure_stage(run_metrics, "vectorization") as stage:
+            query_matrix = vectorize_query_blocks(corpus_index, unique_texts).astype(np.float32)
+            stage.update(blocks=len(query_text_blocks), distinct_blocks=len(unique_texts), features=query_matrix.shape[1])
+
+        with measure_stage(run_metrics, "similarity") as stage:
+            for rows, cols, scores in find_similar_pairs(query_matrix, corpus_index["matrix"], threshold, top_k):
+                for i, j, similarity in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+                    match = (corpus_index["pdf_names"][corpus_index["block_pdf"][j]], round(similarity * 100, 2))
+                    for query_name in dict.fromkeys(query_names[index] for index in occurrences[i]):
+                        batch_elements[query_name]["text_blocks"][unique_texts[i]].append(match)
+            stage.update(compared_pairs=compared_pairs,
+                         report_rows=sum(len(matches) for common_elements in batch_elements.values()
+                                         for matches in common_elements["text_blocks"].values()))
+
+    for common_elements in batch_elements.values():
+        common_elements["comparison_stats"] = stats
+    return batch_elements
+
+# Function to compare a single PDF against the corpus index with the same output as compare_pdf_structures
+def compare_with_corpus_index(corpus_index, single_pdf_report, threshold=SIMILARITY_THRESHOLD, top_k=None, run_metrics=None):
+    return compare_query_batch_with_corpus_index(corpus_index, {"Single PDF": single_pdf_report}, threshold, top_k,
+                                                 run_metrics)["Single PDF"]
+
+# Tables of the SQLite results store. Every run adds its PDFs, pages, blocks and match rows; block
+# texts are stored once in texts and shared by all runs, so the same block can be followed across
+# runs and PDFs by its text_id. Page numbers are 1-based.
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    similarity_mode TEXT,
+    threshold REAL,
+    output_folder TEXT,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS texts (
+    text_id INTEGER PRIMARY KEY,
+    text_hash TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pdfs (
+    pdf_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    name TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content_hash TEXT,
+    page_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS pages (
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    page_number INTEGER NOT NULL,
+    block_count INTEGER NOT NULL,
+    PRIMARY KEY (pdf_id, page_number)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    block_number INTEGER NOT NULL,
+    page_number INTEGER,
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    bbox TEXT,
+    PRIMARY KEY (pdf_id, block_number)
+);
+CREATE TABLE IF NOT EXISTS matches (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    row_number INTEGER NOT NULL,
+    query_pdf_id INTEGER REFERENCES pdfs(pdf_id),
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    similarity REAL NOT NULL,
+    PRIMARY KEY (run_id, row_number)
+);
+CREATE INDEX IF NOT EXISTS pdfs_run_name ON pdfs (run_id, name);
+CREATE INDEX IF NOT EXISTS blocks_text ON blocks (text_id);
+CREATE INDEX IF NOT EXISTS matches_text ON matches (text_id);
+CREATE INDEX IF NOT EXISTS matches_pdf ON matches (pdf_id);
+"""
+
+# Function to open the results store, creating its tables on first use
+def open_results_store(db_path):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.executescript(RESULTS_SCHEMA)
+    # Stores created before block bounding boxes were kept lack the bbox column
+    if "bbox" not in [column[1] for column in connection.execute("PRAGMA table_info(blocks)")]:
+        connection.execute("ALTER TABLE blocks ADD COLUMN bbox TEXT")
+    return connection
+
+# Helper function to hash a normalized block text for the texts table
+def block_text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# Helper function to return the text_id of a block text, adding the text on first use
+def store_block_text(connection, text_ids, text):
+    if text not in text_ids:
+        text_hash = block_text_hash(text)
+        connection.execute("INSERT OR IGNORE INTO texts (text_hash, text) VALUES (?, ?)", (text_hash, text))
+        text_ids[text] = connection.execute("SELECT text_id FROM texts WHERE text_hash = ?", (text_hash,)).fetchone()[0]
+    return text_ids[text]
+
+# Function to save one run to the results store: its PDFs with their pages and blocks, and every
+# report row of common_elements_by_query, which maps a query PDF name (None for all-vs-all runs)
+# to its common elements. Reports without text blocks (e.g. library PDFs read from a corpus
+# index) are stored as PDFs only. Returns the run_id.
+def store_run_results(db_path, kind, output_folder, similarity_mode, threshold, stats, library_reports,
+                      common_elements_by_query, query_reports=None, content_hashes=None):
+    content_hashes = content_hashes or {}
+    connection = open_results_store(db_path)
+    try:
+        with connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (created_at, kind, similarity_mode, threshold, output_folder, stats) VALUES (?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), kind, similarity_mode, threshold, output_folder, json.dumps(stats))
+            ).lastrowid
+
+            text_ids = {}
+            pdf_ids = {}
+            for role, reports in (("query", query_reports or {}), ("library", library_reports)):
+                for pdf_name, report in reports.items():
+                    pdf_id = connection.execute(
+                        "INSERT INTO pdfs (run_id, name, role, content_hash, page_count) VALUES (?, ?, ?, ?, ?)",
+                        (run_id, pdf_name, role, content_hashes.get(pdf_name), report.get("page_count"))
+                    ).lastrowid
+                    pdf_ids.setdefault(pdf_name, pdf_id)
+
+                    text_blocks = report.get("text_blocks", [])
+                    block_pages = report.get("block_pages", [None] * len(text_blocks))
+                    block_boxes = report.get("block_boxes", [None] * len(text_blocks))
+                    connection.executemany(
+                        "INSERT INTO blocks (pdf_id, block_number, page_number, text_id, bbox) VALUES (?, ?, ?, ?, ?)",
+                        ((pdf_id, block_number, None if page is None else page + 1, store_block_text(connection, text_ids, text),
+                          None if bbox is None else json.dumps(bbox))
+                         for block_number, (text, page, bbox) in enumerate(zip(text_blocks, block_pages, block_boxes)))
+                    )
+                    if report.get("page_count") is not None:
+                        page_block_counts = Counter(block_pages)
+                        connection.executemany(
+                            "INSERT INTO pages (pdf_id, page_number, block_count) VALUES (?, ?, ?)",
+                            ((pdf_id, page + 1, page_block_counts[page]) for page in range(report["page_count"]))
+                        )
+
+            # Match rows keep the order of the generated reports so they can be rendered again as-is
+            def match_rows():
+                row_number = 0
+                for query_name, common_elements in common_elements_by_query.items():
+                    query_pdf_id = None if query_name is None else pdf_ids[query_name]
+                    for _, text, pdf_name, similarity in iter_report_rows(common_elements):
+                        if pdf_name not in pdf_ids:
+                            pdf_ids[pdf_name] = connection.execute(
+                                "INSERT INTO pdfs (run_id, name, role) VALUES (?, ?, 'library')", (run_id, pdf_name)
+                            ).lastrowid
+                        yield run_id, row_number, query_pdf_id, store_block_text(connection, text_ids, text), pdf_ids[pdf_name], similarity
+                        row_number += 1
+
+            connection.executemany(
+                "INSERT INTO matches (run_id, row_number, query_pdf_id, text_id, pdf_id, similarity) VALUES (?, ?, ?, ?, ?, ?)",
+                match_rows()
+            )
+    finally:
+        connection.close()
+    print(f"Run {run_id} saved to results store: {db_path}")
+    return run_id
+
+# Function to list the runs in the results store, newest first
+def list_stored_runs(db_path):
+    connection = open_results_store(db_path)
+    try:
+        return connection.execute("""
+            SELECT runs.run_id, runs.created_at, runs.kind, runs.similarity_mode, runs.output_folder,
+                   (SELECT COUNT(*) FROM pdfs WHERE pdfs.run_id = runs.run_id),
+                   (SELECT COUNT(*) FROM matches WHERE matches.run_id = runs.run_id)
+            FROM runs ORDER BY runs.run_id DESC
+        """).fetchall()
+    finally:
+        connection.close()
+
+# Helper function to find the latest run in the results store
+def latest_stored_run(connection):
+    row = connection.execute("SELECT MAX(run_id) FROM runs").fetchone()
+    return row[0]
+
+# Function to find which PDFs contain a block and which PDFs it was matched with in a run (the
+# latest run by default). The text is normalized like extracted blocks; when no stored block is
+# identical to it, blocks containing it are returned instead.
+def query_stored_block(db_path, text, run_id=None):
+    connection = open_results_store(db_path)
+    try:
+        run_id = run_id or latest_stored_run(connection)
+        text = normalize_text(text)
+        text_rows = connection.execute("SELECT text_id, text FROM texts WHERE text_hash = ?", (block_text_hash(text),)).fetchall()
+        if not text_rows:
+            text_rows = connection.execute("SELECT text_id, text FROM texts WHERE instr(text, ?) > 0", (text,)).fetchall()
+
+        results = []
+        for text_id, block_text in text_rows:
+            occurrences = connection.execute("""
+                SELECT pdfs.name, blocks.page_number, blocks.bbox FROM blocks JOIN pdfs ON pdfs.pdf_id = blocks.pdf_id
+                WHERE blocks.text_id = ? AND pdfs.run_id = ? ORDER BY pdfs.name, blocks.page_number
+            """, (text_id, run_id)).fetchall()
+            matches = connection.execute("""
+                SELECT query.name, pdfs.name, matches.similarity FROM matches
+                JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+                LEFT JOIN pdfs AS query ON query.pdf_id = matches.query_pdf_id
+                WHERE matches.text_id = ? AND matches.run_id = ? ORDER BY matches.row_number
+            """, (text_id, run_id)).fetchall()
+            if occurrences or matches:
+                results.append({"text": block_text, "occurrences": occurrences, "matches": matches})
+        return run_id, results
+    finally:
+        connection.close()
+
+# Function to compare the matches of two runs in the results store. Pairs are keyed by query PDF,
+# block text and matched PDF name, so runs over changed folders can be compared; the comparison
+# runs inside SQLite without loading either run.
+def compare_stored_runs(db_path, old_run_id, new_run_id):
+    connection = open_results_store(db_path)
+    try:
+        connection.execute("DROP TABLE IF EXISTS temp.run_pairs")
+        connection.execute("""
+            CREATE TEMP TABLE run_pairs AS
+            SELECT matches.run_id, COALESCE(query.name, '') AS query_name, matches.text_id, pdfs.name AS pdf_name,
+                   MAX(matches.similarity) AS similarity
+            FROM matches JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+            LEFT JOIN pdfs AS query ON query.pdf_id = matches.query_pdf_id
+            WHERE matches.run_id IN (?, ?)
+            GROUP BY matches.run_id, query_name, matches.text_id, pdf_name
+        """, (old_run_id, new_run_id))
+        connection.execute("CREATE INDEX temp.run_pairs_key ON run_pairs (run_id, query_name, text_id, pdf_name)")
+
+        def count_pairs(sql, *params):
+            return connection.execute(sql, params).fetchone()[0]
+
+        only_in = """
+            SELECT COUNT(*) FROM run_pairs AS a WHERE a.run_id = ? AND NOT EXISTS (
+                SELECT 1 FROM run_pairs AS b WHERE b.run_id = ? AND b.query_name = a.query_name
+                AND b.text_id = a.text_id AND b.pdf_name = a.pdf_name)
+        """
+        changed = """
+            SELECT COUNT(*) FROM run_pairs AS a JOIN run_pairs AS b
+            ON b.run_id = ? AND b.query_name = a.query_name AND b.text_id = a.text_id AND b.pdf_name = a.pdf_name
+            WHERE a.run_id = ? AND b.similarity != a.similarity
+        """
+        pdf_names = """
+            SELECT name FROM pdfs WHERE run_id = ? EXCEPT SELECT name FROM pdfs WHERE run_id = ? ORDER BY name
+        """
+        return {
+            "old_run": old_run_id,
+            "new_run": new_run_id,
+            "old_pairs": count_pairs("SELECT COUNT(*) FROM run_pairs WHERE run_id = ?", old_run_id),
+            "new_pairs": count_pairs("SELECT COUNT(*) FROM run_pairs WHERE run_id = ?", new_run_id),
+            "added_pairs": count_pairs(only_in, new_run_id, old_run_id),
+            "removed_pairs": count_pairs(only_in, old_run_id, new_run_id),
+            "changed_similarity_pairs": count_pairs(changed, new_run_id, old_run_id),
+            "added_pdfs": [row[0] for row in connection.execute(pdf_names, (new_run_id, old_run_id))],
+            "removed_pdfs": [row[0] for row in connection.execute(pdf_names, (old_run_id, new_run_id))],
+        }
+    finally:
+        connection.close()
+
+# Helper function to yield the stored report rows of a run (optionally of one query PDF) in report order,
+# optionally only those above a higher similarity threshold than the run's own
+def iter_stored_report_rows(db_path, run_id, query_pdf_id=None, threshold=None):
+    connection = open_results_store(db_path)
+    try:
+        rows = connection.execute("""
+            SELECT 'Text Block', texts.text, pdfs.name, matches.similarity FROM matches
+            JOIN texts ON texts.text_id = matches.text_id JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+            WHERE matches.run_id = ? AND matches.query_pdf_id IS ? AND matches.similarity > ? ORDER BY matches.row_number
+        """, (run_id, query_pdf_id, -1 if threshold is None else threshold * 100))
+        yield from rows
+    finally:
+        connection.close()
+
+# Function to render the HTML and Excel reports of a stored run without recomputing anything,
+# optionally keeping only the matches above a higher threshold. Runs with several query PDFs get one
+# report folder per query PDF.
+def render_stored_run(db_path, run_id, output_folder, threshold=None):
+    connection = open_results_store(db_path)
+    try:
+        queries = connection.execute("""
+            SELECT DISTINCT matches.query_pdf_id, pdfs.name FROM matches LEFT JOIN pdfs ON pdfs.pdf_id = matches.query_pdf_id
+            WHERE matches.run_id = ? ORDER BY pdfs.name
+        """, (run_id,)).fetchall()
+    finally:
+        connection.close()
+
+    for query_pdf_id, query_name in queries or [(None, None)]:
+        report_folder = output_folder if len(queries) <= 1 else os.path.join(output_folder, os.path.splitext(query_name)[0])
+        os.makedirs(report_folder, exist_ok=True)
+        page_count = write_html_report_pages(iter_stored_report_rows(db_path, run_id, query_pdf_id, threshold), report_folder)
+        print(f"Template reusability report generated: {os.path.join(report_folder, html_report_page_name(1))} ({page_count} pages)")
+        for excel_filename in write_excel_report(iter_stored_report_rows(db_path, run_id, query_pdf_id, threshold), report_folder):
+            print(f"Excel report generated: {excel_filename}")
+
+# Function to report a stored run again at higher similarity thresholds without extracting or
+# comparing anything: the run's match rows above each threshold are rendered to one folder per
+# threshold under output_folder, and threshold_sweep.csv lists the match rows, matched blocks and
+# reusable percentage of every query PDF at each threshold. The run's own threshold is the lowest
+# that can be reported; similarities are compared as the percentages shown in the reports.
+def rethreshold_stored_run(db_path, run_id, thresholds, output_folder):
+    connection = open_results_store(db_path)
+    try:
+        run = connection.execute("SELECT threshold FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if run is None:
+            print(f"Run {run_id} not found in the results store.")
+            return []
+        run_threshold = run[0]
+        query_blocks = dict(connection.execute("""
+            SELECT pdfs.name, COUNT(DISTINCT blocks.text_id) FROM pdfs JOIN blocks ON blocks.pdf_id = pdfs.pdf_id
+            WHERE pdfs.run_id = ? AND pdfs.role = 'query' GROUP BY pdfs.pdf_id
+        """, (run_id,)))
+        sweep_rows = []
+        for threshold in sorted(set(thresholds)):
+            if threshold < run_threshold:
+                print(f"Skipping threshold {threshold}: run {run_id} only kept matches above {run_threshold}")
+                continue
+            query_matches = {name: (match_rows, matched_blocks) for name, match_rows, matched_blocks in connection.execute("""
+                SELECT query.name, COUNT(*), COUNT(DISTINCT matches.text_id) FROM matches
+                LEFT JOIN pdfs AS query ON query.pdf_id = matches.query_pdf_id
+                WHERE matches.run_id = ? AND matches.similarity > ? GROUP BY matches.query_pdf_id
+            """, (run_id, threshold * 100))}
+            for query_name in sorted(query_blocks) or [None]:
+                match_rows, matched_blocks = query_matches.get(query_name, (0, 0))
+                distinct_blocks = query_blocks.get(query_name, 0)
+                sweep_rows.append({"Threshold": threshold, "Query PDF": query_name or "", "Match Rows": match_rows,
+                                   "Matched Blocks": matched_blocks,
+                                   "Reusable Percentage": round(matched_blocks / distinct_blocks * 100, 2) if distinct_blocks else 0})
+    finally:
+        connection.close()
+
+    for threshold in sorted({row["Threshold"] for row in sweep_rows}):
+        render_stored_run(db_path, run_id, os.path.join(output_folder, f"threshold_{threshold}"), threshold)
+    if sweep_rows:
+        sweep_filename = os.path.join(output_folder, "threshold_sweep.csv")
+        with open(sweep_filename, "w", newline="", encoding="utf-8") as sweep_file:
+            writer = csv.DictWriter(sweep_file, fieldnames=list(sweep_rows[0]))
+            writer.writeheader()
+            writer.writerows(sweep_rows)
+        for row in sweep_rows:
+            print(f"Threshold {row['Threshold']}: {row['Match Rows']} match rows, {row['Matched Blocks']} matched blocks "
+                  f"({row['Reusable Percentage']}% reusable)" + (f" for {row['Query PDF']}" if row["Query PDF"] else ""))
+        print(f"Threshold sweep saved: {sweep_filename}")
+    return sweep_rows
+
+# Main function to process the PDF analysis and comparison. The wall time, CPU time, peak RSS and
+# item counts of every stage go to run_manifest.json in the report folder; returns that folder.
+def analyze_single_vs_all(single_pdf_folder, all_pdf_folder, base_output_folder, similarity_mode="sparse",
+                          lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE,
+                          cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES, index_dir=None, results_db=None,
+                          extraction_mode=DEFAULT_EXTRACTION_MODE, threshold=SIMILARITY_THRESHOLD):
+    run_metrics = start_run_metrics("single_vs_all", {"similarity_mode": similarity_mode, "threshold": threshold,
+                                                      "lsh_bands": lsh_bands, "lsh_rows": lsh_rows, "shingle_size": shingle_size,
+                                                      "cache": bool(cache_dir), "index": bool(index_dir),
+                                                      "extraction_mode": extraction_mode})
     single_pdf_files = [f for f in os.listdir(single_pdf_folder) if f.lower().endswith('.pdf')]
     if not single_pdf_files:
         print("No valid PDF files found in the singlepdf folder.")
         return
 
     single_pdf = os.path.join(single_pdf_folder, single_pdf_files[0])
-    if not validate_pdf(single_pdf):
+    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
+
+    single_pdf_report = None
+    single_hashes = {}
+    if cache_dir:
+        single_reports, single_hashes = load_cached_reports([single_pdf], cache_dir, extraction_mode)
+        single_pdf_report = single_reports.get(os.path.basename(single_pdf))
+
+    if single_pdf_report is None and not validate_pdf(single_pdf):
         print(f"Single PDF {single_pdf} is not valid. Skipping analysis.")
         return
 
-    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
-    all_pdf_files = [pdf for pdf in all_pdf_files if validate_pdf(pdf)]
+    # With a corpus index only new or changed library PDFs are extracted and vectorized
+    extraction_times = {}
+    if index_dir:
+        with measure_stage(run_metrics, "index_update") as stage:
+            update_corpus_index(all_pdf_folder, index_dir, base_output_folder, cache_dir, cache_max_bytes, extraction_mode)
+            corpus_index = load_corpus_index(index_dir)
+            corpus_is_empty = not corpus_index["manifest"]["pdfs"]
+            stage.update(pdfs=len(corpus_index["manifest"]["pdfs"]), blocks=corpus_index["manifest"]["block_count"])
+    else:
+        with measure_stage(run_metrics, "corpus_extraction") as stage:
+            pdf_reports, content_hashes = extract_pdf_reports(all_pdf_files, base_output_folder, cache_dir, cache_max_bytes,
+                                                              extraction_times=extraction_times, extraction_mode=extraction_mode)
+            corpus_is_empty = not pdf_reports
+            stage.update(pdfs=len(all_pdf_files), extracted_pdfs=len(extraction_times),
+                         cached_pdfs=len(pdf_reports) - len(extraction_times),
+                         pages=sum(report["page_count"] for report in pdf_reports.values()),
+                         blocks=sum(len(report["text_blocks"]) for report in pdf_reports.values()))
 
-    if not all_pdf_files:
+    if corpus_is_empty:
         print("No valid PDF files found in the allpdf folder.")
         return
 
-    print(f"Analyzing single PDF: {single_pdf}")
-    single_pdf_report = analyze_pdf(single_pdf)
-    if single_pdf_report is None:
-        print("Failed to process the single PDF.")
+    with measure_stage(run_metrics, "query_extraction") as stage:
+        stage["cached_pdfs"] = int(single_pdf_report is not None)
+        if single_pdf_report is None:
+            print(f"Analyzing single PDF: {single_pdf}")
+            start = time.perf_counter()
+            single_pdf_report = analyze_pdf(single_pdf, extraction_mode)
+            if single_pdf_report is None:
+                print("Failed to process the single PDF.")
+                return
+            extraction_times[os.path.basename(single_pdf)] = {"pages": single_pdf_report["page_count"], "tasks": 1,
+                                                              "seconds": round(time.perf_counter() - start, 4)}
+            if cache_dir:
+                store_cached_extraction(cache_dir, single_hashes[single_pdf], extraction_settings(extraction_mode), single_pdf_report,
+                                        cache_max_bytes)
+        stage.update(pdfs=1, pages=single_pdf_report["page_count"], blocks=len(single_pdf_report["text_blocks"]))
+
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_report_{current_time}")
+    os.makedirs(output_folder, exist_ok=True)
+
+    if index_dir:
+        if similarity_mode == "lsh":
+            print("The corpus index is queried with a sparse product; --similarity-mode lsh is ignored.")
+        common_elements = compare_with_corpus_index(corpus_index, single_pdf_report, threshold, run_metrics=run_metrics)
+    else:
+        common_elements = compare_pdf_structures(pdf_reports, single_pdf_report, threshold, similarity_mode=similarity_mode,
+                                                 lsh_bands=lsh_bands, lsh_rows=lsh_rows, shingle_size=shingle_size,
+                                                 run_metrics=run_metrics)
+    stats = common_elements["comparison_stats"]
+    print(f"Compared {stats['compared_pairs']} of {stats['total_pairs']} block pairs ({stats['similarity_mode']} mode, "
+          f"{stats['avoided_pairs']} comparisons avoided, {stats['avoided_percentage']}%, "
+          f"{stats['exact_duplicate_blocks']} exact duplicate blocks)")
+
+    report_rows = sum(len(matches) for matches in common_elements["text_blocks"].values())
+    with measure_stage(run_metrics, "html_report") as stage:
+        generate_comparison_html_report(common_elements, output_folder)
+        stage["rows"] = report_rows
+    with measure_stage(run_metrics, "excel_report") as stage:
+        generate_comparison_excel_report(common_elements, output_folder)
+        stage["rows"] = report_rows
+
+    if results_db:
+        single_pdf_name = os.path.basename(single_pdf)
+        if index_dir:
+            pdf_reports = {pdf["name"]: {} for pdf in corpus_index["manifest"]["pdfs"]}
+            content_hashes = {pdf["name"]: pdf["content_hash"] for pdf in corpus_index["manifest"]["pdfs"]}
+        else:
+            content_hashes = {os.path.basename(path): content_hash for path, content_hash in content_hashes.items()}
+        if single_pdf in single_hashes:
+            content_hashes[single_pdf_name] = single_hashes[single_pdf]
+        with measure_stage(run_metrics, "results_store") as stage:
+            store_run_results(results_db, "single_vs_all", output_folder, stats["similarity_mode"], threshold, stats,
+                              pdf_reports, {single_pdf_name: common_elements}, {single_pdf_name: single_pdf_report}, content_hashes)
+            stage["rows"] = report_rows
+
+    write_run_manifest(run_metrics, output_folder, extraction_times, results=stats)
+    return output_folder
+
+# Helper function to summarize the matches of one query PDF for the batch summary
+def summarize_query_matches(query_name, query_report, common_elements):
+    matched_blocks = [block for block in dict.fromkeys(query_report["text_blocks"]) if common_elements["text_blocks"].get(block)]
+    exact_blocks = [block for block in matched_blocks if any(similarity == 100 for _, similarity in common_elements["text_blocks"][block])]
+    pdf_match_counts = Counter(pdf_name for block in matched_blocks for pdf_name, _ in common_elements["text_blocks"][block])
+    distinct_blocks = len(set(query_report["text_blocks"]))
+    return {
+        "Query PDF": query_name,
+        "Text Blocks": distinct_blocks,
+        "Matched Blocks": len(matched_blocks),
+        "Exact Matched Blocks": len(exact_blocks),
+        "Reusable Percentage": round(len(matched_blocks) / distinct_blocks * 100, 2) if distinct_blocks else 0,
+        "Match Rows": sum(len(common_elements["text_blocks"][block]) for block in matched_blocks),
+        "Most Similar Library PDF": pdf_match_counts.most_common(1)[0][0] if pdf_match_counts else "",
+    }
+
+# Main function to check every PDF in the singlepdf folder against the library in one batch. The
+# library is extracted (or its index loaded) once, all query blocks go through one shared
+# vectorization and sparse product, and each query PDF gets its own report folder next to a
+# combined batch_summary.csv and the run_manifest.json metrics. Returns the batch report folder.
+def analyze_batch_vs_all(single_pdf_folder, all_pdf_folder, base_output_folder, similarity_mode="sparse",
+                         lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE,
+                         cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES, index_dir=None, results_db=None,
+                         extraction_mode=DEFAULT_EXTRACTION_MODE, threshold=SIMILARITY_THRESHOLD):
+    run_metrics = start_run_metrics("batch_vs_all", {"similarity_mode": similarity_mode, "threshold": threshold,
+                                                     "lsh_bands": lsh_bands, "lsh_rows": lsh_rows, "shingle_size": shingle_size,
+                                                     "cache": bool(cache_dir), "index": bool(index_dir),
+                                                     "extraction_mode": extraction_mode})
+    query_pdf_files = [os.path.join(single_pdf_folder, f) for f in sorted(os.listdir(single_pdf_folder)) if f.lower().endswith('.pdf')]
+    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
+
+    print(f"Analyzing {len(query_pdf_files)} query PDFs...")
+    extraction_times = {}
+    with measure_stage(run_metrics, "query_extraction") as stage:
+        query_reports, query_hashes = extract_pdf_reports(query_pdf_files, base_output_folder, cache_dir, cache_max_bytes,
+                                                          extraction_times=extraction_times, extraction_mode=extraction_mode)
+        stage.update(pdfs=len(query_pdf_files), extracted_pdfs=len(extraction_times),
+                     cached_pdfs=len(query_reports) - len(extraction_times),
+                     pages=sum(report["page_count"] for report in query_reports.values()),
+                     blocks=sum(len(report["text_blocks"]) for report in query_reports.values()))
+    if not query_reports:
+        print("No valid PDF files found in the singlepdf folder.")
+        return
+    query_reports = dict(sorted(query_reports.items()))
+
+    if index_dir:
+        with measure_stage(run_metrics, "index_update") as stage:
+            update_corpus_index(all_pdf_folder, index_dir, base_output_folder, cache_dir, cache_max_bytes, extraction_mode)
+            corpus_index = load_corpus_index(index_dir)
+            corpus_is_empty = not corpus_index["manifest"]["pdfs"]
+            stage.update(pdfs=len(corpus_index["manifest"]["pdfs"]), blocks=corpus_index["manifest"]["block_count"])
+    else:
+        corpus_times = {}
+        with measure_stage(run_metrics, "corpus_extraction") as stage:
+            pdf_reports, content_hashes = extract_pdf_reports(all_pdf_files, base_output_folder, cache_dir, cache_max_bytes,
+                                                              extraction_times=corpus_times, extraction_mode=extraction_mode)
+            corpus_is_empty = not pdf_reports
+            stage.update(pdfs=len(all_pdf_files), extracted_pdfs=len(corpus_times),
+                         cached_pdfs=len(pdf_reports) - len(corpus_times),
+                         pages=sum(report["page_count"] for report in pdf_reports.values()),
+                         blocks=sum(len(report["text_blocks"]) for report in pdf_reports.values()))
+        extraction_times.update(corpus_times)
+
+    if corpus_is_empty:
+        print("No valid PDF files found in the allpdf folder.")
         return
 
-    pdf_reports = {}
-    processed_count = 0
-    total_pdfs = len(all_pdf_files)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = {executor.submit(analyze_pdf, pdf): pdf for pdf in all_pdf_files}
-        for future in concurrent.futures.as_completed(futures):
-            pdf = futures[future]
-            try:
-                report = future.result()
-                if report:
-                    pdf_reports[os.path.basename(pdf)] = report
-                processed_count += 1
-                print(f"Processed {processed_count}/{total_pdfs} PDFs...")
-            except Exception as exc:
-                print(f"PDF {pdf} generated an exception: {exc}")
-                with open(os.path.join(base_output_folder, "processing_log.txt"), 'a') as log_file:
-                    log_file.write(f"{pdf} failed with error: {exc}\n")
-                with open("error_log.txt", 'a') as log_file:
-                    log_file.write(f"PDF {pdf} generated an exception: {exc}\n")
+    if index_dir:
+        if similarity_mode == "lsh":
+            print("The corpus index is queried with a sparse product; --similarity-mode lsh is ignored.")
+        batch_elements = compare_query_batch_with_corpus_index(corpus_index, query_reports, threshold, run_metrics=run_metrics)
+    else:
+        batch_elements = compare_query_batch(pdf_reports, query_reports, threshold, similarity_mode=similarity_mode,
+                                             lsh_bands=lsh_bands, lsh_rows=lsh_rows, shingle_size=shingle_size,
+                                             run_metrics=run_metrics)
+    stats = next(iter(batch_elements.values()))["comparison_stats"]
+    print(f"Compared {stats['compared_pairs']} of {stats['total_pairs']} block pairs ({stats['similarity_mode']} mode, "
+          f"{stats['avoided_pairs']} comparisons avoided, {stats['avoided_percentage']}%, "
+          f"{stats['exact_duplicate_blocks']} exact duplicate blocks)")
 
     current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_report_{current_time}")
+    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_batch_report_{current_time}")
     os.makedirs(output_folder, exist_ok=True)
 
-    common_elements = compare_pdf_structures(pdf_reports, single_pdf_report)
-    generate_comparison_html_report(common_elements, output_folder)
-    generate_comparison_excel_report(common_elements, output_folder)
+    summaries = []
+    report_rows = sum(len(matches) for common_elements in batch_elements.values() for matches in common_elements["text_blocks"].values())
+    with measure_stage(run_metrics, "reports") as stage:
+        for query_name, common_elements in batch_elements.items():
+            query_output_folder = os.path.join(output_folder, os.path.splitext(query_name)[0])
+            os.makedirs(query_output_folder, exist_ok=True)
+            generate_comparison_html_report(common_elements, query_output_folder)
+            generate_comparison_excel_report(common_elements, query_output_folder)
+            summaries.append(summarize_query_matches(query_name, query_reports[query_name], common_elements))
+        stage.update(query_pdfs=len(batch_elements), rows=report_rows)
+
+    summary_filename = os.path.join(output_folder, "batch_summary.csv")
+    with open(summary_filename, "w", newline="", encoding="utf-8") as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=list(summaries[0]))
+        writer.writeheader()
+        writer.writerows(summaries)
+    print(f"Batch summary saved: {summary_filename}")
+
+    if results_db:
+        if index_dir:
+            pdf_reports = {pdf["name"]: {} for pdf in corpus_index["manifest"]["pdfs"]}
+            content_hashes = {pdf["name"]: pdf["content_hash"] for pdf in corpus_index["manifest"]["pdfs"]}
+        else:
+            content_hashes = {os.path.basename(path): content_hash for path, content_hash in content_hashes.items()}
+        content_hashes.update((os.path.basename(path), content_hash) for path, content_hash in query_hashes.items())
+        with measure_stage(run_metrics, "results_store") as stage:
+            store_run_results(results_db, "batch_vs_all", output_folder, stats["similarity_mode"], threshold, stats,
+                              pdf_reports, batch_elements, query_reports, content_hashes)
+            stage["rows"] = report_rows
+
+    write_run_manifest(run_metrics, output_folder, extraction_times, results=stats, query_summaries=summaries)
+    return output_folder
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the PDF in the singlepdf folder against all PDFs in the allpdf folder.")
+    parser.add_argument("--similarity-mode", choices=["sparse", "lsh"], default="sparse",
+                        help="sparse compares every block pair; lsh only scores MinHash/LSH candidate pairs")
+    parser.add_argument("--lsh-bands", type=int, default=LSH_BANDS, help="LSH bands (more bands: higher recall)")
+    parser.add_argument("--lsh-rows", type=int, default=LSH_ROWS, help="rows per LSH band (more rows: higher precision)")
+    parser.add_argument("--shingle-size", type=int, default=LSH_SHINGLE_SIZE, help="words per MinHash shingle")
+    parser.add_argument("--cache-dir", help="extraction cache folder (default: extraction_cache next to this script)")
+    parser.add_argument("--cache-max-mb", type=int, default=EXTRACTION_CACHE_MAX_BYTES // 1024 ** 2,
+                        help="evict least recently used cache entries beyond this size")
+    parser.add_argument("--no-cache", action="store_true", help="always extract PDFs with PyMuPDF")
+    parser.add_argument("--extraction-mode", choices=EXTRACTION_MODES, default=DEFAULT_EXTRACTION_MODE,
+                        help="PyMuPDF text extraction: block-level text (faster), the span dictionary (default), or blocks with bounding boxes")
+    parser.add_argument("--invalidate-cache", nargs="*", metavar="PDF",
+                        help="remove cached extractions of the given PDFs (all entries if none given) and exit")
+    parser.add_argument("--batch", action="store_true",
+                        help="check every PDF in the singlepdf folder in one batch instead of only the first one")
+    parser.add_argument("--use-index", action="store_true",
+                        help="query a persistent index of the allpdf folder, updating it for new or changed PDFs first")
+    parser.add_argument("--update-index", action="store_true", help="build or update the corpus index and exit")
+    parser.add_argument("--index-dir", help="corpus index folder (default: corpus_index next to this script)")
+    parser.add_argument("--results-db", help="SQLite results store (default: result/results.sqlite next to this script)")
+    parser.add_argument("--no-results-db", action="store_true", help="do not save the run to the results store")
+    parser.add_argument("--list-runs", action="store_true", help="list the runs in the results store and exit")
+    parser.add_argument("--query-block", metavar="TEXT", help="show which PDFs contain or match a block in a stored run and exit")
+    parser.add_argument("--run", type=int, help="stored run for --query-block (default: the latest run)")
+    parser.add_argument("--compare-runs", nargs=2, type=int, metavar=("OLD", "NEW"), help="compare the matches of two stored runs and exit")
+    parser.add_argument("--render-run", type=int, metavar="RUN", help="render the HTML and Excel reports of a stored run and exit")
+    parser.add_argument("--threshold", type=float, default=SIMILARITY_THRESHOLD,
+                        help="cosine similarity above which a block is reported as a match; a low threshold keeps more "
+                             "matches in the results store for --report-run")
+    parser.add_argument("--report-run", type=int, metavar="RUN",
+                        help="report a stored run again at the higher similarity thresholds of --thresholds and exit")
+    parser.add_argument("--thresholds", type=float, nargs="+", metavar="T", help="similarity thresholds for --report-run")
+    parser.add_argument("--profile", action="store_true",
+                        help="also write a cProfile dump of the main process (profile.prof) to the report folder")
+    args = parser.parse_args()
+
     base_dir = os.path.dirname(os.path.abspath(__file__))
     single_pdf_folder = os.path.join(base_dir, 'singlepdf')
     all_pdf_folder = os.path.join(base_dir, 'allpdf')
     base_output_folder = os.path.join(base_dir, 'result')
+    cache_dir = args.cache_dir or os.path.join(base_dir, 'extraction_cache')
+
+    if args.invalidate_cache is not None:
+        removed = invalidate_extraction_cache(cache_dir, args.invalidate_cache)
+        print(f"Removed {removed} cached extractions from {cache_dir}")
+        raise SystemExit(0)
 
     os.makedirs(base_output_folder, exist_ok=True)
 
+    results_db = args.results_db or os.path.join(base_output_folder, RESULTS_DB_NAME)
+    if args.list_runs:
+        for run_id, created_at, kind, mode, run_output_folder, pdf_count, match_count in list_stored_runs(results_db):
+            print(f"Run {run_id}: {created_at} {kind} ({mode} mode), {pdf_count} PDFs, {match_count} match rows -> {run_output_folder}")
+        raise SystemExit(0)
+    if args.query_block:
+        run_id, results = query_stored_block(results_db, args.query_block, args.run)
+        print(f"Run {run_id}: {len(results)} matching blocks")
+        for result in results:
+            print(f"\n{result['text']}")
+            for pdf_name, page_number, bbox in result["occurrences"]:
+                print(f"  contained in {pdf_name}, page {page_number}" + (f", bbox {bbox}" if bbox else ""))
+            for query_name, pdf_name, similarity in result["matches"]:
+                print(f"  matched {pdf_name} ({similarity}%)" + (f" for {query_name}" if query_name else ""))
+        raise SystemExit(0)
+    if args.compare_runs:
+        print(json.dumps(compare_stored_runs(results_db, *args.compare_runs), indent=2))
+        raise SystemExit(0)
+    if args.render_run:
+        current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        render_stored_run(results_db, args.render_run, os.path.join(base_output_folder, f"pdf_rationalization_report_run{args.render_run}_{current_time}"))
+        raise SystemExit(0)
+    if args.report_run:
+        if not args.thresholds:
+            parser.error("--report-run needs --thresholds")
+        current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        rethreshold_stored_run(results_db, args.report_run, args.thresholds,
+                               os.path.join(base_output_folder, f"pdf_rationalization_sweep_run{args.report_run}_{current_time}"))
+        raise SystemExit(0)
+    index_dir = args.index_dir or os.path.join(base_dir, 'corpus_index')
+
+    if args.update_index:
+        update_corpus_index(all_pdf_folder, index_dir, base_output_folder, None if args.no_cache else cache_dir, args.cache_max_mb * 1024 ** 2,
+                            args.extraction_mode)
+        raise SystemExit(0)
+
     print("Starting analysis...")
-    analyze_single_vs_all(single_pdf_folder, all_pdf_folder, base_output_folder)
+    analyze = analyze_batch_vs_all if args.batch else analyze_single_vs_all
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    output_folder = analyze(single_pdf_folder, all_pdf_folder, base_output_folder, args.similarity_mode,
+                            args.lsh_bands, args.lsh_rows, args.shingle_size,
+                            None if args.no_cache else cache_dir, args.cache_max_mb * 1024 ** 2,
+                            index_dir if args.use_index else None, None if args.no_results_db else results_db,
+                            args.extraction_mode, args.threshold)
+    if profiler:
+        profiler.disable()
+        profile_path = os.path.join(output_folder or base_output_folder, "profile.prof")
+        profiler.dump_stats(profile_path)
+        print(f"cProfile dump saved: {profile_path} (inspect with python -m pstats)")
     print("Analysis complete.")
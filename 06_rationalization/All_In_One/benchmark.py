@@ -0,0 +1,217 @@
+import os
+import argparse
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import fitz
+from datetime import datetime
+import numpy as np
+import scipy
+import sklearn
+import openpyxl
+from script import (
+    LSH_BANDS, LSH_ROWS, LSH_SHINGLE_SIZE, SIMILARITY_THRESHOLD, EXTRACTION_MODES, DEFAULT_EXTRACTION_MODE,
+    validate_pdf, extract_pdf_reports, block_store_groups, weighted_tfidf_matrix,
+    find_similar_pairs, minhash_signatures, lsh_candidate_pairs, score_candidate_pairs,
+    compare_all_pdfs, generate_comparison_html_report, generate_comparison_excel_report,
+)
+
+# Words the synthetic paragraphs are drawn from
+VOCABULARY_SIZE = 5000
+# Number of distinct boilerplate paragraphs shared between documents
+BOILERPLATE_POOL_SIZE = 200
+# Share of boilerplate blocks that get one word changed, so the similarity stage also sees near duplicates
+BOILERPLATE_EDIT_SHARE = 0.3
+# Words per synthetic paragraph; always above MIN_BLOCK_WORDS so every block is compared
+BLOCK_WORDS = (20, 40)
+# Vertical space per text block on a generated page, in points
+BLOCK_HEIGHT = 70
+
+# Helper function to build a random paragraph from the synthetic vocabulary
+def random_paragraph(rng, vocabulary):
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(*BLOCK_WORDS)))
+
+# Function to generate a synthetic PDF corpus. Each page holds blocks_per_page separate text blocks;
+# a boilerplate_share of them comes from a shared pool of paragraphs (some with one word changed)
+# and the rest is unique text. Returns the generated file paths.
+def generate_corpus(corpus_dir, documents, pages, blocks_per_page, boilerplate_share, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"w{index}{rng.choice('aeiou')}" for index in range(VOCABULARY_SIZE)]
+    boilerplate = [random_paragraph(rng, vocabulary) for _ in range(BOILERPLATE_POOL_SIZE)]
+    page_height = max(842, blocks_per_page * BLOCK_HEIGHT + 72)
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    pdf_files = []
+    for document_number in range(documents):
+        doc = fitz.open()
+        for _ in range(pages):
+            page = doc.new_page(width=595, height=page_height)
+            for block_number in range(blocks_per_page):
+                if rng.random() < boilerplate_share:
+                    words = rng.choice(boilerplate).split()
+                    if rng.random() < BOILERPLATE_EDIT_SHARE:
+                        words[rng.randrange(len(words))] = rng.choice(vocabulary)
+                    text = " ".join(words)
+                else:
+                    text = random_paragraph(rng, vocabulary)
+                top = 36 + block_number * BLOCK_HEIGHT
+                page.insert_textbox(fitz.Rect(36, top, 559, top + BLOCK_HEIGHT - 10), text, fontsize=8)
+        pdf_files.append(os.path.join(corpus_dir, f"synthetic_{document_number:05d}.pdf"))
+        doc.save(pdf_files[-1])
+        doc.close()
+    return pdf_files
+
+# Helper function to run one benchmark stage, recording wall time and the peak Python heap
+# allocation (tracemalloc also covers NumPy and SciPy buffers, but not the worker processes
+# of the extraction pool)
+def run_stage(stages, name, function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stages[name] = {"seconds": round(seconds, 4), "peak_memory_bytes": peak}
+    print(f"{name}: {seconds:.3f}s, peak memory {peak / 1024 ** 2:.1f} MiB")
+    return result
+
+# Helper function to consume the similarity stage on its own so it can be timed apart from vectorization
+def count_similar_pairs(tfidf_matrix, unique_texts, similarity_mode, lsh_bands, lsh_rows, shingle_size):
+    if similarity_mode == "lsh":
+        signatures = minhash_signatures(unique_texts, lsh_bands * lsh_rows, shingle_size)
+        rows, cols = lsh_candidate_pairs(signatures, lsh_bands, lsh_rows)
+        pair_batches = score_candidate_pairs(tfidf_matrix, tfidf_matrix, rows, cols, SIMILARITY_THRESHOLD)
+    else:
+        pair_batches = find_similar_pairs(tfidf_matrix, tfidf_matrix, SIMILARITY_THRESHOLD, upper_triangle=True)
+    return sum(len(rows) for rows, _, _ in pair_batches)
+
+# Function to benchmark every stage of the all-vs-all pipeline on a corpus and return the results
+def run_benchmark(pdf_files, output_folder, similarity_mode="sparse", lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS,
+                  shingle_size=LSH_SHINGLE_SIZE, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    stages = {}
+    valid_files = run_stage(stages, "validation", lambda: [f for f in pdf_files if validate_pdf(f)])
+    stages["validation"]["items"] = len(valid_files)
+
+    block_store, _ = run_stage(stages, "extraction", extract_pdf_reports, valid_files, output_folder,
+                               extraction_mode=extraction_mode)
+    stages["extraction"]["items"] = sum(block_store["page_counts"])
+    stages["extraction"]["blocks"] = len(block_store["block_texts"])
+    stages["extraction"]["text_buffer_bytes"] = len(block_store["text_buffer"])
+
+    unique_texts, occurrences = block_store_groups(block_store)
+    tfidf_matrix = run_stage(stages, "vectorization", weighted_tfidf_matrix, unique_texts,
+                             np.array([len(indices) for indices in occurrences]))
+    stages["vectorization"]["items"] = len(unique_texts)
+    stages["vectorization"]["features"] = tfidf_matrix.shape[1]
+
+    similar_pairs = run_stage(stages, "similarity", count_similar_pairs, tfidf_matrix, unique_texts,
+                               similarity_mode, lsh_bands, lsh_rows, shingle_size)
+    stages["similarity"]["items"] = similar_pairs
+
+    common_elements = run_stage(stages, "comparison", compare_all_pdfs, block_store, similarity_mode=similarity_mode,
+                                lsh_bands=lsh_bands, lsh_rows=lsh_rows, shingle_size=shingle_size)
+    report_rows = sum(len(matches) for matches in common_elements["text_blocks"].values())
+    stages["comparison"]["items"] = report_rows
+    stages["comparison"]["comparison_stats"] = common_elements["comparison_stats"]
+
+    run_stage(stages, "html", generate_comparison_html_report, common_elements, output_folder)
+    stages["html"]["items"] = report_rows
+    run_stage(stages, "excel", generate_comparison_excel_report, common_elements, output_folder)
+    stages["excel"]["items"] = report_rows
+    return stages
+
+# Helper function to describe the machine and library versions a benchmark ran with
+def benchmark_environment():
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pymupdf": fitz.VersionBind,
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "scikit-learn": sklearn.__version__,
+        "openpyxl": openpyxl.__version__,
+    }
+
+# Function to print how the stage timings and peak memory of a run changed against an earlier result file
+def compare_benchmarks(baseline, result):
+    print(f"Compared with {baseline['created_at']}:")
+    for name, stage in result["stages"].items():
+        old_stage = baseline["stages"].get(name)
+        if not old_stage:
+            continue
+        time_change = (stage["seconds"] / old_stage["seconds"] - 1) * 100 if old_stage["seconds"] else 0
+        memory_change = (stage["peak_memory_bytes"] / old_stage["peak_memory_bytes"] - 1) * 100 if old_stage["peak_memory_bytes"] else 0
+        print(f"  {name}: {old_stage['seconds']}s -> {stage['seconds']}s ({time_change:+.1f}%), "
+              f"peak memory {memory_change:+.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the all-vs-all pipeline on a synthetic PDF corpus.")
+    parser.add_argument("--documents", type=int, default=50, help="number of generated PDFs")
+    parser.add_argument("--pages", type=int, default=5, help="pages per generated PDF")
+    parser.add_argument("--blocks-per-page", type=int, default=8, help="text blocks per page")
+    parser.add_argument("--boilerplate-share", type=float, default=0.3, help="share of blocks taken from shared boilerplate (0-1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus generator")
+    parser.add_argument("--similarity-mode", choices=["sparse", "lsh"], default="sparse")
+    parser.add_argument("--extraction-mode", choices=EXTRACTION_MODES, default=DEFAULT_EXTRACTION_MODE)
+    parser.add_argument("--lsh-bands", type=int, default=LSH_BANDS)
+    parser.add_argument("--lsh-rows", type=int, default=LSH_ROWS)
+    parser.add_argument("--shingle-size", type=int, default=LSH_SHINGLE_SIZE)
+    parser.add_argument("--corpus-dir", help="generate the corpus here and keep it (default: a temporary folder)")
+    parser.add_argument("--output", help="result JSON file (default: benchmark_results/benchmark_<time>.json next to this script)")
+    parser.add_argument("--compare", metavar="RESULT_JSON", help="print the change against an earlier result file")
+    args = parser.parse_args()
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    output_file = args.output or os.path.join(base_dir, "benchmark_results", f"benchmark_{current_time}.json")
+    work_dir = tempfile.mkdtemp(prefix="rationalization_benchmark_")
+    corpus_dir = args.corpus_dir or os.path.join(work_dir, "allpdf")
+    report_folder = os.path.join(work_dir, "result")
+    os.makedirs(report_folder, exist_ok=True)
+
+    try:
+        print(f"Generating {args.documents} PDFs with {args.pages} pages of {args.blocks_per_page} blocks...")
+        start = time.perf_counter()
+        pdf_files = generate_corpus(corpus_dir, args.documents, args.pages, args.blocks_per_page, args.boilerplate_share, args.seed)
+        print(f"Corpus generated in {time.perf_counter() - start:.1f}s: {corpus_dir}")
+
+        stages = run_benchmark(pdf_files, report_folder, args.similarity_mode, args.lsh_bands, args.lsh_rows, args.shingle_size,
+                               args.extraction_mode)
+        result = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "corpus": {
+                "documents": args.documents,
+                "pages": args.pages,
+                "blocks_per_page": args.blocks_per_page,
+                "boilerplate_share": args.boilerplate_share,
+                "seed": args.seed,
+                "total_bytes": sum(os.path.getsize(f) for f in pdf_files),
+            },
+            "settings": {
+                "similarity_mode": args.similarity_mode,
+                "extraction_mode": args.extraction_mode,
+                "lsh_bands": args.lsh_bands,
+                "lsh_rows": args.lsh_rows,
+                "shingle_size": args.shingle_size,
+            },
+            "environment": benchmark_environment(),
+            "stages": stages,
+            "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 4),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Benchmark results saved: {output_file}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_benchmarks(json.load(f), result)
@@ -1,82 +1,1393 @@
 import os
+import argparse
+import cProfile
+import csv
+import hashlib
+import html
+import json
+import multiprocessing
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from array import array
 import fitz  # PyMuPDF for analyzing structure and layout
 from datetime import datetime
-from collections import defaultdict
-import pandas as pd
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
 import concurrent.futures
+from multiprocessing.connection import wait
 import traceback
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
 from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, PatternFill
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then left out of the run metrics
+    resource = None
+
+# Cosine similarity above which two text blocks are reported as a match
+SIMILARITY_THRESHOLD = 0.1
+# Cosine similarity above which two blocks are linked into the same template cluster; higher than
+# SIMILARITY_THRESHOLD because loosely related blocks would chain most of a corpus into one cluster
+CLUSTER_SIMILARITY_THRESHOLD = 0.8
+# Default lowest cosine similarity of the scored pairs a run keeps for re-thresholding (--pairs-floor)
+SCORED_PAIRS_FLOOR = 0.1
+# Number of query rows multiplied against the corpus per sparse batch
+SIMILARITY_BATCH_SIZE = 1024
+# Memory the tiled all-vs-all similarity stage may use: the memory-mapped matrices shared by the
+# workers plus the tile products all workers hold at the same time. The similar pairs passed on to
+# the report (and kept as scored pairs) are held by the main process on top of the budget.
+SIMILARITY_MEMORY_BUDGET = 2 * 1024 ** 3
+# Estimated bytes per stored product while a tile is multiplied, thresholded and sorted (the COO
+# data, row and column arrays plus the masks and sort order taken from them)
+SIMILARITY_BYTES_PER_PRODUCT = 48
+# Minimum number of tiles per similarity worker, so that uneven tiles still keep every worker busy
+SIMILARITY_TILES_PER_WORKER = 4
+# MinHash/LSH settings: BANDS * ROWS permutations per signature. More bands raise recall,
+# more rows per band raise precision; pairs with Jaccard above about (1/BANDS) ** (1/ROWS)
+# are likely to become candidates.
+LSH_BANDS = 32
+LSH_ROWS = 4
+LSH_SHINGLE_SIZE = 2
+MINHASH_PRIME = np.uint64((1 << 61) - 1)
+# Text blocks with fewer words than this are not compared
+MIN_BLOCK_WORDS = 10
+# Version of normalize_text; change it whenever normalization changes so cached extractions are refreshed
+NORMALIZER_VERSION = "lower-strip-v1"
+# Text extraction modes: "blocks" reads PyMuPDF's block-level text, "dict" joins the spans of the
+# full text dictionary (the original extractor) and "layout" is "blocks" that also keeps the
+# bounding box of every block for the results store
+EXTRACTION_MODES = ("blocks", "dict", "layout")
+# Default extraction mode: the span dictionary, so existing runs and caches keep their blocks. The
+# faster "blocks" mode is opt-in, since it can split words whose spans change style differently.
+DEFAULT_EXTRACTION_MODE = "dict"
+# PyMuPDF text flags of every extraction mode: the dictionary defaults without image decoding,
+# since image blocks are dropped anyway
+EXTRACTION_TEXT_FLAGS = fitz.TEXTFLAGS_BLOCKS
+# Pages per extraction task; large PDFs are split into page ranges spread over the process pool
+PAGES_PER_TASK = 50
+# Limits of the extraction workers: summed task seconds per PDF, seconds per page and resident
+# memory per worker. A worker breaking one is killed and replaced and its PDF is quarantined; None
+# disables a limit. The memory limit is read from /proc and is not enforced where that is missing.
+EXTRACTION_WORKER_LIMITS = {"file_seconds": 1800, "page_seconds": 120, "memory_bytes": 4 * 1024 ** 3}
+# Seconds between two checks of the extraction workers against their limits
+WORKER_POLL_SECONDS = 0.2
+# Quarantine list of PDFs that broke a worker limit, kept in the result folder; they are skipped
+# until their content changes or --retry-quarantined is given
+QUARANTINE_FILE_NAME = "quarantine.json"
+# Rows per page of the HTML report
+HTML_ROWS_PER_PAGE = 5000
+# Excel holds at most 1,048,576 rows per sheet, including the header row
+EXCEL_MAX_ROWS_PER_SHEET = 1048576
+# Sheets per workbook before the Excel export continues in a new workbook
+EXCEL_MAX_SHEETS_PER_WORKBOOK = 8
+# Size limit of the on-disk extraction cache before the least recently used entries are evicted
+EXTRACTION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# SQLite results store of all runs, kept in the result folder unless --results-db is given
+RESULTS_DB_NAME = "results.sqlite"
+# Hashed feature columns of the streaming mode; collisions between terms are negligible at this size
+HASHING_FEATURES = 2 ** 20
+# Block rows per on-disk shard of the streaming mode; at most two shards are loaded at a time
+STREAM_SHARD_ROWS = 50000
+# Number of slowest PDFs listed in the extraction metrics of the run manifest
+SLOWEST_PDFS_REPORTED = 10
 
 # Helper function to normalize text for comparison
 def normalize_text(text):
     return text.lower().strip()
 
-# Function to validate PDF files
-def validate_pdf(file_path):
+# Function to validate a PDF file and count its pages; returns None for unusable files
+def pdf_page_count(file_path):
     try:
         with fitz.open(file_path) as doc:
             if doc.is_encrypted:
                 print(f"PDF {file_path} is encrypted. Skipping...")
-                return False
-            return True
+                return None
+            return len(doc)
     except Exception as e:
         print(f"Error opening {file_path}: {e}. Skipping...")
-        return False
+        return None
+
+# Function to validate PDF files
+def validate_pdf(file_path):
+    return pdf_page_count(file_path) is not None
+
+# Helper function to read the raw text and bounding box of every text block of a page
+def page_text_blocks(page, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    if extraction_mode == "dict":
+        blocks = page.get_text("dict", flags=EXTRACTION_TEXT_FLAGS)["blocks"]
+        return [("\n".join([span["text"] for line in block["lines"] for span in line["spans"]]), block["bbox"])
+                for block in blocks if "lines" in block]
+    # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 1 marks image blocks
+    blocks = page.get_text("blocks", flags=EXTRACTION_TEXT_FLAGS)
+    return [(block[4], block[:4]) for block in blocks if block[6] == 0]
+
+# Helper function to extract the normalized text blocks of a range of pages of an open PDF. The
+# "layout" mode also returns the bounding box of every block in block_boxes; on_page is called
+# with the number of every page before it is read.
+def extract_page_blocks(doc, start_page, end_page, extraction_mode=DEFAULT_EXTRACTION_MODE, on_page=None):
+    text_blocks = []
+    block_pages = []
+    block_boxes = []
+    for page_number in range(start_page, min(end_page, len(doc))):
+        if on_page is not None:
+            on_page(page_number)
+        page = doc.load_page(page_number)
+        for block_text, bbox in page_text_blocks(page, extraction_mode):
+            block_text = normalize_text(block_text.strip())
+
+            # Filter out small blocks of text less than MIN_BLOCK_WORDS words
+            if len(block_text.split()) >= MIN_BLOCK_WORDS:
+                text_blocks.append(block_text)
+                block_pages.append(page_number)
+                block_boxes.append([round(value, 1) for value in bbox])
+    page_range = {"text_blocks": text_blocks, "block_pages": block_pages}
+    if extraction_mode == "layout":
+        page_range["block_boxes"] = block_boxes
+    return page_range
+
+# Function to analyze a range of pages of a PDF; used as one task of a page-range split. The
+# result also carries the time the task took in seconds.
+def analyze_pdf_pages(file_path, start_page, end_page, extraction_mode=DEFAULT_EXTRACTION_MODE, on_page=None):
+    start = time.perf_counter()
+    with fitz.open(file_path) as doc:
+        page_range = extract_page_blocks(doc, start_page, end_page, extraction_mode, on_page)
+    page_range["seconds"] = time.perf_counter() - start
+    return page_range
 
 # Function to analyze a single PDF structure (text)
-def analyze_pdf(file_path):
+def analyze_pdf(file_path, extraction_mode=DEFAULT_EXTRACTION_MODE):
     try:
         with fitz.open(file_path) as doc:
             if doc.is_encrypted:
                 print(f"PDF {file_path} is encrypted. Skipping...")
                 return None
 
-            text_blocks = []
-            for page_number in range(len(doc)):
-                page = doc.load_page(page_number)
-                blocks = page.get_text("dict")["blocks"]
-                for block in blocks:
-                    if "lines" in block:
-                        block_text = "\n".join([span["text"] for line in block["lines"] for span in line["spans"]]).strip()
-                        block_text = normalize_text(block_text)
-
-                        # Filter out small blocks of text less than 10 words
-                        if len(block_text.split()) >= 10:
-                            text_blocks.append(block_text)
-
-            return {"text_blocks": text_blocks}
+            report = extract_page_blocks(doc, 0, len(doc), extraction_mode)
+            report["page_count"] = len(doc)
+            return report
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         traceback.print_exc()
         return None
 
-# Function to compare PDFs and find common elements with similarity percentages
-def compare_all_pdfs(pdf_reports):
+# Helper function to hash a file's content without reading it into memory at once
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Helper function to describe the extractor settings that change the extracted text blocks
+def extraction_settings(extraction_mode=DEFAULT_EXTRACTION_MODE):
+    report_fields = ["text_blocks", "block_pages", "page_count"] + (["block_boxes"] if extraction_mode == "layout" else [])
+    return {"normalizer": NORMALIZER_VERSION, "min_words": MIN_BLOCK_WORDS, "extraction_mode": extraction_mode,
+            "report_fields": report_fields}
+
+# Helper function to build the cache entry path for a PDF content hash and extractor settings
+def extraction_cache_path(cache_dir, content_hash, settings):
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{content_hash}_{settings_hash}.json")
+
+# Function to load a cached extraction; returns None on a cache miss
+def load_cached_extraction(cache_dir, content_hash, settings):
+    cache_path = extraction_cache_path(cache_dir, content_hash, settings)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            report = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+    # Touch the entry so eviction removes the least recently used entries first
+    os.utime(cache_path)
+    return report
+
+# Function to save an extraction to the cache and evict old entries beyond the size limit
+def store_cached_extraction(cache_dir, content_hash, settings, report, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = extraction_cache_path(cache_dir, content_hash, settings)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as cache_file:
+        json.dump(report, cache_file)
+    os.replace(temp_path, cache_path)
+    evict_extraction_cache(cache_dir, max_bytes)
+
+# Function to delete the least recently used cache entries until the cache fits in max_bytes
+def evict_extraction_cache(cache_dir, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+
+# Function to load the cached extractions of a list of PDFs. Returns the cached reports keyed
+# by PDF name and the content hash of every PDF so new extractions can be stored afterwards.
+def load_cached_reports(pdf_files, cache_dir, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    pdf_reports = {}
+    content_hashes = {}
+    settings = extraction_settings(extraction_mode)
+    for pdf in pdf_files:
+        content_hashes[pdf] = file_content_hash(pdf)
+        report = load_cached_extraction(cache_dir, content_hashes[pdf], settings)
+        if report is not None:
+            pdf_reports[os.path.basename(pdf)] = report
+    return pdf_reports, content_hashes
+
+# Function to remove cached extractions for the given PDFs, or the whole cache when none are given
+def invalidate_extraction_cache(cache_dir, pdf_files=None):
+    if not os.path.isdir(cache_dir):
+        return 0
+    prefixes = None if not pdf_files else tuple(f"{file_content_hash(pdf)}_" for pdf in pdf_files)
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json") and (prefixes is None or entry.name.startswith(prefixes)):
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+# Helper function to read the peak resident set size in bytes of this process and of its largest
+# finished child process (the extraction workers); None where the resource module is unavailable
+def peak_rss_bytes():
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+# Helper function to read the CPU time of this process and of its finished child processes
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# Function to start collecting the metrics of a run
+def start_run_metrics(kind, settings):
+    return {"kind": kind, "started_at": datetime.now().isoformat(), "settings": settings, "stages": {}}
+
+# Context manager to record the wall time, CPU time and peak RSS of a stage in the run metrics. The
+# yielded dict takes the item counts of the stage; without run metrics nothing is recorded.
+@contextmanager
+def measure_stage(run_metrics, name):
+    stage = {}
+    wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+    try:
+        yield stage
+    finally:
+        if run_metrics is not None:
+            peak_rss, peak_worker_rss = peak_rss_bytes()
+            run_metrics["stages"][name] = dict(stage, wall_seconds=round(time.perf_counter() - wall_start, 4),
+                                               cpu_seconds=round(cpu_seconds() - cpu_start, 4),
+                                               peak_rss_bytes=peak_rss, peak_worker_rss_bytes=peak_worker_rss)
+
+# Function to summarize per-PDF extraction latency: totals, percentiles and the slowest PDFs
+def extraction_latency_summary(extraction_times):
+    if not extraction_times:
+        return {"pdfs": 0}
+    seconds = np.array([times["seconds"] for times in extraction_times.values()])
+    slowest = sorted(extraction_times.items(), key=lambda item: item[1]["seconds"], reverse=True)[:SLOWEST_PDFS_REPORTED]
+    return {
+        "pdfs": len(seconds),
+        "total_seconds": round(float(seconds.sum()), 4),
+        "mean_seconds": round(float(seconds.mean()), 4),
+        "median_seconds": round(float(np.median(seconds)), 4),
+        "p95_seconds": round(float(np.percentile(seconds, 95)), 4),
+        "max_seconds": round(float(seconds.max()), 4),
+        "slowest": [dict(pdf=pdf_name, **times, seconds_per_page=round(times["seconds"] / max(times["pages"], 1), 4))
+                    for pdf_name, times in slowest],
+    }
+
+# Function to write the run metrics to run_manifest.json in the report folder
+def write_run_manifest(run_metrics, output_folder, extraction_times=None, **results):
+    finished_at = datetime.now()
+    run_metrics.update(results)
+    run_metrics["finished_at"] = finished_at.isoformat()
+    run_metrics["wall_seconds"] = round((finished_at - datetime.fromisoformat(run_metrics["started_at"])).total_seconds(), 4)
+    run_metrics["pdf_extraction"] = extraction_latency_summary(extraction_times)
+    manifest_path = os.path.join(output_folder, "run_manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(run_metrics, manifest_file, indent=2)
+    print(f"Run manifest saved: {manifest_path}")
+
+# Helper function to read the resident memory of a process in bytes; None where /proc is unavailable
+def process_rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Function run by the supervised worker processes: run the (function, args) tasks received on the
+# connection one at a time and send back ("done", result) or ("error", message). Every page start
+# is written to the worker's slot of the shared page arrays so the supervisor can time single pages.
+def supervised_worker(slot, connection, page_starts, current_pages):
+    def on_page(page_number):
+        current_pages[slot] = page_number
+        page_starts[slot] = time.time()
+
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        function, args = task
+        try:
+            connection.send(("done", function(*args, on_page=on_page)))
+        except Exception as exc:
+            connection.send(("error", f"{type(exc).__name__}: {exc}"))
+
+# Function to run page-range tasks on worker processes watched by this process, in place of a process
+# pool that cannot stop a single hung task. tasks are (key, group, function, args) tuples in scheduling
+# order, a group being the PDF a task belongs to; function is called with args and an on_page callback.
+# A worker is killed and replaced when its current page runs longer than page_seconds, when its group
+# has used more than file_seconds of task time, or when its resident memory exceeds memory_bytes. Any
+# failure drops the remaining tasks of the group. Yields (key, group, result, error, quarantined) as
+# tasks finish; error is None on success and otherwise the reason, and quarantined is set when the
+# worker broke a limit or died, so that its file should not be tried again.
+def run_supervised_tasks(tasks, worker_limits=EXTRACTION_WORKER_LIMITS, workers=None):
+    file_seconds, page_seconds, memory_bytes = (worker_limits.get(name) for name in ("file_seconds", "page_seconds", "memory_bytes"))
+    if not tasks:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    page_starts = multiprocessing.RawArray("d", workers)
+    current_pages = multiprocessing.RawArray("i", workers)
+    pending = deque(tasks)
+    failed_groups = {}
+    group_seconds = defaultdict(float)
+    slots = [None] * workers
+
+    def start_worker(slot):
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=supervised_worker, args=(slot, worker_connection, page_starts, current_pages),
+                                          daemon=True)
+        process.start()
+        worker_connection.close()
+        slots[slot] = {"process": process, "connection": connection, "task": None, "started": None}
+
+    def stop_worker(slot):
+        worker = slots[slot]
+        worker["process"].kill()
+        worker["process"].join()
+        worker["connection"].close()
+
+    def limit_reason(slot, now):
+        worker = slots[slot]
+        group = worker["task"][1]
+        if page_seconds is not None and now - page_starts[slot] > page_seconds:
+            where = f"page {current_pages[slot] + 1}" if current_pages[slot] >= 0 else "opening the file"
+            return f"{where} took longer than {page_seconds}s"
+        if file_seconds is not None and group_seconds[group] + now - worker["started"] > file_seconds:
+            return f"extraction took longer than {file_seconds}s"
+        rss = process_rss_bytes(worker["process"].pid) if memory_bytes is not None else None
+        if rss is not None and rss > memory_bytes:
+            return f"worker used {rss // 1024 ** 2} MB, more than the {memory_bytes // 1024 ** 2} MB limit"
+        return None
+
+    try:
+        for slot in range(workers):
+            start_worker(slot)
+        while pending or any(worker["task"] for worker in slots):
+            for slot, worker in enumerate(slots):
+                while worker["task"] is None and pending:
+                    task = pending.popleft()
+                    key, group, function, args = task
+                    if group in failed_groups:
+                        yield key, group, None, f"skipped after an earlier failure: {failed_groups[group]}", False
+                        continue
+                    current_pages[slot] = -1
+                    page_starts[slot] = time.time()
+                    worker["connection"].send((function, args))
+                    worker["task"], worker["started"] = task, time.time()
+
+            running = [slot for slot, worker in enumerate(slots) if worker["task"]]
+            wait([slots[slot]["connection"] for slot in running] + [slots[slot]["process"].sentinel for slot in running],
+                 timeout=WORKER_POLL_SECONDS)
+            now = time.time()
+            for slot in running:
+                worker = slots[slot]
+                key, group, function, args = worker["task"]
+                result, error, quarantined = None, None, False
+                try:
+                    message = worker["connection"].recv() if worker["connection"].poll() else None
+                except (EOFError, OSError):
+                    worker["process"].join()
+                    message = ("error", f"worker exited with code {worker['process'].exitcode}")
+                    quarantined = True
+                if message is None:
+                    if not worker["process"].is_alive():
+                        message = ("error", f"worker exited with code {worker['process'].exitcode}")
+                        quarantined = True
+                    else:
+                        error = limit_reason(slot, now)
+                        if error is None:
+                            continue
+                        quarantined = True
+                if message is not None:
+                    status, payload = message
+                    result, error = (payload, None) if status == "done" else (None, payload)
+
+                group_seconds[group] += now - worker["started"]
+                worker["task"] = None
+                if error is not None:
+                    failed_groups.setdefault(group, error)
+                    if quarantined:
+                        stop_worker(slot)
+                        start_worker(slot)
+                yield key, group, result, error, quarantined
+    finally:
+        for slot, worker in enumerate(slots):
+            if worker is not None:
+                stop_worker(slot)
+
+# Function to load the quarantine list of PDFs that broke an extraction worker limit
+def load_quarantine(base_output_folder):
+    try:
+        with open(os.path.join(base_output_folder, QUARANTINE_FILE_NAME), "r", encoding="utf-8") as quarantine_file:
+            return json.load(quarantine_file)
+    except FileNotFoundError:
+        return {}
+
+# Function to quarantine a PDF that broke an extraction worker limit or crashed its worker: the reason goes to the processing
+# log and the PDF's content hash to the quarantine list, so later runs skip it until the file changes
+def quarantine_pdf(base_output_folder, pdf, reason, content_hash=None):
+    print(f"PDF {pdf} quarantined: {reason}")
+    with open(os.path.join(base_output_folder, "processing_log.txt"), 'a') as log_file:
+        log_file.write(f"{pdf} quarantined: {reason}\n")
+    quarantine = load_quarantine(base_output_folder)
+    quarantine[os.path.basename(pdf)] = {"content_hash": content_hash or file_content_hash(pdf), "reason": reason,
+                                         "quarantined_at": datetime.now().isoformat()}
+    with open(os.path.join(base_output_folder, QUARANTINE_FILE_NAME), "w", encoding="utf-8") as quarantine_file:
+        json.dump(quarantine, quarantine_file, indent=2)
+
+# Helper function to record the first failed task of a PDF in the processing log, quarantining the
+# PDF when its worker broke a limit or died
+def log_extraction_failure(base_output_folder, pdf, error, quarantined, content_hash=None):
+    if quarantined:
+        quarantine_pdf(base_output_folder, pdf, error, content_hash)
+        return
+    print(f"PDF {pdf} generated an exception: {error}")
+    with open(os.path.join(base_output_folder, "processing_log.txt"), 'a') as log_file:
+        log_file.write(f"{pdf} failed with error: {error}\n")
+
+# Function to drop quarantined PDFs whose content has not changed from a list of PDF files
+def skip_quarantined_pdfs(pdf_files, base_output_folder):
+    quarantine = load_quarantine(base_output_folder)
+    kept = []
+    for pdf in pdf_files:
+        entry = quarantine.get(os.path.basename(pdf))
+        if entry is not None and entry["content_hash"] == file_content_hash(pdf):
+            print(f"Skipping quarantined PDF {pdf}: {entry['reason']}")
+            continue
+        kept.append(pdf)
+    return kept
+
+# Function to start an empty block store, the compact form of the extracted blocks of a run. Every
+# distinct block text is kept once in one UTF-8 buffer with its end offset, and every block occurrence
+# as the int32 id of its text and its page (plus its bounding box in "layout" mode); PDF names and
+# page counts are kept once per PDF, whose blocks are contiguous and start at pdf_starts.
+def new_block_store(extraction_mode=DEFAULT_EXTRACTION_MODE):
+    return {"text_buffer": bytearray(), "text_ends": array("q"), "text_ids": {},
+            "block_texts": array("i"), "block_pages": array("i"), "block_boxes": array("f") if extraction_mode == "layout" else None,
+            "pdf_names": [], "page_counts": [], "pdf_starts": array("q", [0])}
+
+# Helper function to fingerprint the UTF-8 bytes of a block text to a 64-bit integer
+def block_bytes_fingerprint(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+# Helper function to return the UTF-8 bytes of a distinct text of a block store
+def stored_text_bytes(store, text_id):
+    ends = store["text_ends"]
+    return store["text_buffer"][ends[text_id - 1] if text_id else 0:ends[text_id]]
+
+# Function to append the blocks of one PDF to a block store. data holds the UTF-8 texts of all blocks
+# back to back with their byte lengths in block_lengths; texts already in the store are interned.
+# Texts are looked up by fingerprint, and the stored bytes are compared on a hit: a text whose
+# fingerprint collides with a different one is interned under its bytes instead.
+def add_blocks_to_store(store, data, block_lengths, block_pages, block_boxes=None):
+    text_ids = store["text_ids"]
+    view = memoryview(data)
+    position = 0
+    for length in np.asarray(block_lengths).tolist():
+        block = view[position:position + length]
+        position += length
+        key = block_bytes_fingerprint(block)
+        text_id = text_ids.get(key)
+        if text_id is not None and stored_text_bytes(store, text_id) != block:
+            key = bytes(block)
+            text_id = text_ids.get(key)
+        if text_id is None:
+            text_id = text_ids[key] = len(store["text_ends"])
+            store["text_buffer"] += block
+            store["text_ends"].append(len(store["text_buffer"]))
+        store["block_texts"].append(text_id)
+    store["block_pages"].extend(np.asarray(block_pages, dtype=np.int32).tolist())
+    if store["block_boxes"] is not None and block_boxes is not None:
+        store["block_boxes"].extend(np.asarray(block_boxes, dtype=np.float32).ravel().tolist())
+
+# Function to close the current PDF of a block store after its blocks have been added
+def finish_store_pdf(store, pdf_name, page_count):
+    store["pdf_names"].append(pdf_name)
+    store["page_counts"].append(page_count)
+    store["pdf_starts"].append(len(store["block_texts"]))
+
+# Function to add a PDF report of text lists (a cached extraction, or a report built in memory) to a block store
+def add_report_to_store(store, pdf_name, report):
+    encoded = [text.encode("utf-8") for text in report["text_blocks"]]
+    add_blocks_to_store(store, b"".join(encoded), [len(block) for block in encoded],
+                        report.get("block_pages", [-1] * len(encoded)), report.get("block_boxes"))
+    finish_store_pdf(store, pdf_name, report.get("page_count"))
+
+# Function to build a block store from PDF reports keyed by PDF name
+def block_store_from_reports(pdf_reports, extraction_mode=DEFAULT_EXTRACTION_MODE):
+    store = new_block_store(extraction_mode)
+    for pdf_name, report in pdf_reports.items():
+        add_report_to_store(store, pdf_name, report)
+    return store
+
+# Helper function to decode the distinct block texts of a block store, in order of first appearance
+def block_store_texts(store):
+    buffer, ends = store["text_buffer"], store["text_ends"]
+    return [buffer[start:end].decode("utf-8") for start, end in zip([0] + ends[:-1].tolist(), ends.tolist())]
+
+# Helper function to return the PDF id of every block of a block store
+def block_store_pdf_ids(store):
+    return np.repeat(np.arange(len(store["pdf_names"]), dtype=np.int32), np.diff(np.frombuffer(store["pdf_starts"], dtype=np.int64)))
+
+# Function to group the blocks of a block store by their interned text: returns the distinct texts in
+# order of first appearance and, for each of them, the indices of all its occurrences
+def block_store_groups(store):
+    if not store["text_ends"]:
+        return [], []
+    block_texts = np.frombuffer(store["block_texts"], dtype=np.int32)
+    order = np.argsort(block_texts, kind="stable")
+    counts = np.bincount(block_texts, minlength=len(store["text_ends"]))
+    return block_store_texts(store), [indices.tolist() for indices in np.split(order, np.cumsum(counts)[:-1])]
+
+# Function to decode the report of one PDF of a block store, in the form analyze_pdf returns it
+def block_store_report(store, pdf_id):
+    start, end = store["pdf_starts"][pdf_id], store["pdf_starts"][pdf_id + 1]
+    buffer, ends = store["text_buffer"], store["text_ends"]
+    text_ids = store["block_texts"][start:end]
+    report = {"text_blocks": [buffer[ends[text_id - 1] if text_id else 0:ends[text_id]].decode("utf-8") for text_id in text_ids],
+              "block_pages": store["block_pages"][start:end].tolist(), "page_count": store["page_counts"][pdf_id]}
+    if store["block_boxes"] is not None:
+        boxes = store["block_boxes"][start * 4:end * 4].tolist()
+        report["block_boxes"] = [[round(value, 1) for value in boxes[index:index + 4]] for index in range(0, len(boxes), 4)]
+    return report
+
+# Helper function to iterate (PDF name, report) over PDF reports keyed by name or over a block store,
+# whose reports are decoded one PDF at a time
+def iter_pdf_reports(reports):
+    if "text_ends" not in reports:
+        yield from reports.items()
+        return
+    for pdf_id, pdf_name in enumerate(reports["pdf_names"]):
+        yield pdf_name, block_store_report(reports, pdf_id)
+
+# Function run by the extraction workers: analyze a range of pages of a PDF and write the UTF-8 text of
+# its blocks back to back to a spill file in spill_dir, so that only the file name, byte lengths, pages
+# and boxes of the blocks are sent back instead of a pickled list of strings
+def spill_pdf_pages(file_path, start_page, end_page, spill_dir, extraction_mode=DEFAULT_EXTRACTION_MODE, on_page=None):
+    page_range = analyze_pdf_pages(file_path, start_page, end_page, extraction_mode, on_page)
+    encoded = [text.encode("utf-8") for text in page_range.pop("text_blocks")]
+    spill_fd, spill_path = tempfile.mkstemp(suffix=".blocks", dir=spill_dir)
+    with os.fdopen(spill_fd, "wb") as spill_file:
+        spill_file.write(b"".join(encoded))
+    page_range["spill_path"] = spill_path
+    page_range["block_lengths"] = np.array([len(block) for block in encoded], dtype=np.int64)
+    page_range["block_pages"] = np.array(page_range["block_pages"], dtype=np.int32)
+    if "block_boxes" in page_range:
+        page_range["block_boxes"] = np.array(page_range["block_boxes"], dtype=np.float32).reshape(-1, 4)
+    return page_range
+
+# Function to extract the text blocks of a list of PDFs on supervised worker processes. Each PDF is
+# split into page-range tasks and the largest files are scheduled first, so wall-clock time depends
+# on the total number of pages rather than on the biggest file. Workers hand their blocks back through
+# spill files, which are added to a block store (see new_block_store) as soon as all page ranges of a
+# PDF are in. Cached extractions are reused when a cache folder is given; quarantined PDFs are skipped
+# and PDFs breaking a worker limit are quarantined. Returns the block store and the content hash of
+# every PDF looked up in the cache. When an extraction_times dict is given, it is filled with the
+# pages, tasks and summed task seconds of every PDF extracted in this call.
+def extract_pdf_reports(pdf_files, base_output_folder, cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+                        pages_per_task=PAGES_PER_TASK, extraction_times=None, extraction_mode=DEFAULT_EXTRACTION_MODE,
+                        worker_limits=EXTRACTION_WORKER_LIMITS):
+    pdf_files = skip_quarantined_pdfs(pdf_files, base_output_folder)
+    block_store = new_block_store(extraction_mode)
+    cached_reports, content_hashes = {}, {}
+    if cache_dir:
+        cached_reports, content_hashes = load_cached_reports(pdf_files, cache_dir, extraction_mode)
+        print(f"Loaded {len(cached_reports)} of {len(pdf_files)} PDFs from the extraction cache.")
+        for pdf_name in list(cached_reports):
+            add_report_to_store(block_store, pdf_name, cached_reports.pop(pdf_name))
+
+    cached_names = set(block_store["pdf_names"])
+    page_counts = {}
+    for pdf in pdf_files:
+        if os.path.basename(pdf) not in cached_names:
+            page_count = pdf_page_count(pdf)
+            if page_count is not None:
+                page_counts[pdf] = page_count
+
+    page_ranges = defaultdict(dict)
+    pending_tasks = {}
+    failed_pdfs = set()
+    with tempfile.TemporaryDirectory(prefix="block_spill_") as spill_dir:
+        tasks = []
+        for pdf in sorted(page_counts, key=page_counts.get, reverse=True):
+            start_pages = range(0, max(page_counts[pdf], 1), pages_per_task)
+            pending_tasks[pdf] = len(start_pages)
+            for start_page in start_pages:
+                tasks.append((start_page, pdf, spill_pdf_pages,
+                              (pdf, start_page, start_page + pages_per_task, spill_dir, extraction_mode)))
+
+        for start_page, pdf, page_range, error, quarantined in run_supervised_tasks(tasks, worker_limits):
+            pending_tasks[pdf] -= 1
+            if error is None:
+                page_ranges[pdf][start_page] = page_range
+            elif pdf not in failed_pdfs:
+                failed_pdfs.add(pdf)
+                log_extraction_failure(base_output_folder, pdf, error, quarantined, content_hashes.get(pdf))
+
+            if pending_tasks[pdf] > 0:
+                continue
+            ranges = page_ranges.pop(pdf, {})
+            if pdf in failed_pdfs:
+                for page_range in ranges.values():
+                    os.remove(page_range["spill_path"])
+                continue
+            if extraction_times is not None:
+                extraction_times[os.path.basename(pdf)] = {
+                    "pages": page_counts[pdf],
+                    "tasks": len(ranges),
+                    "seconds": round(sum(page_range["seconds"] for page_range in ranges.values()), 4),
+                }
+            for start in sorted(ranges):
+                page_range = ranges[start]
+                with open(page_range["spill_path"], "rb") as spill_file:
+                    data = spill_file.read()
+                os.remove(page_range["spill_path"])
+                add_blocks_to_store(block_store, data, page_range["block_lengths"], page_range["block_pages"],
+                                    page_range.get("block_boxes"))
+            finish_store_pdf(block_store, os.path.basename(pdf), page_counts[pdf])
+            if cache_dir:
+                store_cached_extraction(cache_dir, content_hashes[pdf], extraction_settings(extraction_mode),
+                                        block_store_report(block_store, len(block_store["pdf_names"]) - 1), cache_max_bytes)
+
+    return block_store, content_hashes
+
+# Helper function to keep only the top-k highest scoring pairs of each query row
+def keep_top_k_pairs(rows, cols, scores, top_k):
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    _, first_index, counts = np.unique(rows, return_index=True, return_counts=True)
+    rank = np.arange(len(rows)) - np.repeat(first_index, counts)
+    keep = rank < top_k
+    return rows[keep], cols[keep], scores[keep]
+
+# Helper function to find the pairs above the threshold between a block of query rows and the
+# transposed corpus. start_row is the index of the first query row, so that upper_triangle compares
+# global row numbers; returns (rows, cols, scores) arrays sorted by (row, col).
+def similar_pairs_in_rows(query_rows, corpus_t, start_row, threshold=SIMILARITY_THRESHOLD, top_k=None, upper_triangle=False):
+    products = (query_rows @ corpus_t).tocoo()
+    rows, cols, scores = products.row.astype(np.int64) + start_row, products.col.astype(np.int64), products.data
+    keep = scores > threshold
+    if upper_triangle:
+        keep &= cols > rows
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    if top_k is not None:
+        rows, cols, scores = keep_top_k_pairs(rows, cols, scores, top_k)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], scores[order]
+
+# Function to find block pairs above a similarity threshold in vectorized row batches.
+# TF-IDF rows are L2-normalized, so the sparse product of two rows is their cosine
+# similarity; only one batch of products is held in memory at a time, and each batch
+# yields (rows, cols, scores) arrays sorted by (row, col).
+def find_similar_pairs(query_matrix, corpus_matrix, threshold=SIMILARITY_THRESHOLD, top_k=None,
+                       batch_size=SIMILARITY_BATCH_SIZE, upper_triangle=False):
+    corpus_t = corpus_matrix.T.tocsr()
+    for start in range(0, query_matrix.shape[0], batch_size):
+        yield similar_pairs_in_rows(query_matrix[start:start + batch_size], corpus_t, start, threshold, top_k, upper_triangle)
+
+# Function to write the CSR arrays of a matrix and of its transpose to .npy files in folder, so
+# that similarity workers memory-map one shared copy from the page cache instead of each receiving
+# a pickled one. Returns the file paths and shapes the workers load them from, and their total size.
+def share_similarity_matrix(matrix, folder):
+    shared = {}
+    shared_bytes = 0
+    for name, csr in (("matrix", matrix), ("transposed", matrix.T.tocsr())):
+        shared[name] = {"shape": csr.shape}
+        for part in ("data", "indices", "indptr"):
+            path = os.path.join(folder, f"{name}_{part}.npy")
+            np.save(path, getattr(csr, part))
+            shared[name][part] = path
+            shared_bytes += getattr(csr, part).nbytes
+    return shared, shared_bytes
+
+# Helper function to memory-map a matrix written by share_similarity_matrix
+def load_shared_matrix(shared_matrix):
+    arrays = tuple(np.load(shared_matrix[part], mmap_mode="r") for part in ("data", "indices", "indptr"))
+    return sparse.csr_matrix(arrays, shape=shared_matrix["shape"], copy=False)
+
+# Function run by the similarity worker processes: score the rows start to end of the shared
+# matrix against all of its rows. Only the tile's own rows and its products are copied into the
+# worker's memory.
+def similarity_tile(shared, start, end, threshold, top_k, upper_triangle):
+    matrix = load_shared_matrix(shared["matrix"])
+    corpus_t = load_shared_matrix(shared["transposed"])
+    return similar_pairs_in_rows(matrix[start:end], corpus_t, start, threshold, top_k, upper_triangle)
+
+# Function to split the rows of a normalized TF-IDF matrix into contiguous tiles whose products
+# stay within tile_budget bytes. A row has at most one product per row sharing a term with it,
+# and never more than there are rows, which bounds the product size of every row up front.
+# Tiles are also kept small enough that each of the workers gets several of them.
+def plan_similarity_tiles(matrix, tile_budget, workers):
+    row_count = matrix.shape[0]
+    term_rows = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    product_counts = np.concatenate(([0], np.cumsum(term_rows[matrix.indices], dtype=np.int64)))
+    row_products = np.minimum(product_counts[matrix.indptr[1:]] - product_counts[matrix.indptr[:-1]], row_count)
+    cumulative_bytes = np.cumsum(row_products * SIMILARITY_BYTES_PER_PRODUCT)
+    total_bytes = int(cumulative_bytes[-1]) if row_count else 0
+    tile_budget = max(min(tile_budget, total_bytes // (workers * SIMILARITY_TILES_PER_WORKER)), 1)
+
+    tiles = []
+    start = 0
+    while start < row_count:
+        used_bytes = int(cumulative_bytes[start - 1]) if start else 0
+        end = max(int(np.searchsorted(cumulative_bytes, used_bytes + tile_budget, side="right")), start + 1)
+        tiles.append((start, min(end, row_count)))
+        start = end
+    return tiles
+
+# Function to find the similar pairs of all rows of a normalized TF-IDF matrix with each other
+# (upper triangle) in row tiles spread over worker processes. The matrix is shared through
+# memory-mapped files, the tile size follows from the memory budget left after the shared copy,
+# and tiles are yielded in row order as the same (rows, cols, scores) batches as find_similar_pairs.
+def find_similar_pairs_tiled(matrix, threshold=SIMILARITY_THRESHOLD, top_k=None, workers=None,
+                             memory_budget=SIMILARITY_MEMORY_BUDGET, stage=None):
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix="similarity_tiles_") as folder:
+        shared, shared_bytes = share_similarity_matrix(matrix, folder)
+        tile_budget = (memory_budget - shared_bytes) // workers
+        if tile_budget <= 0:
+            print(f"The similarity memory budget ({memory_budget // 1024 ** 2} MB) does not cover the shared matrix "
+                  f"({shared_bytes // 1024 ** 2} MB); scoring one row per tile.")
+        tiles = plan_similarity_tiles(matrix, tile_budget, workers)
+        if stage is not None:
+            stage.update(similarity_workers=workers, similarity_tiles=len(tiles), shared_matrix_bytes=shared_bytes)
+
+        # At most one tile per worker is in flight or waiting to be yielded, so finished tiles
+        # cannot pile up beyond the budget while an earlier, larger tile is still being scored
+        pending_tiles = deque(tiles)
+        futures = deque()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tiles))) as executor:
+            while pending_tiles or futures:
+                while pending_tiles and len(futures) < workers:
+                    start, end = pending_tiles.popleft()
+                    futures.append(executor.submit(similarity_tile, shared, start, end, threshold, top_k, True))
+                yield futures.popleft().result()
+
+# Helper function to pick the all-vs-all similarity search of a normalized TF-IDF matrix: row
+# batches in this process for one worker or a matrix of a single batch, tiles on a process pool otherwise
+def all_vs_all_pair_batches(matrix, threshold, top_k, similarity_workers, memory_budget, stage=None):
+    if similarity_workers == 1 or matrix.shape[0] <= SIMILARITY_BATCH_SIZE:
+        return find_similar_pairs(matrix, matrix, threshold, top_k, upper_triangle=True)
+    return find_similar_pairs_tiled(matrix, threshold, top_k, similarity_workers, memory_budget, stage)
+
+# Helper function to hash the word shingles of a text block to 32-bit integers
+def shingle_hashes(text, shingle_size=LSH_SHINGLE_SIZE):
+    words = text.split()
+    shingles = {" ".join(words[k:k + shingle_size]) for k in range(max(1, len(words) - shingle_size + 1))}
+    return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+# Function to compute MinHash signatures over word shingles for a list of text blocks
+def minhash_signatures(text_blocks, num_perm, shingle_size=LSH_SHINGLE_SIZE, seed=1):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+    signatures = np.empty((len(text_blocks), num_perm), dtype=np.uint64)
+    for index, text in enumerate(text_blocks):
+        hashes = shingle_hashes(text, shingle_size)
+        signatures[index] = ((hashes[:, None] * a + b) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+# Function to propose candidate pairs whose signatures collide in at least one LSH band.
+# With split set, only pairs between a query row (< split) and a corpus row (>= split) are kept.
+def lsh_candidate_pairs(signatures, bands, rows, split=None):
+    count = signatures.shape[0]
+    band_weights = np.random.default_rng(0).integers(1, 1 << 63, rows, dtype=np.uint64)
+    candidates = []
+    for band in range(bands):
+        # Colliding keys from different band values only add extra candidates, which are
+        # filtered out by the exact cosine scoring afterwards
+        keys = (signatures[:, band * rows:(band + 1) * rows] * band_weights).sum(axis=1)
+        _, bucket_ids = np.unique(keys, return_inverse=True)
+        order = np.argsort(bucket_ids, kind="stable")
+        bucket_sizes = np.bincount(bucket_ids)
+        bucket_starts = np.concatenate(([0], np.cumsum(bucket_sizes)[:-1]))
+        for bucket in np.flatnonzero(bucket_sizes > 1):
+            members = order[bucket_starts[bucket]:bucket_starts[bucket] + bucket_sizes[bucket]]
+            if split is None:
+                left, right = np.triu_indices(len(members), 1)
+                candidates.append(members[left] * count + members[right])
+            else:
+                queries, corpus = members[members < split], members[members >= split]
+                if len(queries) and len(corpus):
+                    candidates.append((queries[:, None] * count + corpus).ravel())
+
+    if not candidates:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pair_keys = np.unique(np.concatenate(candidates))
+    return pair_keys // count, pair_keys % count
+
+# Function to score candidate pairs with exact TF-IDF cosine similarity in row batches.
+# Candidates must be sorted by query row; yields the same (rows, cols, scores) batches as
+# find_similar_pairs.
+def score_candidate_pairs(query_matrix, corpus_matrix, rows, cols, threshold=SIMILARITY_THRESHOLD,
+                          top_k=None, batch_size=SIMILARITY_BATCH_SIZE):
+    for start in range(0, query_matrix.shape[0], batch_size):
+        low, high = np.searchsorted(rows, [start, start + batch_size])
+        if low == high:
+            continue
+        batch_rows, batch_cols = rows[low:high], cols[low:high]
+        scores = np.asarray(query_matrix[batch_rows].multiply(corpus_matrix[batch_cols]).sum(axis=1)).ravel()
+        keep = scores > threshold
+        batch_rows, batch_cols, scores = batch_rows[keep], batch_cols[keep], scores[keep]
+        if top_k is not None:
+            batch_rows, batch_cols, scores = keep_top_k_pairs(batch_rows, batch_cols, scores, top_k)
+            order = np.lexsort((batch_cols, batch_rows))
+            batch_rows, batch_cols, scores = batch_rows[order], batch_cols[order], scores[order]
+        yield batch_rows, batch_cols, scores
+
+# Helper function to compute smoothed IDF weights the way TfidfVectorizer does
+def idf_weights(document_frequency, document_count):
+    return np.log((1 + document_count) / (1 + np.asarray(document_frequency, dtype=np.float64))) + 1
+
+# Helper function to scale the rows of a sparse matrix to unit length. extra_square_norms adds
+# the squared weight of terms that are not columns of the matrix to each row's norm.
+def l2_normalize_rows(weights, extra_square_norms=0):
+    row_norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel() + extra_square_norms)
+    row_norms[row_norms == 0] = 1
+    return (sparse.diags((1 / row_norms).astype(weights.dtype)) @ weights).tocsr()
+
+# Helper function to summarize how many block comparisons a similarity mode performed
+def comparison_stats(similarity_mode, total_pairs, compared_pairs, duplicate_blocks=0):
+    avoided = total_pairs - compared_pairs
+    return {
+        "similarity_mode": similarity_mode,
+        "total_pairs": total_pairs,
+        "compared_pairs": compared_pairs,
+        "avoided_pairs": avoided,
+        "avoided_percentage": round(avoided / total_pairs * 100, 2) if total_pairs else 0,
+        "exact_duplicate_blocks": duplicate_blocks,
+    }
+
+# Function to vectorize distinct blocks so that each row equals the TF-IDF vector a TfidfVectorizer
+# fitted on every occurrence would produce: document frequencies are weighted by occurrence counts
+def weighted_tfidf_matrix(unique_texts, occurrence_counts):
+    counts = CountVectorizer().fit_transform(unique_texts)
+    presence = counts.copy()
+    presence.data[:] = 1
+    document_frequency = presence.T @ occurrence_counts
+    idf = idf_weights(document_frequency, occurrence_counts.sum())
+    return l2_normalize_rows(counts.astype(np.float64) @ sparse.diags(idf))
+
+# Helper function to pass on the similar pairs above threshold of pair batches computed down to a lower
+# floor, keeping all of them as the scored pairs of the run (see store_run_results). Returns the batches
+# to report and the scored pairs.
+def split_scored_pairs(pair_batches, threshold, floor, unique_texts):
+    rows, cols, scores = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for batch_rows, batch_cols, batch_scores in pair_batches:
+        rows.append(batch_rows)
+        cols.append(batch_cols)
+        scores.append(batch_scores)
+    rows, cols, scores = np.concatenate(rows), np.concatenate(cols), np.concatenate(scores)
+    keep = scores > threshold
+    scored_pairs = {"texts": unique_texts, "rows": rows, "cols": cols, "scores": scores, "floor": floor}
+    return [(rows[keep], cols[keep], scores[keep])], scored_pairs
+
+# Function to start the pair report of all-vs-all blocks: identical blocks are reported as 100%
+# matches straight away, since only one representative of each group is compared
+def duplicate_block_matches(unique_texts, occurrences, pdf_names, pdf_ids):
     common_elements = {"text_blocks": defaultdict(list)}
-    all_text_blocks = [block for report in pdf_reports.values() for block in report["text_blocks"]]
-    pdf_names = [pdf_name for pdf_name, report in pdf_reports.items() for _ in report["text_blocks"]]
+    for text, indices in zip(unique_texts, occurrences):
+        for j in indices[1:]:
+            common_elements["text_blocks"][text].append((pdf_names[pdf_ids[j]], 100.0))
+    return common_elements
 
-    vectorizer = TfidfVectorizer().fit_transform(all_text_blocks)
-    similarity_matrix = cosine_similarity(vectorizer)
+# Function to add the similar pairs of distinct blocks to a pair report. A match between two
+# representatives is a match between every occurrence of their groups; as before, each match is
+# listed under the block that occurs first.
+def add_pair_matches(common_elements, pair_batches, unique_texts, occurrences, pdf_names, pdf_ids):
+    for rows, cols, scores in pair_batches:
+        for i, j, similarity in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            similarity = round(similarity * 100, 2)
+            for k in occurrences[j]:
+                common_elements["text_blocks"][unique_texts[i]].append((pdf_names[pdf_ids[k]], similarity))
+            for k in occurrences[i]:
+                if k > occurrences[j][0]:
+                    common_elements["text_blocks"][unique_texts[j]].append((pdf_names[pdf_ids[k]], similarity))
 
-    for i in range(len(all_text_blocks)):
-        for j in range(i + 1, len(all_text_blocks)):
-            similarity = similarity_matrix[i, j]
-            if similarity > 0.1:
-                common_elements["text_blocks"][all_text_blocks[i]].append((pdf_names[j], round(similarity * 100, 2)))
+# Function to compare the PDFs of a block store and find common elements with similarity percentages.
+# With pairs_floor, similar pairs are searched down to that floor and kept in the scored_pairs of the
+# result, so reports for any higher threshold can be made without recomputing (see rethreshold_stored_run).
+def compare_all_pdfs(block_store, threshold=SIMILARITY_THRESHOLD, top_k=None, similarity_mode="sparse",
+                     lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE, run_metrics=None,
+                     similarity_workers=None, memory_budget=SIMILARITY_MEMORY_BUDGET, pairs_floor=None):
+    pdf_names, pdf_ids = block_store["pdf_names"], block_store_pdf_ids(block_store)
+    block_count = len(block_store["block_texts"])
+    total_pairs = block_count * (block_count - 1) // 2
+
+    # Only one representative of each group of identical blocks goes through the fuzzy similarity stage
+    unique_texts, occurrences = block_store_groups(block_store)
+    common_elements = duplicate_block_matches(unique_texts, occurrences, pdf_names, pdf_ids)
+
+    duplicate_blocks = block_count - len(unique_texts)
+    unique_pairs = len(unique_texts) * (len(unique_texts) - 1) // 2
+    common_elements["comparison_stats"] = comparison_stats(similarity_mode, total_pairs, unique_pairs, duplicate_blocks)
+    if unique_pairs == 0:
+        if pairs_floor is not None:
+            common_elements["scored_pairs"] = split_scored_pairs([], threshold, min(pairs_floor, threshold), unique_texts)[1]
+        return common_elements
+
+    with measure_stage(run_metrics, "vectorization") as stage:
+        tfidf_matrix = weighted_tfidf_matrix(unique_texts, np.array([len(indices) for indices in occurrences]))
+        stage.update(blocks=block_count, distinct_blocks=len(unique_texts), features=tfidf_matrix.shape[1])
+
+    with measure_stage(run_metrics, "similarity") as stage:
+        floor = threshold if pairs_floor is None else min(pairs_floor, threshold)
+        if similarity_mode == "lsh":
+            signatures = minhash_signatures(unique_texts, lsh_bands * lsh_rows, shingle_size)
+            candidate_rows, candidate_cols = lsh_candidate_pairs(signatures, lsh_bands, lsh_rows)
+            common_elements["comparison_stats"] = comparison_stats(similarity_mode, total_pairs, len(candidate_rows), duplicate_blocks)
+            pair_batches = score_candidate_pairs(tfidf_matrix, tfidf_matrix, candidate_rows, candidate_cols, floor, top_k)
+        else:
+            pair_batches = all_vs_all_pair_batches(tfidf_matrix, floor, top_k, similarity_workers, memory_budget, stage)
+        if pairs_floor is not None:
+            pair_batches, common_elements["scored_pairs"] = split_scored_pairs(pair_batches, threshold, floor, unique_texts)
+            stage["scored_pairs"] = len(common_elements["scored_pairs"]["rows"])
+
+        add_pair_matches(common_elements, pair_batches, unique_texts, occurrences, pdf_names, pdf_ids)
+        stage.update(compared_pairs=common_elements["comparison_stats"]["compared_pairs"],
+                     report_rows=sum(len(matches) for matches in common_elements["text_blocks"].values()))
 
     return common_elements
 
-# Function to generate HTML report for common elements in tabular format
-def generate_comparison_html_report(common_elements, output_folder):
-    html_content = f"""
+# Function to collapse the similarity graph of distinct blocks into template clusters. Identical
+# blocks share one node, similar pairs between nodes (scores in percent) are the edges, and each
+# connected component holding at least two blocks is a template cluster with its most frequent block
+# as representative, its member and distinct block counts, the PDFs it occurs in and the range of its
+# similarity scores.
+def cluster_similarity_graph(unique_texts, occurrences, rows, cols, scores, pdf_names, pdf_ids):
+    occurrence_counts = np.array([len(indices) for indices in occurrences], dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(unique_texts),) * 2)
+    cluster_count, labels = connected_components(graph, directed=False)
+
+    # Score ranges per component; identical blocks count as 100% matches
+    min_scores = np.full(cluster_count, np.inf)
+    max_scores = np.full(cluster_count, -np.inf)
+    np.minimum.at(min_scores, labels[rows], scores)
+    np.maximum.at(max_scores, labels[rows], scores)
+    has_duplicates = np.bincount(labels, weights=occurrence_counts > 1, minlength=cluster_count) > 0
+    min_scores[has_duplicates] = np.minimum(min_scores[has_duplicates], 100.0)
+    max_scores[has_duplicates] = 100.0
+
+    member_blocks = np.bincount(labels, weights=occurrence_counts, minlength=cluster_count).astype(np.int64)
+    distinct_blocks = np.bincount(labels, minlength=cluster_count)
+
+    # The representative is the most frequent block of a cluster, the first one on ties
+    order = np.lexsort((np.arange(len(unique_texts)), -occurrence_counts, labels))
+    group_starts = order[np.r_[True, labels[order][1:] != labels[order][:-1]]] if len(order) else order
+    representatives = np.empty(cluster_count, dtype=np.int64)
+    representatives[labels[group_starts]] = group_starts
+
+    cluster_pdfs = defaultdict(dict)
+    for unique_id, label in enumerate(labels.tolist()):
+        if member_blocks[label] > 1:
+            cluster_pdfs[label].update(dict.fromkeys(pdf_names[pdf_ids[index]] for index in occurrences[unique_id]))
+
+    template_clusters = [
+        {
+            "representative": unique_texts[representatives[label]],
+            "member_blocks": int(member_blocks[label]),
+            "distinct_blocks": int(distinct_blocks[label]),
+            "pdfs": sorted(pdf_set),
+            "min_similarity": float(min_scores[label]),
+            "max_similarity": float(max_scores[label]),
+        }
+        for label, pdf_set in cluster_pdfs.items()
+    ]
+    template_clusters.sort(key=lambda cluster: -cluster["member_blocks"])
+    return template_clusters, cluster_count
+
+# Function to find the template clusters of all text blocks (see cluster_similarity_graph). No pair
+# list is built, so memory and report size follow the number of templates, not of pairs. pairs_floor
+# keeps the scored pairs down to a lower floor as in compare_all_pdfs.
+def find_template_clusters(block_store, threshold=SIMILARITY_THRESHOLD, top_k=None, similarity_mode="sparse",
+                           lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE, run_metrics=None,
+                           similarity_workers=None, memory_budget=SIMILARITY_MEMORY_BUDGET, pairs_floor=None):
+    pdf_names, pdf_ids = block_store["pdf_names"], block_store_pdf_ids(block_store)
+    block_count = len(block_store["block_texts"])
+    total_pairs = block_count * (block_count - 1) // 2
+
+    unique_texts, occurrences = block_store_groups(block_store)
+    if not unique_texts:
+        return {"template_clusters": [], "comparison_stats": comparison_stats(similarity_mode, 0, 0)}
+    occurrence_counts = np.array([len(indices) for indices in occurrences], dtype=np.int64)
+    duplicate_blocks = block_count - len(unique_texts)
+    unique_pairs = len(unique_texts) * (len(unique_texts) - 1) // 2
+    stats = comparison_stats(similarity_mode, total_pairs, unique_pairs, duplicate_blocks)
+    result = {}
+
+    edge_rows, edge_cols, edge_scores = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    if unique_pairs > 0:
+        with measure_stage(run_metrics, "vectorization") as stage:
+            tfidf_matrix = weighted_tfidf_matrix(unique_texts, occurrence_counts)
+            stage.update(blocks=block_count, distinct_blocks=len(unique_texts), features=tfidf_matrix.shape[1])
+
+        with measure_stage(run_metrics, "similarity") as stage:
+            floor = threshold if pairs_floor is None else min(pairs_floor, threshold)
+            if similarity_mode == "lsh":
+                signatures = minhash_signatures(unique_texts, lsh_bands * lsh_rows, shingle_size)
+                candidate_rows, candidate_cols = lsh_candidate_pairs(signatures, lsh_bands, lsh_rows)
+                stats = comparison_stats(similarity_mode, total_pairs, len(candidate_rows), duplicate_blocks)
+                pair_batches = score_candidate_pairs(tfidf_matrix, tfidf_matrix, candidate_rows, candidate_cols, floor, top_k)
+            else:
+                pair_batches = all_vs_all_pair_batches(tfidf_matrix, floor, top_k, similarity_workers, memory_budget, stage)
+            if pairs_floor is not None:
+                pair_batches, result["scored_pairs"] = split_scored_pairs(pair_batches, threshold, floor, unique_texts)
+                stage["scored_pairs"] = len(result["scored_pairs"]["rows"])
+
+            for rows, cols, scores in pair_batches:
+                edge_rows.append(rows)
+                edge_cols.append(cols)
+                edge_scores.append(np.round(scores * 100, 2))
+            stage.update(compared_pairs=stats["compared_pairs"], similar_pairs=sum(len(rows) for rows in edge_rows))
+    elif pairs_floor is not None:
+        result["scored_pairs"] = split_scored_pairs([], threshold, min(pairs_floor, threshold), unique_texts)[1]
+
+    with measure_stage(run_metrics, "clustering") as stage:
+        rows, cols, scores = np.concatenate(edge_rows), np.concatenate(edge_cols), np.concatenate(edge_scores)
+        template_clusters, cluster_count = cluster_similarity_graph(unique_texts, occurrences, rows, cols, scores, pdf_names, pdf_ids)
+        stage.update(components=cluster_count, template_clusters=len(template_clusters))
+
+    result.update(template_clusters=template_clusters, comparison_stats=stats)
+    return result
+
+# Helper function to hash a block text to a 64-bit integer for exact-duplicate detection without the text
+def block_text_fingerprint(text):
+    return block_bytes_fingerprint(text.encode("utf-8"))
+
+# Function to hash the blocks of a range of pages of a PDF for the streaming pipeline. Only the
+# hashed term counts, a fingerprint of each block text and the block's page and offset on that page
+# leave the worker; the text itself is read again from the PDF when a report needs it.
+def hash_pdf_pages(file_path, start_page, end_page, on_page=None):
+    page_range = analyze_pdf_pages(file_path, start_page, end_page, on_page=on_page)
+    text_blocks, block_pages = page_range["text_blocks"], page_range["block_pages"]
+    block_offsets = []
+    for index, page in enumerate(block_pages):
+        block_offsets.append(block_offsets[-1] + 1 if index and block_pages[index - 1] == page else 0)
+
+    if text_blocks:
+        vectorizer = HashingVectorizer(n_features=HASHING_FEATURES, alternate_sign=False, norm=None, dtype=np.float32)
+        counts = vectorizer.transform(text_blocks)
+    else:
+        counts = sparse.csr_matrix((0, HASHING_FEATURES), dtype=np.float32)
+    return {
+        "counts": counts,
+        "fingerprints": np.array([block_text_fingerprint(text) for text in text_blocks], dtype=np.uint64),
+        "block_pages": np.array(block_pages, dtype=np.int32),
+        "block_offsets": np.array(block_offsets, dtype=np.int32),
+        "seconds": page_range["seconds"],
+    }
+
+# Helper function to write buffered count rows to the next on-disk shard
+def write_stream_shard(shard_dir, shard_paths, shard_parts):
+    shard_path = os.path.join(shard_dir, f"shard_{len(shard_paths):05d}.npz")
+    sparse.save_npz(shard_path, sparse.vstack(shard_parts, format="csr"), compressed=False)
+    shard_paths.append(shard_path)
+
+# Function to extract and hash the blocks of all PDFs straight into on-disk count shards as the
+# page-range tasks complete. The blocks of a PDF are appended in page order once all its tasks are
+# done, so at most one PDF's hashed counts wait in memory. Returns the shard paths and row starts,
+# the PDF paths, names and page counts of the successfully hashed PDFs, per-block references (PDF
+# id, page, offset on the page), block fingerprints and the document frequency of every hashed term.
+def stream_pdf_blocks(pdf_files, base_output_folder, shard_dir, shard_rows=STREAM_SHARD_ROWS,
+                      pages_per_task=PAGES_PER_TASK, extraction_times=None, worker_limits=EXTRACTION_WORKER_LIMITS):
+    pdf_files = skip_quarantined_pdfs(pdf_files, base_output_folder)
+    page_counts = {}
+    for pdf in pdf_files:
+        page_count = pdf_page_count(pdf)
+        if page_count is not None:
+            page_counts[pdf] = page_count
+
+    os.makedirs(shard_dir, exist_ok=True)
+    stream = {"shard_paths": [], "shard_starts": [0], "pdf_paths": [], "pdf_names": [], "page_counts": [],
+              "document_frequency": np.zeros(HASHING_FEATURES, dtype=np.int64)}
+    block_pdfs, block_pages, block_offsets, fingerprints = [], [], [], []
+    shard_parts, shard_part_rows = [], 0
+    page_ranges = defaultdict(dict)
+    pending_tasks = {}
+    failed_pdfs = set()
+    tasks = []
+    for pdf in sorted(page_counts, key=page_counts.get, reverse=True):
+        start_pages = range(0, max(page_counts[pdf], 1), pages_per_task)
+        pending_tasks[pdf] = len(start_pages)
+        for start_page in start_pages:
+            tasks.append((start_page, pdf, hash_pdf_pages, (pdf, start_page, start_page + pages_per_task)))
+
+    for start_page, pdf, hashed_range, error, quarantined in run_supervised_tasks(tasks, worker_limits):
+        pending_tasks[pdf] -= 1
+        if error is None:
+            page_ranges[pdf][start_page] = hashed_range
+        elif pdf not in failed_pdfs:
+            failed_pdfs.add(pdf)
+            log_extraction_failure(base_output_folder, pdf, error, quarantined)
+
+        if pending_tasks[pdf] > 0:
+            continue
+        ranges = page_ranges.pop(pdf, {})
+        if pdf in failed_pdfs:
+            continue
+
+        pdf_id = len(stream["pdf_names"])
+        stream["pdf_paths"].append(pdf)
+        stream["pdf_names"].append(os.path.basename(pdf))
+        stream["page_counts"].append(page_counts[pdf])
+        if extraction_times is not None:
+            extraction_times[os.path.basename(pdf)] = {
+                "pages": page_counts[pdf],
+                "tasks": len(ranges),
+                "seconds": round(sum(page_range["seconds"] for page_range in ranges.values()), 4),
+            }
+        for start in sorted(ranges):
+            hashed = ranges[start]
+            block_count = hashed["counts"].shape[0]
+            if block_count == 0:
+                continue
+            stream["document_frequency"] += np.bincount(hashed["counts"].indices, minlength=HASHING_FEATURES)
+            block_pdfs.append(np.full(block_count, pdf_id, dtype=np.int32))
+            block_pages.append(hashed["block_pages"])
+            block_offsets.append(hashed["block_offsets"])
+            fingerprints.append(hashed["fingerprints"])
+            shard_parts.append(hashed["counts"])
+            shard_part_rows += block_count
+            if shard_part_rows >= shard_rows:
+                write_stream_shard(shard_dir, stream["shard_paths"], shard_parts)
+                stream["shard_starts"].append(stream["shard_starts"][-1] + shard_part_rows)
+                shard_parts, shard_part_rows = [], 0
+
+    if shard_parts:
+        write_stream_shard(shard_dir, stream["shard_paths"], shard_parts)
+        stream["shard_starts"].append(stream["shard_starts"][-1] + shard_part_rows)
+
+    def concatenate(parts, dtype):
+        return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    stream["block_pdfs"] = concatenate(block_pdfs, np.int32)
+    stream["block_pages"] = concatenate(block_pages, np.int32)
+    stream["block_offsets"] = concatenate(block_offsets, np.int32)
+    stream["fingerprints"] = concatenate(fingerprints, np.uint64)
+    return stream
+
+# Helper function to load a count shard as L2-normalized TF-IDF rows
+def load_stream_shard(shard_path, idf):
+    return l2_normalize_rows(sparse.load_npz(shard_path).astype(np.float64) @ sparse.diags(idf))
+
+# Function to merge the components joined by a batch of edges. labels maps every block to the root
+# of its component, roots maps every root id to its current root, and min_scores and max_scores hold
+# the score range of each root; all four arrays are updated in place.
+def merge_components(labels, roots, min_scores, max_scores, rows, cols, scores):
+    if len(rows) == 0:
+        return
+    edge_count = len(rows)
+    nodes, inverse = np.unique(np.concatenate([labels[rows], labels[cols]]), return_inverse=True)
+    graph = sparse.coo_matrix((np.ones(edge_count, dtype=np.int8), (inverse[:edge_count], inverse[edge_count:])),
+                              shape=(len(nodes),) * 2)
+    component_count, components = connected_components(graph, directed=False)
+
+    new_roots = np.full(component_count, len(labels), dtype=labels.dtype)
+    np.minimum.at(new_roots, components, nodes)
+    component_min = np.full(component_count, np.inf, dtype=min_scores.dtype)
+    component_max = np.full(component_count, -np.inf, dtype=max_scores.dtype)
+    np.minimum.at(component_min, components, min_scores[nodes])
+    np.maximum.at(component_max, components, max_scores[nodes])
+    np.minimum.at(component_min, components[inverse[:edge_count]], scores)
+    np.maximum.at(component_max, components[inverse[:edge_count]], scores)
+    min_scores[new_roots] = component_min
+    max_scores[new_roots] = component_max
+
+    roots[nodes] = new_roots[components]
+    labels[:] = roots[labels]
+
+# Function to read block texts back from their PDFs by reference, opening every PDF and page once.
+# references is a list of (pdf_id, page, offset on the page); returns the texts in the same order.
+def read_block_texts(pdf_paths, references):
+    texts = [None] * len(references)
+    by_pdf = defaultdict(lambda: defaultdict(list))
+    for index, (pdf_id, page, offset) in enumerate(references):
+        by_pdf[pdf_id][page].append((offset, index))
+    for pdf_id, pages in by_pdf.items():
+        with fitz.open(pdf_paths[pdf_id]) as doc:
+            for page, wanted in pages.items():
+                page_blocks = extract_page_blocks(doc, page, page + 1)["text_blocks"]
+                for offset, index in wanted:
+                    texts[index] = page_blocks[offset]
+    return texts
+
+# Function to find template clusters with bounded memory. Blocks are hashed in the extraction
+# workers and streamed into on-disk shards; IDF weights come from the streamed document
+# frequencies, and the first occurrences of distinct blocks are compared two shards at a time
+# while similar pairs are merged into connected components. Besides the shards only a few
+# integers per block stay in memory, and the texts of cluster representatives are read back
+# from the PDFs at the end. Returns the same result as find_template_clusters plus the PDF page
+# counts and block total.
+def stream_template_clusters(pdf_files, base_output_folder, shard_dir, threshold=CLUSTER_SIMILARITY_THRESHOLD, top_k=None,
+                             shard_rows=STREAM_SHARD_ROWS, run_metrics=None, extraction_times=None,
+                             worker_limits=EXTRACTION_WORKER_LIMITS):
+    with measure_stage(run_metrics, "streaming_extraction") as stage:
+        stream = stream_pdf_blocks(pdf_files, base_output_folder, shard_dir, shard_rows, extraction_times=extraction_times,
+                                   worker_limits=worker_limits)
+        block_count = len(stream["fingerprints"])
+        stage.update(pdfs=len(stream["pdf_names"]), pages=sum(stream["page_counts"]), blocks=block_count,
+                     shards=len(stream["shard_paths"]),
+                     shard_bytes=sum(os.path.getsize(shard_path) for shard_path in stream["shard_paths"]))
+
+    labels = np.arange(block_count, dtype=np.int64)
+    roots = np.arange(block_count, dtype=np.int64)
+    min_scores = np.full(block_count, np.inf, dtype=np.float32)
+    max_scores = np.full(block_count, -np.inf, dtype=np.float32)
+
+    # Identical blocks are joined through their fingerprints and only first occurrences are compared
+    with measure_stage(run_metrics, "deduplication") as stage:
+        order = np.argsort(stream["fingerprints"], kind="stable")
+        is_repeat = np.r_[False, stream["fingerprints"][order][1:] == stream["fingerprints"][order][:-1]]
+        group_first = order[np.maximum.accumulate(np.where(is_repeat, 0, np.arange(block_count)))] if block_count else order
+        is_first = np.ones(block_count, dtype=bool)
+        is_first[order[is_repeat]] = False
+        merge_components(labels, roots, min_scores, max_scores, group_first[is_repeat], order[is_repeat],
+                         np.full(int(is_repeat.sum()), 100.0, dtype=np.float32))
+        stage.update(blocks=block_count, distinct_blocks=int(is_first.sum()))
+
+    total_pairs = block_count * (block_count - 1) // 2
+    compared_pairs = 0
+    with measure_stage(run_metrics, "similarity") as stage:
+        idf = idf_weights(stream["document_frequency"], block_count)
+        shard_starts = stream["shard_starts"]
+        shard_pairs = 0
+        for i, shard_path in enumerate(stream["shard_paths"]):
+            query_rows = np.flatnonzero(is_first[shard_starts[i]:shard_starts[i + 1]])
+            if len(query_rows) == 0:
+                continue
+            query_matrix = load_stream_shard(shard_path, idf)[query_rows]
+            for j in range(i, len(stream["shard_paths"])):
+                corpus_rows = np.flatnonzero(is_first[shard_starts[j]:shard_starts[j + 1]])
+                if len(corpus_rows) == 0:
+                    continue
+                corpus_matrix = query_matrix if j == i else load_stream_shard(stream["shard_paths"][j], idf)[corpus_rows]
+                shard_pairs += 1
+                compared_pairs += len(query_rows) * (len(query_rows) - 1) // 2 if j == i else len(query_rows) * len(corpus_rows)
+                for rows, cols, scores in find_similar_pairs(query_matrix, corpus_matrix, threshold, top_k, upper_triangle=(j == i)):
+                    merge_components(labels, roots, min_scores, max_scores, shard_starts[i] + query_rows[rows],
+                                     shard_starts[j] + corpus_rows[cols], np.round(scores * 100, 2).astype(np.float32))
+        stage.update(shard_pairs=shard_pairs, compared_pairs=compared_pairs)
+
+    with measure_stage(run_metrics, "clustering") as stage:
+        member_blocks = np.bincount(labels, minlength=block_count)
+        in_cluster = np.flatnonzero(member_blocks[labels] > 1)
+        cluster_labels = labels[in_cluster]
+
+        # PDFs of every cluster from the unique (cluster, PDF) pairs
+        cluster_pdfs = defaultdict(list)
+        pdf_count = max(len(stream["pdf_names"]), 1)
+        pdf_keys = np.unique(cluster_labels * pdf_count + stream["block_pdfs"][in_cluster])
+        for label, pdf_id in zip((pdf_keys // pdf_count).tolist(), (pdf_keys % pdf_count).tolist()):
+            cluster_pdfs[label].append(stream["pdf_names"][pdf_id])
+
+        # Distinct blocks of every cluster; the most frequent one (first on ties) is the representative
+        first_rows = np.empty(block_count, dtype=np.int64)
+        first_rows[order] = group_first
+        variants, variant_counts = np.unique(np.stack([cluster_labels, first_rows[in_cluster]], axis=1), axis=0, return_counts=True) \
+            if len(in_cluster) else (np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64))
+        distinct_blocks = Counter(variants[:, 0].tolist())
+        variant_order = np.lexsort((variants[:, 1], -variant_counts, variants[:, 0]))
+        is_best = np.r_[True, variants[variant_order][1:, 0] != variants[variant_order][:-1, 0]] if len(variant_order) else np.empty(0, dtype=bool)
+        best_variants = variants[variant_order][is_best]
+        representatives = dict(zip(best_variants[:, 0].tolist(), best_variants[:, 1].tolist()))
+
+        cluster_roots = sorted(representatives, key=lambda label: (-member_blocks[label], label))
+        references = [(int(stream["block_pdfs"][representatives[label]]), int(stream["block_pages"][representatives[label]]),
+                       int(stream["block_offsets"][representatives[label]])) for label in cluster_roots]
+        representative_texts = read_block_texts(stream["pdf_paths"], references)
+        template_clusters = [
+            {
+                "representative": text,
+                "member_blocks": int(member_blocks[label]),
+                "distinct_blocks": distinct_blocks[label],
+                "pdfs": sorted(cluster_pdfs[label]),
+                "min_similarity": round(float(min_scores[label]), 2),
+                "max_similarity": round(float(max_scores[label]), 2),
+            }
+            for label, text in zip(cluster_roots, representative_texts)
+        ]
+        stage.update(template_clusters=len(template_clusters), representative_lookups=len(references))
+
+    stats = comparison_stats("streaming", total_pairs, compared_pairs, block_count - int(is_first.sum()))
+    return {"template_clusters": template_clusters, "comparison_stats": stats,
+            "pdf_page_counts": dict(zip(stream["pdf_names"], stream["page_counts"])), "total_blocks": block_count}
+
+# Helper function to format a template cluster as a report row (type, content, found in PDFs, similarity).
+# The similarity is a single number when all scores agree and a "min-max" range otherwise.
+def cluster_report_row(cluster_number, cluster):
+    similarity = cluster["min_similarity"]
+    if cluster["max_similarity"] != similarity:
+        similarity = f"{similarity}-{cluster['max_similarity']}"
+    element_type = f"Template {cluster_number} ({cluster['member_blocks']} blocks, {cluster['distinct_blocks']} variants)"
+    return element_type, cluster["representative"], ", ".join(cluster["pdfs"]), similarity
+
+# Helper function to yield the report rows (type, content, found in PDF, similarity) of the common
+# elements: one row per template cluster, or one row per matching block pair
+def iter_report_rows(common_elements):
+    if "template_clusters" in common_elements:
+        for cluster_number, cluster in enumerate(common_elements["template_clusters"], 1):
+            yield cluster_report_row(cluster_number, cluster)
+        return
+    for item, matches in common_elements["text_blocks"].items():
+        for pdf_name, similarity in matches:
+            yield "Text Block", item, pdf_name, similarity
+
+# Helper function to name the file of an HTML report page; the first page keeps the original report name
+def html_report_page_name(page_number):
+    if page_number == 1:
+        return "template_reusability_report.html"
+    return f"template_reusability_report_page_{page_number}.html"
+
+# Helper function to write the head of an HTML report page up to the opening of the table body
+def write_html_page_header(html_file, page_number, generated_on):
+    previous_link = f'<a href="{html_report_page_name(page_number - 1)}">&laquo; Previous</a> | ' if page_number > 1 else ""
+    html_file.write(f"""
     <html>
     <head>
-        <title>Template Reusability Report</title>
+        <meta charset="utf-8">
+        <title>Template Reusability Report - Page {page_number}</title>
         <style>
             body {{ font-family: Arial, sans-serif; margin: 20px; }}
             h1 {{ color: #333; }}
@@ -89,7 +1400,8 @@ def generate_comparison_html_report(common_elements, output_folder):
     </head>
     <body>
         <h1>Template Reusability Report</h1>
-        <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        <p>Generated on {generated_on}</p>
+        <p>{previous_link}Page {page_number} | <a href="template_reusability_report_pages.html">All pages</a></p>
         <table>
             <thead>
                 <tr>
@@ -100,69 +1412,165 @@ def generate_comparison_html_report(common_elements, output_folder):
                 </tr>
             </thead>
             <tbody>
-    """
+    """)
+
+# Helper function to close the table of an HTML report page, linking the next page when there is one
+def write_html_page_footer(html_file, next_page_number=None):
+    next_link = f'<p><a href="{html_report_page_name(next_page_number)}">Next &raquo;</a></p>' if next_page_number else ""
+    html_file.write(f"""
+            </tbody>
+        </table>
+        {next_link}
+    </body>
+    </html>
+    """)
+
+# Function to stream report rows into linked HTML pages of at most rows_per_page rows each.
+# Rows are written to disk as they are produced, so memory use does not depend on the number
+# of matches. Returns the number of pages written.
+def write_html_report_pages(rows, output_folder, rows_per_page=HTML_ROWS_PER_PAGE):
+    generated_on = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    page_row_counts = []
+    html_file = None
+    try:
+        for element_type, content, pdf_name, similarity in rows:
+            if not page_row_counts or page_row_counts[-1] == rows_per_page:
+                if html_file:
+                    write_html_page_footer(html_file, len(page_row_counts) + 1)
+                    html_file.close()
+                page_row_counts.append(0)
+                html_file = open(os.path.join(output_folder, html_report_page_name(len(page_row_counts))), "w", encoding="utf-8")
+                write_html_page_header(html_file, len(page_row_counts), generated_on)
 
-    for item, matches in common_elements["text_blocks"].items():
-        for match in matches:
-            pdf_name, similarity = match
             highlight_class = "highlight-green" if similarity == 100 else "highlight-yellow"
-            html_content += f"""
+            html_file.write(f"""
             <tr class="{highlight_class}">
-                <td>Text Block</td>
-                <td>{item}</td>
-                <td>{pdf_name}</td>
+                <td>{html.escape(element_type)}</td>
+                <td>{html.escape(content)}</td>
+                <td>{html.escape(pdf_name)}</td>
                 <td>{similarity}%</td>
             </tr>
-            """
+            """)
+            page_row_counts[-1] += 1
 
-    html_content += """
-            </tbody>
-        </table>
+        if html_file is None:
+            page_row_counts.append(0)
+            html_file = open(os.path.join(output_folder, html_report_page_name(1)), "w", encoding="utf-8")
+            write_html_page_header(html_file, 1, generated_on)
+        write_html_page_footer(html_file)
+    finally:
+        if html_file:
+            html_file.close()
+
+    with open(os.path.join(output_folder, "template_reusability_report_pages.html"), "w", encoding="utf-8") as index_file:
+        index_file.write(f"""
+    <html>
+    <head><meta charset="utf-8"><title>Template Reusability Report - Pages</title></head>
+    <body style="font-family: Arial, sans-serif; margin: 20px;">
+        <h1>Template Reusability Report</h1>
+        <p>Generated on {generated_on}: {sum(page_row_counts)} rows in {len(page_row_counts)} pages</p>
+        <ul>
+    """)
+        row_start = 1
+        for page_number, row_count in enumerate(page_row_counts, 1):
+            index_file.write(f'<li><a href="{html_report_page_name(page_number)}">Page {page_number}</a> '
+                             f'(rows {row_start}-{row_start + row_count - 1})</li>\n')
+            row_start += row_count
+        index_file.write("""
+        </ul>
     </body>
     </html>
-    """
+    """)
+    return len(page_row_counts)
 
-    html_filename = os.path.join(output_folder, "template_reusability_report.html")
-    with open(html_filename, "w", encoding="utf-8") as html_file:
-        html_file.write(html_content)
+# Function to generate HTML report for common elements in tabular format
+def generate_comparison_html_report(common_elements, output_folder, rows_per_page=HTML_ROWS_PER_PAGE):
+    page_count = write_html_report_pages(iter_report_rows(common_elements), output_folder, rows_per_page)
+    html_filename = os.path.join(output_folder, html_report_page_name(1))
+    print(f"Template reusability report generated: {html_filename} ({page_count} pages)")
 
-    print(f"Template reusability report generated: {html_filename}")
+# Helper function to name the workbook of an Excel report part; the first part keeps the original name
+def excel_report_filename(output_folder, current_time, part_number):
+    suffix = "" if part_number == 1 else f"_part{part_number}"
+    return os.path.join(output_folder, f"template_reusability_report_{current_time}{suffix}.xlsx")
 
-# Function to generate Excel report with wrapped text and highlighting
-def generate_comparison_excel_report(common_elements, output_folder):
-    rows = []
-    for item, matches in common_elements["text_blocks"].items():
-        for match in matches:
-            pdf_name, similarity = match
-            rows.append(["Text Block", item, pdf_name, similarity])
+# Function to stream report rows into write-only Excel workbooks. Cell styles are created once per
+# sheet and shared by every row; a full sheet rolls over to a new sheet, and a workbook with
+# max_sheets_per_workbook sheets rolls over to a new workbook. Returns the workbook paths.
+def write_excel_report(rows, output_folder, max_rows_per_sheet=EXCEL_MAX_ROWS_PER_SHEET,
+                       max_sheets_per_workbook=EXCEL_MAX_SHEETS_PER_WORKBOOK):
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    header = ["Type", "Content (Paragraph)", "Found in PDF", "Similarity Percentage"]
+    alignment = Alignment(wrap_text=True, vertical='top')
+    fills = {
+        True: PatternFill(start_color="D4EDDA", end_color="D4EDDA", fill_type="solid"),
+        False: PatternFill(start_color="FFF3CD", end_color="FFF3CD", fill_type="solid"),
+    }
 
-    df = pd.DataFrame(rows, columns=["Type", "Content (Paragraph)", "Found in PDF", "Similarity Percentage"])
+    excel_filenames = []
+    workbook = None
+    worksheet = None
+    row_cells = None
+    sheet_count = 0
+    total_sheet_count = 0
+    sheet_row_count = max_rows_per_sheet
+    rows = iter(rows)
+    while True:
+        row = next(rows, None)
+        if sheet_row_count == max_rows_per_sheet and (row is not None or workbook is None):
+            if workbook is None or sheet_count == max_sheets_per_workbook:
+                if workbook is not None:
+                    excel_filenames.append(excel_report_filename(output_folder, current_time, len(excel_filenames) + 1))
+                    workbook.save(excel_filenames[-1])
+                workbook = Workbook(write_only=True)
+                sheet_count = 0
+            sheet_count += 1
+            total_sheet_count += 1
+            title = "Template Reusability Report" + ("" if total_sheet_count == 1 else f" {total_sheet_count}")
+            worksheet = workbook.create_sheet(title)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Template Reusability Report"
+            header_cells = [WriteOnlyCell(worksheet, value=value) for value in header]
+            for cell in header_cells:
+                cell.alignment = alignment
+            worksheet.append(header_cells)
 
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
-        for c_idx, value in enumerate(row, 1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=value)
-            cell.alignment = Alignment(wrap_text=True, vertical='top')
+            # Write-only rows are serialized on append, so the same styled cells are reused for every row
+            row_cells = {}
+            for is_exact_match, fill in fills.items():
+                row_cells[is_exact_match] = [WriteOnlyCell(worksheet) for _ in header]
+                for column_index, cell in enumerate(row_cells[is_exact_match], 1):
+                    cell.alignment = alignment
+                    if column_index in (2, 4):
+                        cell.fill = fill
+            sheet_row_count = 1
 
-            if r_idx > 1:
-                if c_idx == 4:
-                    similarity = float(value)
-                    fill = PatternFill(start_color="D4EDDA", end_color="D4EDDA", fill_type="solid") if similarity == 100 else PatternFill(start_color="FFF3CD", end_color="FFF3CD", fill_type="solid")
-                    ws.cell(row=r_idx, column=2).fill = fill
-                    ws.cell(row=r_idx, column=4).fill = fill
+        if row is None:
+            break
+        cells = row_cells[row[3] == 100]
+        for cell, value in zip(cells, row):
+            cell.value = value
+        worksheet.append(cells)
+        sheet_row_count += 1
 
-    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    excel_filename = os.path.join(output_folder, f"template_reusability_report_{current_time}.xlsx")
-    wb.save(excel_filename)
+    excel_filenames.append(excel_report_filename(output_folder, current_time, len(excel_filenames) + 1))
+    workbook.save(excel_filenames[-1])
+    return excel_filenames
 
-    print(f"Excel report generated: {excel_filename}")
+# Function to generate Excel report with wrapped text and highlighting
+def generate_comparison_excel_report(common_elements, output_folder):
+    for excel_filename in write_excel_report(iter_report_rows(common_elements), output_folder):
+        print(f"Excel report generated: {excel_filename}")
+
+# Helper function to count the blocks rationalization could remove: all blocks of a template cluster
+# but one, or every reported match of a pair report
+def count_reusable_blocks(common_elements):
+    if "template_clusters" in common_elements:
+        return sum(cluster["member_blocks"] - 1 for cluster in common_elements["template_clusters"])
+    return sum(len(matches) for matches in common_elements["text_blocks"].values())
 
 # Function to estimate the percentage of effort reduction
 def calculate_effort_reduction(common_elements, total_blocks):
-    matching_blocks = sum(len(matches) for matches in common_elements["text_blocks"].values())
+    matching_blocks = count_reusable_blocks(common_elements)
     if total_blocks == 0:
         return 0
     return round((matching_blocks / total_blocks) * 100, 2)
@@ -175,48 +1583,457 @@ def calculate_page_reduction(total_blocks, matching_blocks, total_pages):
     estimated_pages_after_reduction = total_pages * (1 - reduction_ratio)
     return max(1, round(estimated_pages_after_reduction))
 
-# Main function to process the PDF analysis and comparison
-def analyze_all_vs_all(all_pdf_folder, base_output_folder):
-    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
-    all_pdf_files = [pdf for pdf in all_pdf_files if validate_pdf(pdf)]
+# Tables of the SQLite results store. Every run adds its PDFs, pages, blocks and match rows; block
+# texts are stored once in texts and shared by all runs, so the same block can be followed across
+# runs and PDFs by its text_id. Page numbers are 1-based. Runs made with a pairs floor also keep
+# every scored pair of distinct blocks above it, so they can be reported again at other thresholds.
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    similarity_mode TEXT,
+    threshold REAL,
+    output_folder TEXT,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS texts (
+    text_id INTEGER PRIMARY KEY,
+    text_hash TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pdfs (
+    pdf_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    name TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content_hash TEXT,
+    page_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS pages (
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    page_number INTEGER NOT NULL,
+    block_count INTEGER NOT NULL,
+    PRIMARY KEY (pdf_id, page_number)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    block_number INTEGER NOT NULL,
+    page_number INTEGER,
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    bbox TEXT,
+    PRIMARY KEY (pdf_id, block_number)
+);
+CREATE TABLE IF NOT EXISTS matches (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    row_number INTEGER NOT NULL,
+    query_pdf_id INTEGER REFERENCES pdfs(pdf_id),
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    pdf_id INTEGER NOT NULL REFERENCES pdfs(pdf_id),
+    similarity REAL NOT NULL,
+    PRIMARY KEY (run_id, row_number)
+);
+CREATE TABLE IF NOT EXISTS template_clusters (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    cluster_number INTEGER NOT NULL,
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    member_blocks INTEGER NOT NULL,
+    distinct_blocks INTEGER NOT NULL,
+    pdfs TEXT NOT NULL,
+    min_similarity REAL NOT NULL,
+    max_similarity REAL NOT NULL,
+    PRIMARY KEY (run_id, cluster_number)
+);
+CREATE TABLE IF NOT EXISTS scored_pairs (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    other_text_id INTEGER NOT NULL REFERENCES texts(text_id),
+    score REAL NOT NULL,
+    PRIMARY KEY (run_id, text_id, other_text_id)
+);
+CREATE INDEX IF NOT EXISTS pdfs_run_name ON pdfs (run_id, name);
+CREATE INDEX IF NOT EXISTS scored_pairs_score ON scored_pairs (run_id, score);
+CREATE INDEX IF NOT EXISTS blocks_text ON blocks (text_id);
+CREATE INDEX IF NOT EXISTS matches_text ON matches (text_id);
+CREATE INDEX IF NOT EXISTS matches_pdf ON matches (pdf_id);
+"""
 
-    if not all_pdf_files:
-        print("No valid PDF files found in the allpdf folder.")
+# Function to open the results store, creating its tables on first use
+def open_results_store(db_path):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.executescript(RESULTS_SCHEMA)
+    # Stores created before block bounding boxes were kept lack the bbox column
+    if "bbox" not in [column[1] for column in connection.execute("PRAGMA table_info(blocks)")]:
+        connection.execute("ALTER TABLE blocks ADD COLUMN bbox TEXT")
+    return connection
+
+# Helper function to hash a normalized block text for the texts table
+def block_text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# Helper function to return the text_id of a block text, adding the text on first use
+def store_block_text(connection, text_ids, text):
+    if text not in text_ids:
+        text_hash = block_text_hash(text)
+        connection.execute("INSERT OR IGNORE INTO texts (text_hash, text) VALUES (?, ?)", (text_hash, text))
+        text_ids[text] = connection.execute("SELECT text_id FROM texts WHERE text_hash = ?", (text_hash,)).fetchone()[0]
+    return text_ids[text]
+
+# Function to save one run to the results store: its PDFs with their pages and blocks, and every
+# report row or template cluster of common_elements_by_query, which maps a query PDF name (None
+# for all-vs-all runs) to its common elements. library_reports may also be a block store, whose PDFs
+# are decoded one at a time. Reports without text blocks (e.g. library PDFs read from a corpus index)
+# are stored as PDFs only, and the scored_pairs of common elements go to the scored_pairs table.
+# Returns the run_id.
+def store_run_results(db_path, kind, output_folder, similarity_mode, threshold, stats, library_reports,
+                      common_elements_by_query, query_reports=None, content_hashes=None):
+    content_hashes = content_hashes or {}
+    connection = open_results_store(db_path)
+    try:
+        with connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (created_at, kind, similarity_mode, threshold, output_folder, stats) VALUES (?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), kind, similarity_mode, threshold, output_folder, json.dumps(stats))
+            ).lastrowid
+
+            text_ids = {}
+            pdf_ids = {}
+            for role, reports in (("query", query_reports or {}), ("library", library_reports)):
+                for pdf_name, report in iter_pdf_reports(reports):
+                    pdf_id = connection.execute(
+                        "INSERT INTO pdfs (run_id, name, role, content_hash, page_count) VALUES (?, ?, ?, ?, ?)",
+                        (run_id, pdf_name, role, content_hashes.get(pdf_name), report.get("page_count"))
+                    ).lastrowid
+                    pdf_ids.setdefault(pdf_name, pdf_id)
+
+                    text_blocks = report.get("text_blocks", [])
+                    block_pages = report.get("block_pages", [None] * len(text_blocks))
+                    block_boxes = report.get("block_boxes", [None] * len(text_blocks))
+                    connection.executemany(
+                        "INSERT INTO blocks (pdf_id, block_number, page_number, text_id, bbox) VALUES (?, ?, ?, ?, ?)",
+                        ((pdf_id, block_number, None if page is None else page + 1, store_block_text(connection, text_ids, text),
+                          None if bbox is None else json.dumps(bbox))
+                         for block_number, (text, page, bbox) in enumerate(zip(text_blocks, block_pages, block_boxes)))
+                    )
+                    if report.get("page_count") is not None and "block_pages" in report:
+                        page_block_counts = Counter(block_pages)
+                        connection.executemany(
+                            "INSERT INTO pages (pdf_id, page_number, block_count) VALUES (?, ?, ?)",
+                            ((pdf_id, page + 1, page_block_counts[page]) for page in range(report["page_count"]))
+                        )
+
+            # Match rows keep the order of the generated reports so they can be rendered again as-is
+            def match_rows():
+                row_number = 0
+                for query_name, common_elements in common_elements_by_query.items():
+                    if "text_blocks" not in common_elements:
+                        continue
+                    query_pdf_id = None if query_name is None else pdf_ids[query_name]
+                    for _, text, pdf_name, similarity in iter_report_rows(common_elements):
+                        if pdf_name not in pdf_ids:
+                            pdf_ids[pdf_name] = connection.execute(
+                                "INSERT INTO pdfs (run_id, name, role) VALUES (?, ?, 'library')", (run_id, pdf_name)
+                            ).lastrowid
+                        yield run_id, row_number, query_pdf_id, store_block_text(connection, text_ids, text), pdf_ids[pdf_name], similarity
+                        row_number += 1
+
+            connection.executemany(
+                "INSERT INTO matches (run_id, row_number, query_pdf_id, text_id, pdf_id, similarity) VALUES (?, ?, ?, ?, ?, ?)",
+                match_rows()
+            )
+            connection.executemany(
+                "INSERT INTO template_clusters (run_id, cluster_number, text_id, member_blocks, distinct_blocks, pdfs, "
+                "min_similarity, max_similarity) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((run_id, cluster_number, store_block_text(connection, text_ids, cluster["representative"]), cluster["member_blocks"],
+                  cluster["distinct_blocks"], json.dumps(cluster["pdfs"]), cluster["min_similarity"], cluster["max_similarity"])
+                 for common_elements in common_elements_by_query.values()
+                 for cluster_number, cluster in enumerate(common_elements.get("template_clusters", []), 1))
+            )
+            for common_elements in common_elements_by_query.values():
+                if "scored_pairs" in common_elements:
+                    scored_pairs = common_elements["scored_pairs"]
+                    pair_text_ids = [store_block_text(connection, text_ids, text) for text in scored_pairs["texts"]]
+                    connection.executemany(
+                        "INSERT INTO scored_pairs (run_id, text_id, other_text_id, score) VALUES (?, ?, ?, ?)",
+                        ((run_id, pair_text_ids[i], pair_text_ids[j], score) for i, j, score in
+                         zip(scored_pairs["rows"].tolist(), scored_pairs["cols"].tolist(), scored_pairs["scores"].tolist()))
+                    )
+    finally:
+        connection.close()
+    print(f"Run {run_id} saved to results store: {db_path}")
+    return run_id
+
+# Function to list the runs in the results store, newest first
+def list_stored_runs(db_path):
+    connection = open_results_store(db_path)
+    try:
+        return connection.execute("""
+            SELECT runs.run_id, runs.created_at, runs.kind, runs.similarity_mode, runs.output_folder,
+                   (SELECT COUNT(*) FROM pdfs WHERE pdfs.run_id = runs.run_id),
+                   (SELECT COUNT(*) FROM matches WHERE matches.run_id = runs.run_id)
+            FROM runs ORDER BY runs.run_id DESC
+        """).fetchall()
+    finally:
+        connection.close()
+
+# Helper function to find the latest run in the results store
+def latest_stored_run(connection):
+    row = connection.execute("SELECT MAX(run_id) FROM runs").fetchone()
+    return row[0]
+
+# Function to find which PDFs contain a block and which PDFs it was matched with in a run (the
+# latest run by default). The text is normalized like extracted blocks; when no stored block is
+# identical to it, blocks containing it are returned instead.
+def query_stored_block(db_path, text, run_id=None):
+    connection = open_results_store(db_path)
+    try:
+        run_id = run_id or latest_stored_run(connection)
+        text = normalize_text(text)
+        text_rows = connection.execute("SELECT text_id, text FROM texts WHERE text_hash = ?", (block_text_hash(text),)).fetchall()
+        if not text_rows:
+            text_rows = connection.execute("SELECT text_id, text FROM texts WHERE instr(text, ?) > 0", (text,)).fetchall()
+
+        results = []
+        for text_id, block_text in text_rows:
+            occurrences = connection.execute("""
+                SELECT pdfs.name, blocks.page_number, blocks.bbox FROM blocks JOIN pdfs ON pdfs.pdf_id = blocks.pdf_id
+                WHERE blocks.text_id = ? AND pdfs.run_id = ? ORDER BY pdfs.name, blocks.page_number
+            """, (text_id, run_id)).fetchall()
+            matches = connection.execute("""
+                SELECT query.name, pdfs.name, matches.similarity FROM matches
+                JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+                LEFT JOIN pdfs AS query ON query.pdf_id = matches.query_pdf_id
+                WHERE matches.text_id = ? AND matches.run_id = ? ORDER BY matches.row_number
+            """, (text_id, run_id)).fetchall()
+            if occurrences or matches:
+                results.append({"text": block_text, "occurrences": occurrences, "matches": matches})
+        return run_id, results
+    finally:
+        connection.close()
+
+# Function to compare the matches of two runs in the results store. Pairs are keyed by query PDF,
+# block text and matched PDF name, so runs over changed folders can be compared; the comparison
+# runs inside SQLite without loading either run.
+def compare_stored_runs(db_path, old_run_id, new_run_id):
+    connection = open_results_store(db_path)
+    try:
+        connection.execute("DROP TABLE IF EXISTS temp.run_pairs")
+        connection.execute("""
+            CREATE TEMP TABLE run_pairs AS
+            SELECT matches.run_id, COALESCE(query.name, '') AS query_name, matches.text_id, pdfs.name AS pdf_name,
+                   MAX(matches.similarity) AS similarity
+            FROM matches JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+            LEFT JOIN pdfs AS query ON query.pdf_id = matches.query_pdf_id
+            WHERE matches.run_id IN (?, ?)
+            GROUP BY matches.run_id, query_name, matches.text_id, pdf_name
+        """, (old_run_id, new_run_id))
+        connection.execute("CREATE INDEX temp.run_pairs_key ON run_pairs (run_id, query_name, text_id, pdf_name)")
+
+        def count_pairs(sql, *params):
+            return connection.execute(sql, params).fetchone()[0]
+
+        only_in = """
+            SELECT COUNT(*) FROM run_pairs AS a WHERE a.run_id = ? AND NOT EXISTS (
+                SELECT 1 FROM run_pairs AS b WHERE b.run_id = ? AND b.query_name = a.query_name
+                AND b.text_id = a.text_id AND b.pdf_name = a.pdf_name)
+        """
+        changed = """
+            SELECT COUNT(*) FROM run_pairs AS a JOIN run_pairs AS b
+            ON b.run_id = ? AND b.query_name = a.query_name AND b.text_id = a.text_id AND b.pdf_name = a.pdf_name
+            WHERE a.run_id = ? AND b.similarity != a.similarity
+        """
+        pdf_names = """
+            SELECT name FROM pdfs WHERE run_id = ? EXCEPT SELECT name FROM pdfs WHERE run_id = ? ORDER BY name
+        """
+        return {
+            "old_run": old_run_id,
+            "new_run": new_run_id,
+            "old_pairs": count_pairs("SELECT COUNT(*) FROM run_pairs WHERE run_id = ?", old_run_id),
+            "new_pairs": count_pairs("SELECT COUNT(*) FROM run_pairs WHERE run_id = ?", new_run_id),
+            "added_pairs": count_pairs(only_in, new_run_id, old_run_id),
+            "removed_pairs": count_pairs(only_in, old_run_id, new_run_id),
+            "changed_similarity_pairs": count_pairs(changed, new_run_id, old_run_id),
+            "added_pdfs": [row[0] for row in connection.execute(pdf_names, (new_run_id, old_run_id))],
+            "removed_pdfs": [row[0] for row in connection.execute(pdf_names, (old_run_id, new_run_id))],
+        }
+    finally:
+        connection.close()
+
+# Helper function to yield the stored report rows of a run (optionally of one query PDF) in report order
+def iter_stored_report_rows(db_path, run_id, query_pdf_id=None):
+    connection = open_results_store(db_path)
+    try:
+        rows = connection.execute("""
+            SELECT 'Text Block', texts.text, pdfs.name, matches.similarity FROM matches
+            JOIN texts ON texts.text_id = matches.text_id JOIN pdfs ON pdfs.pdf_id = matches.pdf_id
+            WHERE matches.run_id = ? AND matches.query_pdf_id IS ? ORDER BY matches.row_number
+        """, (run_id, query_pdf_id))
+        yield from rows
+    finally:
+        connection.close()
+
+# Helper function to yield the stored template clusters of a run as report rows
+def iter_stored_cluster_rows(db_path, run_id):
+    connection = open_results_store(db_path)
+    try:
+        rows = connection.execute("""
+            SELECT template_clusters.cluster_number, texts.text, template_clusters.member_blocks, template_clusters.distinct_blocks,
+                   template_clusters.pdfs, template_clusters.min_similarity, template_clusters.max_similarity
+            FROM template_clusters JOIN texts ON texts.text_id = template_clusters.text_id
+            WHERE template_clusters.run_id = ? ORDER BY template_clusters.cluster_number
+        """, (run_id,))
+        for cluster_number, text, member_blocks, distinct_blocks, pdfs, min_similarity, max_similarity in rows:
+            yield cluster_report_row(cluster_number, {"representative": text, "member_blocks": member_blocks,
+                                                      "distinct_blocks": distinct_blocks, "pdfs": json.loads(pdfs),
+                                                      "min_similarity": min_similarity, "max_similarity": max_similarity})
+    finally:
+        connection.close()
+
+# Function to render the HTML and Excel reports of a stored run without recomputing anything.
+# Runs with several query PDFs get one report folder per query PDF.
+def render_stored_run(db_path, run_id, output_folder):
+    connection = open_results_store(db_path)
+    try:
+        has_clusters = connection.execute("SELECT 1 FROM template_clusters WHERE run_id = ? LIMIT 1", (run_id,)).fetchone()
+        queries = connection.execute("""
+            SELECT DISTINCT matches.query_pdf_id, pdfs.name FROM matches LEFT JOIN pdfs ON pdfs.pdf_id = matches.query_pdf_id
+            WHERE matches.run_id = ? ORDER BY pdfs.name
+        """, (run_id,)).fetchall()
+    finally:
+        connection.close()
+
+    if has_clusters:
+        os.makedirs(output_folder, exist_ok=True)
+        page_count = write_html_report_pages(iter_stored_cluster_rows(db_path, run_id), output_folder)
+        print(f"Template reusability report generated: {os.path.join(output_folder, html_report_page_name(1))} ({page_count} pages)")
+        for excel_filename in write_excel_report(iter_stored_cluster_rows(db_path, run_id), output_folder):
+            print(f"Excel report generated: {excel_filename}")
         return
 
-    total_pages = 0
+    for query_pdf_id, query_name in queries or [(None, None)]:
+        report_folder = output_folder if len(queries) <= 1 else os.path.join(output_folder, os.path.splitext(query_name)[0])
+        os.makedirs(report_folder, exist_ok=True)
+        page_count = write_html_report_pages(iter_stored_report_rows(db_path, run_id, query_pdf_id), report_folder)
+        print(f"Template reusability report generated: {os.path.join(report_folder, html_report_page_name(1))} ({page_count} pages)")
+        for excel_filename in write_excel_report(iter_stored_report_rows(db_path, run_id, query_pdf_id), report_folder):
+            print(f"Excel report generated: {excel_filename}")
+
+# Function to rebuild the block store of a stored all-vs-all run from its blocks, with the PDFs and
+# blocks in the order of the run. Also returns the text of every text_id of the run.
+def load_stored_block_store(connection, run_id):
     pdf_reports = {}
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = {executor.submit(analyze_pdf, pdf): pdf for pdf in all_pdf_files}
-        for future in concurrent.futures.as_completed(futures):
-            pdf = futures[future]
-            try:
-                report = future.result()
-                if report:
-                    pdf_reports[os.path.basename(pdf)] = report
-                    total_pages += len(report["text_blocks"])
-            except Exception as exc:
-                print(f"PDF {pdf} generated an exception: {exc}")
-                with open(os.path.join(base_output_folder, "processing_log.txt"), 'a') as log_file:
-                    log_file.write(f"{pdf} failed with error: {exc}\n")
+    stored_texts = {}
+    pdfs = connection.execute("SELECT pdf_id, name, page_count FROM pdfs WHERE run_id = ? AND role = 'library' ORDER BY pdf_id",
+                              (run_id,)).fetchall()
+    for pdf_id, pdf_name, page_count in pdfs:
+        report = {"text_blocks": [], "block_pages": [], "page_count": page_count}
+        for text_id, text, page_number in connection.execute("""
+            SELECT blocks.text_id, texts.text, blocks.page_number FROM blocks JOIN texts ON texts.text_id = blocks.text_id
+            WHERE blocks.pdf_id = ? ORDER BY blocks.block_number
+        """, (pdf_id,)):
+            stored_texts[text_id] = text
+            report["text_blocks"].append(text)
+            report["block_pages"].append(page_number - 1)
+        pdf_reports[pdf_name] = report
+    return block_store_from_reports(pdf_reports), stored_texts
 
-    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_report_{current_time}")
-    os.makedirs(output_folder, exist_ok=True)
+# Function to report a stored all-vs-all run again at other similarity thresholds without extracting
+# or comparing anything: the run's scored pairs above each threshold give the same pair or template
+# cluster reports, effort reduction and summary as a new run at that threshold would, in one folder
+# per threshold under output_folder. Only thresholds at or above the run's pairs floor can be reported.
+# threshold_sweep.csv compares the thresholds; returns its rows.
+def rethreshold_stored_run(db_path, run_id, thresholds, output_folder):
+    connection = open_results_store(db_path)
+    try:
+        run = connection.execute("SELECT kind, stats FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        stats = json.loads(run[1]) if run else {}
+        pairs_floor = stats.get("pairs_floor")
+        if run is None or run[0] != "all_vs_all" or pairs_floor is None:
+            print(f"Run {run_id} has no scored pairs; run the analysis with --pairs-floor to report it at other thresholds.")
+            return []
+        block_store, stored_texts = load_stored_block_store(connection, run_id)
+        pairs = connection.execute("SELECT text_id, other_text_id, score FROM scored_pairs WHERE run_id = ?", (run_id,)).fetchall()
+    finally:
+        connection.close()
+
+    unique_texts, occurrences = block_store_groups(block_store)
+    text_indices = {text: index for index, text in enumerate(unique_texts)}
+    pair_indices = np.array([(text_indices[stored_texts[text_id]], text_indices[stored_texts[other_text_id]])
+                             for text_id, other_text_id, _ in pairs], dtype=np.int64).reshape(-1, 2)
+    rows, cols = pair_indices.min(axis=1), pair_indices.max(axis=1)
+    scores = np.array([score for _, _, score in pairs], dtype=np.float64)
+    order = np.lexsort((cols, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+
+    pdf_names, pdf_ids = block_store["pdf_names"], block_store_pdf_ids(block_store)
+    total_blocks, total_pages = len(block_store["block_texts"]), sum(block_store["page_counts"])
+    comparison = {key: stats[key] for key in ("similarity_mode", "total_pairs", "compared_pairs", "avoided_pairs",
+                                              "avoided_percentage", "exact_duplicate_blocks")}
+    sweep_rows = []
+    for threshold in sorted(set(thresholds)):
+        if threshold < pairs_floor:
+            print(f"Skipping threshold {threshold}: run {run_id} only kept scored pairs above {pairs_floor}")
+            continue
+        keep = scores > threshold
+        pair_batches = [(rows[keep], cols[keep], scores[keep])]
+        if stats["report_granularity"] == "clusters":
+            template_clusters, _ = cluster_similarity_graph(unique_texts, occurrences, rows[keep], cols[keep],
+                                                            np.round(scores[keep] * 100, 2), pdf_names, pdf_ids)
+            common_elements = {"template_clusters": template_clusters, "comparison_stats": comparison}
+        else:
+            common_elements = duplicate_block_matches(unique_texts, occurrences, pdf_names, pdf_ids)
+            common_elements["comparison_stats"] = comparison
+            add_pair_matches(common_elements, pair_batches, unique_texts, occurrences, pdf_names, pdf_ids)
+
+        print(f"\nThreshold {threshold}: {int(keep.sum())} similar pairs of distinct blocks")
+        threshold_folder = os.path.join(output_folder, f"threshold_{threshold}")
+        os.makedirs(threshold_folder, exist_ok=True)
+        report_rows, effort_reduction, estimated_pages_after_reduction = write_analysis_reports(
+            common_elements, threshold_folder, total_blocks, total_pages)
+        sweep_rows.append({"threshold": threshold, "similar_pairs": int(keep.sum()), "report_rows": report_rows,
+                           "reusable_blocks": count_reusable_blocks(common_elements), "effort_reduction": effort_reduction,
+                           "estimated_pages_after_reduction": estimated_pages_after_reduction, "report_folder": threshold_folder})
 
-    common_elements = compare_all_pdfs(pdf_reports)
-    total_blocks = sum(len(report["text_blocks"]) for report in pdf_reports.values())
+    if sweep_rows:
+        sweep_path = os.path.join(output_folder, "threshold_sweep.csv")
+        with open(sweep_path, "w", newline="") as sweep_file:
+            writer = csv.DictWriter(sweep_file, fieldnames=list(sweep_rows[0]))
+            writer.writeheader()
+            writer.writerows(sweep_rows)
+        print(f"\n{'threshold':>9} {'pairs':>10} {'rows':>8} {'reusable':>9} {'effort %':>9} {'pages':>7}")
+        for row in sweep_rows:
+            print(f"{row['threshold']:>9} {row['similar_pairs']:>10} {row['report_rows']:>8} {row['reusable_blocks']:>9} "
+                  f"{row['effort_reduction']:>9} {row['estimated_pages_after_reduction']:>7}")
+        print(f"Threshold sweep saved: {sweep_path}")
+    return sweep_rows
+
+# Function to write the HTML and Excel reports, the effort and page reduction estimates and
+# effort_reduction_summary.txt of the common elements of an all-vs-all run to output_folder.
+# Returns the number of report rows, the effort reduction and the estimated pages.
+def write_analysis_reports(common_elements, output_folder, total_blocks, total_pages, run_metrics=None):
+    stats = common_elements["comparison_stats"]
+    if "template_clusters" in common_elements:
+        report_rows = len(common_elements["template_clusters"])
+        print(f"Found {report_rows} template clusters covering "
+              f"{sum(cluster['member_blocks'] for cluster in common_elements['template_clusters'])} of {total_blocks} blocks")
+    else:
+        report_rows = sum(len(matches) for matches in common_elements["text_blocks"].values())
 
     # Generate reports
-    generate_comparison_html_report(common_elements, output_folder)
-    generate_comparison_excel_report(common_elements, output_folder)
+    with measure_stage(run_metrics, "html_report") as stage:
+        generate_comparison_html_report(common_elements, output_folder)
+        stage["rows"] = report_rows
+    with measure_stage(run_metrics, "excel_report") as stage:
+        generate_comparison_excel_report(common_elements, output_folder)
+        stage["rows"] = report_rows
 
     # Calculate effort reduction
     effort_reduction = calculate_effort_reduction(common_elements, total_blocks)
     print(f"Estimated effort reduction: {effort_reduction}%")
 
     # Calculate potential page reduction
-    matching_blocks = sum(len(matches) for matches in common_elements["text_blocks"].values())
+    matching_blocks = count_reusable_blocks(common_elements)
     estimated_pages_after_reduction = calculate_page_reduction(total_blocks, matching_blocks, total_pages)
     print(f"Estimated pages after rationalization: {estimated_pages_after_reduction} (from {total_pages})")
 
@@ -224,16 +2041,258 @@ def analyze_all_vs_all(all_pdf_folder, base_output_folder):
     with open(os.path.join(output_folder, "effort_reduction_summary.txt"), "w") as summary_file:
         summary_file.write(f"Estimated effort reduction: {effort_reduction}%\n")
         summary_file.write(f"Estimated pages after rationalization: {estimated_pages_after_reduction} (from {total_pages})\n")
+        summary_file.write(f"Block comparisons ({stats['similarity_mode']} mode): {stats['compared_pairs']} of {stats['total_pairs']} "
+                           f"({stats['avoided_pairs']} avoided, {stats['avoided_percentage']}%, "
+                           f"{stats['exact_duplicate_blocks']} exact duplicate blocks)\n")
+        if "template_clusters" in common_elements:
+            summary_file.write(f"Template clusters: {report_rows} ({matching_blocks} of {total_blocks} blocks reusable)\n")
 
     print(f"Effort reduction summary saved: {output_folder}/effort_reduction_summary.txt")
+    return report_rows, effort_reduction, estimated_pages_after_reduction
+
+# Main function to process the PDF analysis and comparison. Reports and reduction estimates are
+# based on template clusters, or on every matching block pair above pair_threshold with
+# report_granularity="pairs". With pairs_floor and a results store, the scored pairs down to that floor
+# are saved with the run for rethreshold_stored_run. The wall time, CPU time, peak RSS and item counts of every stage go to run_manifest.json in the
+# report folder; returns that folder.
+def analyze_all_vs_all(all_pdf_folder, base_output_folder, similarity_mode="sparse",
+                       lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS, shingle_size=LSH_SHINGLE_SIZE,
+                       cache_dir=None, cache_max_bytes=EXTRACTION_CACHE_MAX_BYTES, results_db=None,
+                       report_granularity="clusters", cluster_threshold=CLUSTER_SIMILARITY_THRESHOLD,
+                       extraction_mode=DEFAULT_EXTRACTION_MODE, similarity_workers=None,
+                       memory_budget=SIMILARITY_MEMORY_BUDGET, worker_limits=EXTRACTION_WORKER_LIMITS,
+                       pair_threshold=SIMILARITY_THRESHOLD, pairs_floor=None):
+    threshold = cluster_threshold if report_granularity == "clusters" else pair_threshold
+    if pairs_floor is not None:
+        pairs_floor = min(pairs_floor, threshold)
+    run_metrics = start_run_metrics("all_vs_all", {"similarity_mode": similarity_mode, "threshold": threshold,
+                                                   "pairs_floor": pairs_floor,
+                                                   "lsh_bands": lsh_bands, "lsh_rows": lsh_rows, "shingle_size": shingle_size,
+                                                   "cache": bool(cache_dir), "report_granularity": report_granularity,
+                                                   "extraction_mode": extraction_mode,
+                                                   "similarity_workers": similarity_workers, "memory_budget": memory_budget,
+                                                   "worker_limits": worker_limits})
+    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
+
+    extraction_times = {}
+    with measure_stage(run_metrics, "extraction") as stage:
+        block_store, content_hashes = extract_pdf_reports(all_pdf_files, base_output_folder, cache_dir, cache_max_bytes,
+                                                          extraction_times=extraction_times, extraction_mode=extraction_mode,
+                                                          worker_limits=worker_limits)
+        stage.update(pdfs=len(all_pdf_files), extracted_pdfs=len(extraction_times),
+                     cached_pdfs=len(block_store["pdf_names"]) - len(extraction_times),
+                     pages=sum(block_store["page_counts"]), blocks=len(block_store["block_texts"]),
+                     distinct_blocks=len(block_store["text_ends"]), text_buffer_bytes=len(block_store["text_buffer"]))
+
+    if not block_store["pdf_names"]:
+        print("No valid PDF files found in the allpdf folder.")
+        return
+
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_report_{current_time}")
+    os.makedirs(output_folder, exist_ok=True)
+
+    total_pages = sum(block_store["page_counts"])
+    compare = find_template_clusters if report_granularity == "clusters" else compare_all_pdfs
+    common_elements = compare(block_store, threshold, similarity_mode=similarity_mode,
+                              lsh_bands=lsh_bands, lsh_rows=lsh_rows, shingle_size=shingle_size,
+                              run_metrics=run_metrics, similarity_workers=similarity_workers, memory_budget=memory_budget,
+                              pairs_floor=pairs_floor)
+    total_blocks = len(block_store["block_texts"])
+    stats = common_elements["comparison_stats"]
+    print(f"Compared {stats['compared_pairs']} of {stats['total_pairs']} block pairs ({stats['similarity_mode']} mode, "
+          f"{stats['avoided_pairs']} comparisons avoided, {stats['avoided_percentage']}%, "
+          f"{stats['exact_duplicate_blocks']} exact duplicate blocks)")
+
+    report_rows, effort_reduction, estimated_pages_after_reduction = write_analysis_reports(
+        common_elements, output_folder, total_blocks, total_pages, run_metrics)
+
+    run_stats = dict(stats, total_blocks=total_blocks, total_pages=total_pages, effort_reduction=effort_reduction,
+                     estimated_pages_after_reduction=estimated_pages_after_reduction,
+                     report_granularity=report_granularity, report_rows=report_rows, pairs_floor=pairs_floor)
+    if results_db:
+        with measure_stage(run_metrics, "results_store") as stage:
+            store_run_results(results_db, "all_vs_all", output_folder, similarity_mode, threshold, run_stats,
+                              block_store, {None: common_elements},
+                              content_hashes={os.path.basename(path): content_hash for path, content_hash in content_hashes.items()})
+            stage["rows"] = report_rows
+
+    write_run_manifest(run_metrics, output_folder, extraction_times, results=run_stats)
+    return output_folder
+
+# Main function of the streaming mode: finds template clusters with stream_template_clusters, so the
+# working set does not grow with the corpus text, and writes the same reports, summary, results store
+# entry and run manifest as analyze_all_vs_all. Returns the report folder.
+def analyze_all_vs_all_streaming(all_pdf_folder, base_output_folder, cluster_threshold=CLUSTER_SIMILARITY_THRESHOLD,
+                                 shard_rows=STREAM_SHARD_ROWS, results_db=None, worker_limits=EXTRACTION_WORKER_LIMITS):
+    run_metrics = start_run_metrics("all_vs_all", {"similarity_mode": "streaming", "threshold": cluster_threshold,
+                                                   "shard_rows": shard_rows, "hashing_features": HASHING_FEATURES,
+                                                   "report_granularity": "clusters", "worker_limits": worker_limits})
+    all_pdf_files = [os.path.join(all_pdf_folder, f) for f in os.listdir(all_pdf_folder) if f.lower().endswith('.pdf')]
+
+    current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    output_folder = os.path.join(base_output_folder, f"pdf_rationalization_report_{current_time}")
+    os.makedirs(output_folder, exist_ok=True)
+    shard_dir = os.path.join(output_folder, "stream_shards")
+
+    extraction_times = {}
+    try:
+        common_elements = stream_template_clusters(all_pdf_files, base_output_folder, shard_dir, cluster_threshold,
+                                                   shard_rows=shard_rows, run_metrics=run_metrics, extraction_times=extraction_times,
+                                                   worker_limits=worker_limits)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    if not common_elements["pdf_page_counts"]:
+        print("No valid PDF files found in the allpdf folder.")
+        return
+
+    total_pages = sum(common_elements["pdf_page_counts"].values())
+    total_blocks = common_elements["total_blocks"]
+    stats = common_elements["comparison_stats"]
+    print(f"Compared {stats['compared_pairs']} of {stats['total_pairs']} block pairs ({stats['similarity_mode']} mode, "
+          f"{stats['avoided_pairs']} comparisons avoided, {stats['avoided_percentage']}%, "
+          f"{stats['exact_duplicate_blocks']} exact duplicate blocks)")
+    report_rows, effort_reduction, estimated_pages_after_reduction = write_analysis_reports(
+        common_elements, output_folder, total_blocks, total_pages, run_metrics)
+
+    run_stats = dict(stats, total_blocks=total_blocks, total_pages=total_pages, effort_reduction=effort_reduction,
+                     estimated_pages_after_reduction=estimated_pages_after_reduction,
+                     report_granularity="clusters", report_rows=report_rows)
+    if results_db:
+        with measure_stage(run_metrics, "results_store") as stage:
+            pdf_reports = {pdf_name: {"page_count": page_count} for pdf_name, page_count in common_elements["pdf_page_counts"].items()}
+            store_run_results(results_db, "all_vs_all", output_folder, "streaming", cluster_threshold, run_stats,
+                              pdf_reports, {None: common_elements})
+            stage["rows"] = report_rows
+
+    write_run_manifest(run_metrics, output_folder, extraction_times, results=run_stats)
+    return output_folder
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find reusable text blocks across all PDFs in the allpdf folder.")
+    parser.add_argument("--similarity-mode", choices=["sparse", "lsh"], default="sparse",
+                        help="sparse compares every block pair; lsh only scores MinHash/LSH candidate pairs")
+    parser.add_argument("--similarity-workers", type=int,
+                        help="processes for the sparse similarity search (default: CPU count; 1 scores in this process)")
+    parser.add_argument("--memory-budget-mb", type=int, default=SIMILARITY_MEMORY_BUDGET // 1024 ** 2,
+                        help="memory the sparse similarity search may use; sets the size of the row tiles per worker")
+    parser.add_argument("--lsh-bands", type=int, default=LSH_BANDS, help="LSH bands (more bands: higher recall)")
+    parser.add_argument("--lsh-rows", type=int, default=LSH_ROWS, help="rows per LSH band (more rows: higher precision)")
+    parser.add_argument("--shingle-size", type=int, default=LSH_SHINGLE_SIZE, help="words per MinHash shingle")
+    parser.add_argument("--cache-dir", help="extraction cache folder (default: extraction_cache next to this script)")
+    parser.add_argument("--cache-max-mb", type=int, default=EXTRACTION_CACHE_MAX_BYTES // 1024 ** 2,
+                        help="evict least recently used cache entries beyond this size")
+    parser.add_argument("--no-cache", action="store_true", help="always extract PDFs with PyMuPDF")
+    parser.add_argument("--extraction-mode", choices=EXTRACTION_MODES, default=DEFAULT_EXTRACTION_MODE,
+                        help="PyMuPDF text extraction: block-level text (faster), the span dictionary (default), or blocks with bounding boxes")
+    parser.add_argument("--file-timeout", type=float, default=EXTRACTION_WORKER_LIMITS["file_seconds"],
+                        help="seconds of extraction per PDF before it is quarantined (0: no limit)")
+    parser.add_argument("--page-timeout", type=float, default=EXTRACTION_WORKER_LIMITS["page_seconds"],
+                        help="seconds per PDF page before its PDF is quarantined (0: no limit)")
+    parser.add_argument("--worker-memory-mb", type=int, default=EXTRACTION_WORKER_LIMITS["memory_bytes"] // 1024 ** 2,
+                        help="resident memory per extraction worker before its PDF is quarantined (0: no limit)")
+    parser.add_argument("--retry-quarantined", action="store_true", help="clear the quarantine list and extract those PDFs again")
+    parser.add_argument("--invalidate-cache", nargs="*", metavar="PDF",
+                        help="remove cached extractions of the given PDFs (all entries if none given) and exit")
+    parser.add_argument("--results-db", help="SQLite results store (default: result/results.sqlite next to this script)")
+    parser.add_argument("--no-results-db", action="store_true", help="do not save the run to the results store")
+    parser.add_argument("--list-runs", action="store_true", help="list the runs in the results store and exit")
+    parser.add_argument("--query-block", metavar="TEXT", help="show which PDFs contain or match a block in a stored run and exit")
+    parser.add_argument("--run", type=int, help="stored run for --query-block (default: the latest run)")
+    parser.add_argument("--compare-runs", nargs=2, type=int, metavar=("OLD", "NEW"), help="compare the matches of two stored runs and exit")
+    parser.add_argument("--render-run", type=int, metavar="RUN", help="render the HTML and Excel reports of a stored run and exit")
+    parser.add_argument("--report-granularity", choices=["clusters", "pairs"], default="clusters",
+                        help="report one row per template cluster, or one row per matching block pair")
+    parser.add_argument("--cluster-threshold", type=float, default=CLUSTER_SIMILARITY_THRESHOLD,
+                        help="cosine similarity that links two blocks into the same template cluster")
+    parser.add_argument("--threshold", type=float, default=SIMILARITY_THRESHOLD,
+                        help="cosine similarity above which two blocks are reported as a match (pairs granularity)")
+    parser.add_argument("--pairs-floor", type=float, nargs="?", const=SCORED_PAIRS_FLOOR,
+                        help="also save the scored pairs down to this similarity (default %(const)s) with the run, "
+                             "so it can be reported at higher thresholds with --report-run")
+    parser.add_argument("--report-run", type=int, metavar="RUN",
+                        help="report a stored run saved with --pairs-floor again at --thresholds and exit")
+    parser.add_argument("--thresholds", type=float, nargs="+", metavar="T",
+                        help="similarity thresholds to report a run at with --report-run")
+    parser.add_argument("--streaming", action="store_true",
+                        help="bounded-memory mode: hash blocks into on-disk shards and report template clusters")
+    parser.add_argument("--shard-rows", type=int, default=STREAM_SHARD_ROWS, help="block rows per on-disk shard in streaming mode")
+    parser.add_argument("--profile", action="store_true",
+                        help="also write a cProfile dump of the main process (profile.prof) to the report folder")
+    args = parser.parse_args()
+
     base_dir = os.path.dirname(os.path.abspath(__file__))
     all_pdf_folder = os.path.join(base_dir, 'allpdf')
     base_output_folder = os.path.join(base_dir, 'result')
+    cache_dir = args.cache_dir or os.path.join(base_dir, 'extraction_cache')
+
+    if args.invalidate_cache is not None:
+        removed = invalidate_extraction_cache(cache_dir, args.invalidate_cache)
+        print(f"Removed {removed} cached extractions from {cache_dir}")
+        raise SystemExit(0)
 
     os.makedirs(base_output_folder, exist_ok=True)
+    if args.retry_quarantined and os.path.exists(os.path.join(base_output_folder, QUARANTINE_FILE_NAME)):
+        os.remove(os.path.join(base_output_folder, QUARANTINE_FILE_NAME))
+    worker_limits = {"file_seconds": args.file_timeout or None, "page_seconds": args.page_timeout or None,
+                     "memory_bytes": args.worker_memory_mb * 1024 ** 2 or None}
+
+    results_db = args.results_db or os.path.join(base_output_folder, RESULTS_DB_NAME)
+    if args.list_runs:
+        for run_id, created_at, kind, mode, run_output_folder, pdf_count, match_count in list_stored_runs(results_db):
+            print(f"Run {run_id}: {created_at} {kind} ({mode} mode), {pdf_count} PDFs, {match_count} match rows -> {run_output_folder}")
+        raise SystemExit(0)
+    if args.query_block:
+        run_id, results = query_stored_block(results_db, args.query_block, args.run)
+        print(f"Run {run_id}: {len(results)} matching blocks")
+        for result in results:
+            print(f"\n{result['text']}")
+            for pdf_name, page_number, bbox in result["occurrences"]:
+                print(f"  contained in {pdf_name}, page {page_number}" + (f", bbox {bbox}" if bbox else ""))
+            for query_name, pdf_name, similarity in result["matches"]:
+                print(f"  matched {pdf_name} ({similarity}%)" + (f" for {query_name}" if query_name else ""))
+        raise SystemExit(0)
+    if args.compare_runs:
+        print(json.dumps(compare_stored_runs(results_db, *args.compare_runs), indent=2))
+        raise SystemExit(0)
+    if args.render_run:
+        current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        render_stored_run(results_db, args.render_run, os.path.join(base_output_folder, f"pdf_rationalization_report_run{args.render_run}_{current_time}"))
+        raise SystemExit(0)
+    if args.report_run:
+        if not args.thresholds:
+            parser.error("--report-run needs --thresholds")
+        current_time = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        rethreshold_stored_run(results_db, args.report_run, args.thresholds,
+                               os.path.join(base_output_folder, f"pdf_rationalization_sweep_run{args.report_run}_{current_time}"))
+        raise SystemExit(0)
 
     print("Starting analysis...")
-    analyze_all_vs_all(all_pdf_folder, base_output_folder)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    if args.streaming:
+        if args.similarity_mode != "sparse" or args.report_granularity != "clusters":
+            print("Streaming mode compares every distinct block pair and reports template clusters; "
+                  "--similarity-mode and --report-granularity are ignored.")
+        if args.extraction_mode != DEFAULT_EXTRACTION_MODE:
+            print(f"Streaming mode always uses the {DEFAULT_EXTRACTION_MODE} extraction mode; --extraction-mode is ignored.")
+        if args.pairs_floor is not None:
+            print("Streaming mode does not keep scored pairs; --pairs-floor is ignored.")
+        output_folder = analyze_all_vs_all_streaming(all_pdf_folder, base_output_folder, args.cluster_threshold, args.shard_rows,
+                                                     None if args.no_results_db else results_db, worker_limits)
+    else:
+        output_folder = analyze_all_vs_all(all_pdf_folder, base_output_folder, args.similarity_mode,
+                                           args.lsh_bands, args.lsh_rows, args.shingle_size,
+                                           None if args.no_cache else cache_dir, args.cache_max_mb * 1024 ** 2,
+                                           None if args.no_results_db else results_db, args.report_granularity,
+                                           args.cluster_threshold, args.extraction_mode,
+                                           args.similarity_workers, args.memory_budget_mb * 1024 ** 2, worker_limits,
+                                           args.threshold, None if args.no_results_db else args.pairs_floor)
+    if profiler:
+        profiler.disable()
+        profile_path = os.path.join(output_folder or base_output_folder, "profile.prof")
+        profiler.dump_stats(profile_path)
+        print(f"cProfile dump saved: {profile_path} (inspect with python -m pstats)")
     print("Analysis complete.")
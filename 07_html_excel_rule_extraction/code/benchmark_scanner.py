@@ -0,0 +1,103 @@
+import re
+import os
+import time
+import random
+import argparse
+import tempfile
+import html2text
+from bs4 import BeautifulSoup
+from extract_rules import scan_rules_and_formulas, extract_rules_from_html_file
+
+# Pattern of the original regex extractor, kept here as the reference the scanner is checked against
+LEGACY_RULE_PATTERN = r'(R\d+|F\d+)\s+([\w_]+)\s*(.*?)\s*(?=R\d+|F\d+|\Z)'
+
+# Names and statements the synthetic reports are built from
+RULE_NAMES = ['Queue_Batch_Rule', 'Component_Setup', 'Page_Load_Check', 'Banner_Visibility', 'Document_Approval', 'Enc_Inclusion']
+STATEMENTS = ['IF(Status = "Pending") THEN', 'QueueBatch = TRUE', 'ENDIF', 'i = FileMap("Ref", LOCATION, True)',
+              'dim i as integer', 'SYS_CurrentProfile = ""']
+
+def legacy_scan(content):
+    """Finds rules with the original backtracking regex."""
+    return re.findall(LEGACY_RULE_PATTERN, content, re.DOTALL)
+
+def legacy_parse_html_in_chunks(file_path):
+    """Converts every pre/div/em block, nested ones included, like the original extractor."""
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+        soup = BeautifulSoup(file, 'lxml')
+    for block in soup.find_all(['pre', 'div', 'em']):
+        yield html2text.html2text(str(block))
+
+def legacy_extract_rules_from_html_file(input_file):
+    """Runs the original extraction pipeline (all blocks, legacy regex) on one file."""
+    extracted_data = []
+    for chunk in legacy_parse_html_in_chunks(input_file):
+        for rule_id, rule_name, formula_content in legacy_scan(chunk):
+            extracted_data.append((rule_id, rule_name, formula_content))
+    return extracted_data
+
+def synthetic_text(target_bytes, indent, seed=0):
+    """Builds html2text-like report text of about target_bytes with the given formula indentation."""
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    number = 0
+    while size < target_bytes:
+        number += 1
+        kind = rng.choice('RF')
+        lines = '\n'.join(' ' * indent + rng.choice(STATEMENTS) for _ in range(rng.randint(3, 12)))
+        part = f"**{kind}{number} {rng.choice(RULE_NAMES)}_{number}**\n\n_Formula:_\n\n{lines}\n\n" + ' ' * indent + '\n\n* * *\n\n'
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)
+
+def synthetic_html(file_path, rules, seed=0):
+    """Writes a synthetic application report with one div block per rule."""
+    rng = random.Random(seed)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('<html><body><p align="center"><big>Application Report</big></p>\n')
+        for number in range(1, rules + 1):
+            kind = rng.choice('RF')
+            formula = '\n'.join('        ' + rng.choice(STATEMENTS) for _ in range(rng.randint(3, 12)))
+            f.write(f'<div align="left"><a name="#Rule{number}" /><strong>{kind}{number} <font color="#0000FF">'
+                    f'{rng.choice(RULE_NAMES)}_{number}</font></strong><br /><br /><em>Formula:</em>\n'
+                    f'<pre>\n{formula}\n        </pre></div>\n<hr />\n')
+        f.write('</body></html>\n')
+
+def time_call(function, *args):
+    """Returns the result of a call and the seconds it took."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark_scanner(sizes_mb, indents):
+    """Compares the scanner with the legacy regex on synthetic text and prints the throughput."""
+    print(f"{'size MB':>8} {'indent':>6} {'rules':>8} {'regex s':>9} {'regex MB/s':>10} {'scan s':>8} {'scan MB/s':>9} {'same':>5}")
+    for indent in indents:
+        for size_mb in sizes_mb:
+            content = synthetic_text(int(size_mb * 1024 ** 2), indent)
+            legacy, legacy_seconds = time_call(legacy_scan, content)
+            scanned, scan_seconds = time_call(scan_rules_and_formulas, content)
+            megabytes = len(content) / 1024 ** 2
+            print(f"{megabytes:>8.1f} {indent:>6} {len(scanned):>8} {legacy_seconds:>9.3f} {megabytes / legacy_seconds:>10.1f} "
+                  f"{scan_seconds:>8.3f} {megabytes / scan_seconds:>9.1f} {str(legacy == scanned):>5}")
+
+def benchmark_files(rule_counts):
+    """Compares the whole legacy and current per-file pipelines on synthetic HTML reports."""
+    print(f"\n{'rules':>8} {'file MB':>8} {'legacy s':>9} {'legacy rows':>11} {'current s':>9} {'current rows':>12}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for rules in rule_counts:
+            file_path = os.path.join(temp_dir, f"report_{rules}.html")
+            synthetic_html(file_path, rules)
+            legacy, legacy_seconds = time_call(legacy_extract_rules_from_html_file, file_path)
+            current, current_seconds = time_call(extract_rules_from_html_file, file_path)
+            print(f"{rules:>8} {os.path.getsize(file_path) / 1024 ** 2:>8.1f} {legacy_seconds:>9.2f} {len(legacy):>11} "
+                  f"{current_seconds:>9.2f} {len(current):>12}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the linear rule scanner against the legacy regex.")
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 2, 4, 8], help="synthetic text sizes")
+    parser.add_argument('--indents', type=int, nargs='+', default=[8, 200], help="formula indentation (whitespace run length)")
+    parser.add_argument('--rules', type=int, nargs='+', default=[1000, 5000], help="rules per synthetic HTML report")
+    args = parser.parse_args()
+    benchmark_scanner(args.sizes_mb, args.indents)
+    benchmark_files(args.rules)
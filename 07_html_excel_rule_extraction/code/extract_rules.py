@@ -1,5 +1,6 @@
 import re
 import os
+from bisect import bisect_left
 import pandas as pd
 from bs4 import BeautifulSoup
 import html2text
@@ -15,27 +16,77 @@ CATEGORY_MAPPING = {
     'document': 'Document Management',
 }
 
+# Tags whose content is converted to text and scanned for rules
+CONTENT_TAGS = ['pre', 'div', 'em']
+
+# A rule or function identifier starts with R or F followed by a digit
+MARKER_PATTERN = re.compile(r'[RF]\d')
+
 def parse_html_in_chunks(file_path):
     """Reads large HTML files in manageable chunks."""
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
             soup = BeautifulSoup(file, 'lxml')
 
-        # Extract only relevant tags to reduce noise
-        content_blocks = soup.find_all(['pre', 'div', 'em'])
+        # Extract only relevant tags to reduce noise; blocks nested in another content block are
+        # already part of the outer block's text, so they are not converted and scanned again
+        content_blocks = soup.find_all(CONTENT_TAGS)
         for block in content_blocks:
-            yield html2text.html2text(str(block))
+            if block.find_parent(CONTENT_TAGS) is None:
+                yield html2text.html2text(str(block))
     except Exception as e:
         print(f"Error parsing {file_path}: {e}")
         return []
 
+def skip_while(content, position, predicate):
+    """Returns the first position at or after position whose character fails predicate."""
+    end = len(content)
+    while position < end and predicate(content[position]):
+        position += 1
+    return position
+
+def is_word_char(char):
+    r"""Matches a regex word character (\w)."""
+    return char.isalnum() or char == '_'
+
+def scan_rules_and_formulas(content):
+    r"""Finds (rule ID, rule name, formula content) triples in one linear pass.
+
+    Gives the same triples as re.findall(r'(R\d+|F\d+)\s+([\w_]+)\s*(.*?)\s*(?=R\d+|F\d+|\Z)',
+    content, re.DOTALL): an identifier is R or F, digits, whitespace and a word, and its formula
+    content runs to the next R/F followed by a digit (anywhere, even inside a word) or the end,
+    without the whitespace around it. Every candidate position is looked at once, so the cost
+    grows linearly with the content instead of backtracking over whitespace runs.
+    """
+    markers = [match.start() for match in MARKER_PATTERN.finditer(content)]
+    matches = []
+    position = 0
+    index = 0
+    while index < len(markers):
+        start = markers[index]
+        index += 1
+        if start < position:
+            continue
+        digits_end = skip_while(content, start + 1, str.isdecimal)
+        name_start = skip_while(content, digits_end, str.isspace)
+        name_end = skip_while(content, name_start, is_word_char)
+        if name_start == digits_end or name_end == name_start:
+            continue
+
+        formula_start = skip_while(content, name_end, str.isspace)
+        index = bisect_left(markers, formula_start, index)
+        next_rule = markers[index] if index < len(markers) else len(content)
+        formula_end = next_rule
+        while formula_end > formula_start and content[formula_end - 1].isspace():
+            formula_end -= 1
+        matches.append((content[start:digits_end], content[name_start:name_end], content[formula_start:formula_end]))
+        position = next_rule
+    return matches
+
 def extract_rules_and_formulas(content):
     """Extracts all rules and formulas between rule identifiers."""
-    rule_pattern = r'(R\d+|F\d+)\s+([\w_]+)\s*(.*?)\s*(?=R\d+|F\d+|\Z)'
-    matches = re.findall(rule_pattern, content, re.DOTALL)
-
     extracted_data = []
-    for rule_id, rule_name, formula_content in matches:
+    for rule_id, rule_name, formula_content in scan_rules_and_formulas(content):
         formula = extract_formula(formula_content)
         category = categorize_rule(rule_name)
         extracted_data.append({
@@ -47,9 +98,9 @@ def extract_rules_and_formulas(content):
     return extracted_data
 
 def extract_formula(content):
-    """Extracts the formula section from a block."""
-    match = re.search(r'Formula:\s*(.*?)\s*$', content, re.DOTALL)
-    return match.group(1).strip() if match else 'N/A'
+    """Extracts the formula section from a block: everything after the first 'Formula:', stripped."""
+    start = content.find('Formula:')
+    return content[start + len('Formula:'):].strip() if start != -1 else 'N/A'
 
 def categorize_rule(rule_name):
     """Categorizes rules based on keywords in their names."""
@@ -0,0 +1,129 @@
+import argparse
+import logging
+from bs4 import BeautifulSoup
+import openpyxl
+from openpyxl.utils import get_column_letter
+from openpyxl.styles import Alignment, Font
+
+from extract_rules import (PARSERS, detect_encoding, extract_files, find_html_files, iter_rule_elements, use_iterparse,
+                           parse_rule, parse_rule_element)
+from extract_functions import extract_function, extract_function_element
+
+# Block types collected from the div.rule blocks of a report, one workbook sheet each. Every type
+# has a parser for BeautifulSoup tags and one for lxml elements (iterparse mode) that return a row
+# or None; formula_column is the 1-based column shown wrapped in a monospace font. Add an entry
+# here to collect a new block type in the same pass.
+BLOCK_TYPES = [
+    {
+        'name': 'rules',
+        'sheet': 'Rules',
+        'header': ['Rule ID', 'Rule Name', 'Formula', 'Category'],
+        'parse_tag': parse_rule,
+        'parse_element': parse_rule_element,
+        'formula_column': 3,
+    },
+    {
+        'name': 'functions',
+        'sheet': 'Functions',
+        'header': ['Function Name', 'Formula'],
+        'parse_tag': extract_function,
+        'parse_element': extract_function_element,
+        'formula_column': 2,
+    },
+]
+
+def iter_blocks(file_path, encoding, parser):
+    """Yield the div.rule blocks of a file and the name of the parser function for them."""
+    if use_iterparse(file_path, parser):
+        for element in iter_rule_elements(file_path, encoding):
+            yield element, 'parse_element'
+        return
+    with open(file_path, 'r', encoding=encoding, errors='ignore') as f:
+        soup = BeautifulSoup(f, 'html.parser')
+    for tag in soup.find_all('div', class_='rule'):
+        yield tag, 'parse_tag'
+
+def extract_blocks(file_path, parser='auto'):
+    """Extract every block type from one HTML file in a single parse; returns rows per block type name.
+
+    An error in one block type stops that type for the rest of the file, as it would stop
+    extract_rules or extract_functions, while the other types keep collecting. Returns None
+    if the file itself could not be read or parsed, so callers can tell it from a file without blocks.
+    """
+    encoding = detect_encoding(file_path)
+    results = empty_blocks()
+    active_types = list(BLOCK_TYPES)
+    try:
+        for block, parse in iter_blocks(file_path, encoding, parser):
+            for block_type in list(active_types):
+                try:
+                    row = block_type[parse](block)
+                except Exception as e:
+                    logging.error(f"Error extracting {block_type['name']} from {file_path}: {e}")
+                    active_types.remove(block_type)
+                    continue
+                if row:
+                    results[block_type['name']].append(row)
+            if not active_types:
+                break
+    except Exception as e:
+        logging.error(f"Error extracting blocks from {file_path}: {e}")
+        return None
+    return results
+
+def empty_blocks():
+    """Return the result of a file without any blocks: an empty row list per block type name."""
+    return {block_type['name']: [] for block_type in BLOCK_TYPES}
+
+def write_to_excel(rows_by_type, output_file):
+    """Write one sheet per block type that has rows to a single Excel workbook."""
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for block_type in BLOCK_TYPES:
+        rows = rows_by_type[block_type['name']]
+        if not rows:
+            continue
+        sheet = workbook.create_sheet(block_type['sheet'])
+        sheet.append(block_type['header'])
+        formula_column = block_type['formula_column']
+        for row_number, row in enumerate(rows, start=2):
+            sheet.append(row)
+            sheet.cell(row_number, formula_column).alignment = Alignment(wrap_text=True)
+            sheet.cell(row_number, formula_column).font = Font(name='Courier New')
+
+        for col in range(1, len(block_type['header']) + 1):
+            sheet.column_dimensions[get_column_letter(col)].width = 50
+
+    workbook.save(output_file)
+    logging.info(f"Saved {', '.join(f'{len(rows)} {name}' for name, rows in rows_by_type.items())} to {output_file}")
+
+def process_all(input_dir, output_file, parser='auto', workers=None, index_db=None):
+    """Process all HTML files in the input directory into one workbook with a sheet per block type.
+
+    With index_db, the extracted rules and functions also replace those files' entries in the rule index.
+    """
+    html_files = find_html_files(input_dir)
+    results = extract_files(html_files, extract_blocks, None, parser, workers)
+    if index_db:
+        from rule_index import index_extracted_files  # imported here since rule_index builds on this module
+        index_extracted_files(index_db, html_files, results)
+
+    all_rows = empty_blocks()
+    for file_results in filter(None, results):
+        for name, rows in file_results.items():
+            all_rows[name].extend(rows)
+
+    if any(all_rows.values()):
+        write_to_excel(all_rows, output_file)
+    else:
+        logging.warning("No rules or functions found.")
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Extract rules and functions from HTML application reports into one Excel workbook.")
+    arg_parser.add_argument('--input-dir', default='./input_htm', help="folder searched recursively for .html/.htm files")
+    arg_parser.add_argument('--output-file', default='./output/application_report.xlsx')
+    arg_parser.add_argument('--parser', choices=PARSERS, default='auto', help="HTML parser (auto uses lxml iterparse for large files)")
+    arg_parser.add_argument('--workers', type=int, help="worker processes (default: CPU count; 1 parses the files one after another)")
+    arg_parser.add_argument('--index-db', help="also update this rule index (see rule_index.py) with the extracted files")
+    args = arg_parser.parse_args()
+    process_all(args.input_dir, args.output_file, args.parser, args.workers, args.index_db)
@@ -1,25 +1,16 @@
-import os
+import argparse
 import logging
-import chardet
 from bs4 import BeautifulSoup
 import openpyxl
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment, Font
 
+from extract_rules import (PARSERS, detect_encoding, element_text, extract_files, find_element, find_html_files,
+                           iter_rule_elements, use_iterparse)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def detect_encoding(file_path):
-    """Detect encoding using chardet."""
-    try:
-        with open(file_path, 'rb') as f:
-            raw_data = f.read(1024 * 1024)  # Read 1MB for encoding detection
-            result = chardet.detect(raw_data)
-            return result.get('encoding', 'utf-8')
-    except Exception as e:
-        logging.error(f"Error detecting encoding: {e}")
-        return 'utf-8'
-
 def extract_function(tag):
     """Extract function name and formula."""
     header = tag.find('h3')
@@ -29,11 +20,26 @@ def extract_function(tag):
         return (func_name, formula)
     return None
 
-def extract_functions(file_path):
-    """Extract functions from HTML."""
+def extract_function_element(element):
+    """Extract function name and formula from an lxml element (iterparse mode)."""
+    header = find_element(element, 'h3')
+    if header is not None and element_text(header, strip=True).startswith('F'):
+        func_name = element_text(header, strip=True)
+        formula = element_text(find_element(element, 'div', 'formula'), '\n')
+        return (func_name, formula)
+    return None
+
+def extract_functions(file_path, parser='auto'):
+    """Extract functions from HTML; parser is 'soup', 'iterparse' (lxml, bounded memory) or 'auto' (iterparse for large files)."""
     encoding = detect_encoding(file_path)
     functions = []
     try:
+        if use_iterparse(file_path, parser):
+            for element in iter_rule_elements(file_path, encoding):
+                func_data = extract_function_element(element)
+                if func_data:
+                    functions.append(func_data)
+            return functions
         with open(file_path, 'r', encoding=encoding, errors='ignore') as f:
             soup = BeautifulSoup(f, 'html.parser')
             tags = soup.find_all('div', class_='rule')
@@ -63,16 +69,11 @@ def write_to_excel(data, output_file):
     workbook.save(output_file)
     logging.info(f"Saved functions report to {output_file}")
 
-def process_functions(input_dir, output_file):
-    """Process all HTML files in the input directory."""
+def process_functions(input_dir, output_file, parser='auto', workers=None):
+    """Process all HTML files in the input directory; workers sets the process pool size (default: CPU count, 1 runs sequentially)."""
     all_functions = []
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith(('.html', '.htm')):
-                file_path = os.path.join(root, file)
-                logging.info(f"Processing {file_path}")
-                functions = extract_functions(file_path)
-                all_functions.extend(functions)
+    for functions in extract_files(find_html_files(input_dir), extract_functions, [], parser, workers):
+        all_functions.extend(functions)
 
     if all_functions:
         write_to_excel(all_functions, output_file)
@@ -80,6 +81,10 @@ def process_functions(input_dir, output_file):
         logging.warning("No functions found.")
 
 if __name__ == "__main__":
-    input_dir = './input_htm'
-    output_file = './output/functions_report.xlsx'
-    process_functions(input_dir, output_file)
+    arg_parser = argparse.ArgumentParser(description="Extract functions from HTML application reports into an Excel workbook.")
+    arg_parser.add_argument('--input-dir', default='./input_htm', help="folder searched recursively for .html/.htm files")
+    arg_parser.add_argument('--output-file', default='./output/functions_report.xlsx')
+    arg_parser.add_argument('--parser', choices=PARSERS, default='auto', help="HTML parser (auto uses lxml iterparse for large files)")
+    arg_parser.add_argument('--workers', type=int, help="worker processes (default: CPU count; 1 parses the files one after another)")
+    args = arg_parser.parse_args()
+    process_functions(args.input_dir, args.output_file, args.parser, args.workers)
@@ -1,4 +1,7 @@
 import os
+import argparse
+import time
+import concurrent.futures
 import re
 import logging
 import chardet
@@ -7,9 +10,88 @@ import openpyxl
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment, Font
 
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional; without it every file is parsed with BeautifulSoup
+    etree = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Files at least this large are parsed incrementally when parser="auto" and lxml is installed
+ITERPARSE_MIN_BYTES = 64 * 1024 * 1024
+# Parser options of the rule and function extractors
+PARSERS = ('auto', 'soup', 'iterparse')
+# Characters fed to the incremental parser per read
+ITERPARSE_CHUNK_CHARS = 1024 * 1024
+
+def has_class(element, class_name):
+    """Check an lxml element's class attribute the way BeautifulSoup matches class_."""
+    return class_name in (element.get('class') or '').split()
+
+def find_element(element, tag, class_name=None):
+    """Return the first descendant with the given tag (and class), like BeautifulSoup's find."""
+    for descendant in element.iterdescendants(tag):
+        if class_name is None or has_class(descendant, class_name):
+            return descendant
+    return None
+
+def element_text(element, separator='', strip=False):
+    """Join the text of an lxml element like BeautifulSoup's get_text (comments are skipped)."""
+    strings = (text.strip() for text in element.itertext()) if strip else element.itertext()
+    return separator.join(text for text in strings if text)
+
+def iter_html_events(file_path, encoding):
+    """Feed an HTML file to lxml's event parser in chunks and yield its (event, element) pairs."""
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    with open(file_path, 'r', encoding=encoding, errors='ignore') as f:
+        for chunk in iter(lambda: f.read(ITERPARSE_CHUNK_CHARS), ''):
+            parser.feed(chunk)
+            yield from parser.read_events()
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        return  # an empty document has no root element
+    # Closing ends the elements still open at the end of a truncated file
+    yield from parser.read_events()
+
+def iter_rule_elements(file_path, encoding):
+    """Yield each div.rule of an HTML file as soon as it is closed, with lxml's event parser.
+
+    The file is decoded exactly like the BeautifulSoup path. Once a rule block has been
+    handled, it and everything parsed before it is removed from the tree, so memory stays
+    bounded by the largest block. Nested rule blocks are yielded in document order, as
+    find_all would return them.
+    """
+    open_rules = []
+    closed_rules = []
+    for event, element in iter_html_events(file_path, encoding):
+        is_rule = element.tag == 'div' and has_class(element, 'rule')
+        if event == 'start':
+            if is_rule:
+                open_rules.append(len(closed_rules) + len(open_rules))
+            continue
+        if is_rule:
+            closed_rules.append((open_rules.pop(), element))
+        if open_rules:
+            continue
+        for _, rule in sorted(closed_rules, key=lambda item: item[0]):
+            yield rule
+        closed_rules = []
+        # Free the finished subtree and the already handled siblings before it
+        element.clear()
+        parent = element.getparent()
+        while parent is not None and element.getprevious() is not None:
+            del parent[0]
+
+def use_iterparse(file_path, parser):
+    """Resolve the parser option of a file to True for lxml iterparse, False for BeautifulSoup."""
+    if parser == 'auto':
+        return etree is not None and os.path.getsize(file_path) >= ITERPARSE_MIN_BYTES
+    if parser == 'iterparse' and etree is None:
+        raise ImportError("parser='iterparse' requires lxml (pip install lxml)")
+    return parser == 'iterparse'
+
 def detect_encoding(file_path):
     """Detect encoding using chardet."""
     try:
@@ -31,6 +113,16 @@ def parse_rule(tag):
         return (rule_id, rule_name, formula, category)
     return None
 
+def parse_rule_element(element):
+    """Extract rule ID, name, and formula from an lxml element (iterparse mode)."""
+    header = find_element(element, 'h3')
+    if header is not None and element_text(header, strip=True).startswith('R'):
+        rule_id, rule_name = parse_rule_name(element_text(header, strip=True))
+        formula = element_text(find_element(element, 'div', 'formula'), '\n')
+        category = categorize_rule(rule_name)
+        return (rule_id, rule_name, formula, category)
+    return None
+
 def parse_rule_name(text):
     """Extract rule ID and name from the text."""
     match = re.match(r"(R\d+)\s*(.*)", text)
@@ -52,11 +144,17 @@ def categorize_rule(rule_name):
             return category
     return "Uncategorized"
 
-def extract_rules(file_path):
-    """Extract rules from HTML files."""
+def extract_rules(file_path, parser='auto'):
+    """Extract rules from HTML files; parser is 'soup', 'iterparse' (lxml, bounded memory) or 'auto' (iterparse for large files)."""
     encoding = detect_encoding(file_path)
     rules = []
     try:
+        if use_iterparse(file_path, parser):
+            for element in iter_rule_elements(file_path, encoding):
+                rule_data = parse_rule_element(element)
+                if rule_data:
+                    rules.append(rule_data)
+            return rules
         with open(file_path, 'r', encoding=encoding, errors='ignore') as f:
             soup = BeautifulSoup(f, 'html.parser')
             tags = soup.find_all('div', class_='rule')
@@ -86,16 +184,73 @@ def write_to_excel(data, output_file):
     workbook.save(output_file)
     logging.info(f"Saved rules report to {output_file}")
 
-def process_rules(input_dir, output_file):
-    """Process all HTML files in the input directory."""
-    all_rules = []
-    for root, _, files in os.walk(input_dir):
-        for file in files:
+def find_html_files(input_dir):
+    """List the HTML files under the input directory in a stable (sorted walk) order."""
+    html_files = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for file in sorted(files):
             if file.endswith(('.html', '.htm')):
-                file_path = os.path.join(root, file)
-                logging.info(f"Processing {file_path}")
-                rules = extract_rules(file_path)
-                all_rules.extend(rules)
+                html_files.append(os.path.join(root, file))
+    return html_files
+
+def describe_result(result):
+    """Summarize the rows extracted from one file for the progress log: a row count, or one per block type."""
+    if result is None:
+        return "failed"
+    if isinstance(result, dict):
+        return ", ".join(f"{len(rows)} {name}" for name, rows in result.items())
+    return f"{len(result)} rows"
+
+def extract_files(html_files, extract_function, empty_result, parser='auto', workers=None):
+    """Run extract_function(file_path, parser) on every file, largest files first on a process pool; returns results in file order.
+
+    extract_function logs its own errors; a file whose worker died (e.g. out of memory) gets empty_result.
+    workers sets the pool size (default: CPU count; 1 runs the files one after another in this process).
+    """
+    sizes = {file_path: os.path.getsize(file_path) for file_path in html_files}
+    total_bytes = sum(sizes.values())
+    workers = min(workers or os.cpu_count() or 1, max(len(html_files), 1))
+    results = {}
+    done_bytes = 0
+    start = time.perf_counter()
+
+    def log_progress(file_path):
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        logging.info(f"[{len(results)}/{len(html_files)}] {file_path}: {describe_result(results[file_path])} "
+                     f"({done_bytes / max(total_bytes, 1):.0%} of {total_bytes / 1024 ** 2:.1f} MB, {done_bytes / 1024 ** 2 / elapsed:.1f} MB/s)")
+
+    if workers == 1:
+        for file_path in html_files:
+            results[file_path] = extract_function(file_path, parser)
+            done_bytes += sizes[file_path]
+            log_progress(file_path)
+    else:
+        logging.info(f"Processing {len(html_files)} files ({total_bytes / 1024 ** 2:.1f} MB) with {workers} worker processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(extract_function, file_path, parser): file_path
+                       for file_path in sorted(html_files, key=sizes.get, reverse=True)}
+            for future in concurrent.futures.as_completed(futures):
+                file_path = futures[future]
+                try:
+                    results[file_path] = future.result()
+                except Exception as e:
+                    logging.error(f"Error extracting {file_path}: {e}")
+                    results[file_path] = empty_result
+                done_bytes += sizes[file_path]
+                log_progress(file_path)
+
+    elapsed = time.perf_counter() - start
+    if html_files:
+        logging.info(f"Processed {len(html_files)} files ({total_bytes / 1024 ** 2:.1f} MB) in {elapsed:.1f}s: "
+                     f"{len(html_files) / max(elapsed, 1e-9):.2f} files/s, {total_bytes / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s")
+    return [results[file_path] for file_path in html_files]
+
+def process_rules(input_dir, output_file, parser='auto', workers=None):
+    """Process all HTML files in the input directory; workers sets the process pool size (default: CPU count, 1 runs sequentially)."""
+    all_rules = []
+    for rules in extract_files(find_html_files(input_dir), extract_rules, [], parser, workers):
+        all_rules.extend(rules)
 
     if all_rules:
         write_to_excel(all_rules, output_file)
@@ -103,6 +258,10 @@ def process_rules(input_dir, output_file):
         logging.warning("No rules found.")
 
 if __name__ == "__main__":
-    input_dir = './input_htm'
-    output_file = './output/rules_report.xlsx'
-    process_rules(input_dir, output_file)
+    arg_parser = argparse.ArgumentParser(description="Extract rules from HTML application reports into an Excel workbook.")
+    arg_parser.add_argument('--input-dir', default='./input_htm', help="folder searched recursively for .html/.htm files")
+    arg_parser.add_argument('--output-file', default='./output/rules_report.xlsx')
+    arg_parser.add_argument('--parser', choices=PARSERS, default='auto', help="HTML parser (auto uses lxml iterparse for large files)")
+    arg_parser.add_argument('--workers', type=int, help="worker processes (default: CPU count; 1 parses the files one after another)")
+    args = arg_parser.parse_args()
+    process_rules(args.input_dir, args.output_file, args.parser, args.workers)
@@ -0,0 +1,310 @@
+import os
+import re
+import argparse
+import hashlib
+import logging
+import sqlite3
+import time
+
+from extract_rules import PARSERS, extract_files, find_html_files
+from extract_all import extract_blocks
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Tables of the rule index. Every indexed file has its blocks (rules and functions) and every
+# block its postings: the identifiers, function calls and string literals of its formula. Terms
+# are stored lowercased, since the report language is case-insensitive.
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    indexed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    block_id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(file_id),
+    kind TEXT NOT NULL,
+    block_key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    formula TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    term TEXT NOT NULL,
+    UNIQUE (term, kind)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL REFERENCES terms(term_id),
+    block_id INTEGER NOT NULL REFERENCES blocks(block_id),
+    PRIMARY KEY (term_id, block_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS blocks_file ON blocks(file_id);
+CREATE INDEX IF NOT EXISTS blocks_name ON blocks(kind, name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS postings_block ON postings(block_id);
+"""
+
+# Term kinds of the index
+TERM_KINDS = ('identifier', 'call', 'string')
+# String literals in double quotes
+STRING_PATTERN = re.compile(r'"([^"\n]*)"')
+# Identifiers directly followed by an opening parenthesis
+CALL_PATTERN = re.compile(r'\b([A-Za-z_]\w*)\s*\(')
+# Any identifier outside string literals
+IDENTIFIER_PATTERN = re.compile(r'\b[A-Za-z_]\w*')
+# Keywords of the report formula language; they are not indexed as identifiers
+KEYWORDS = {'if', 'then', 'else', 'elseif', 'endif', 'end', 'and', 'or', 'not', 'dim', 'as', 'integer', 'string',
+            'boolean', 'true', 'false', 'for', 'to', 'next', 'do', 'while', 'loop', 'exit', 'return', 'sub', 'function'}
+
+def formula_terms(formula):
+    """Return the set of (kind, term) pairs of a formula: identifiers, function calls and string literals."""
+    terms = {('string', literal.lower()) for literal in STRING_PATTERN.findall(formula) if literal.strip()}
+    code = STRING_PATTERN.sub('""', formula)
+    terms.update(('call', name.lower()) for name in CALL_PATTERN.findall(code) if name.lower() not in KEYWORDS)
+    terms.update(('identifier', name.lower()) for name in IDENTIFIER_PATTERN.findall(code) if name.lower() not in KEYWORDS)
+    return terms
+
+def split_block_header(text):
+    """Split a rule or function header such as 'R12 Name' or 'F124Name_Fn' into its key and name."""
+    match = re.match(r"([RF]\d+)\s*(.*)", text)
+    if match:
+        return match.group(1), match.group(2)
+    return "UNKNOWN", text
+
+def block_entries(file_results):
+    """Turn the rule and function rows of one file into (kind, key, name, formula) entries."""
+    for rule_id, rule_name, formula, _ in file_results.get('rules', []):
+        yield 'rule', rule_id, rule_name, formula
+    for func_name, formula in file_results.get('functions', []):
+        function_id, function_name = split_block_header(func_name)
+        yield 'function', function_id, function_name, formula
+
+def file_content_hash(file_path):
+    """Hash a file's content without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_index(db_path):
+    """Open (and create if needed) the rule index."""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.executescript(INDEX_SCHEMA)
+    return connection
+
+def remove_file_entries(connection, file_id):
+    """Delete the blocks and postings of an indexed file."""
+    connection.execute("DELETE FROM postings WHERE block_id IN (SELECT block_id FROM blocks WHERE file_id = ?)", (file_id,))
+    connection.execute("DELETE FROM blocks WHERE file_id = ?", (file_id,))
+
+def index_file_results(connection, file_path, file_results, content_hash=None):
+    """Replace the index entries of one file with freshly extracted rule and function rows.
+
+    file_results is None if the file could not be extracted: its entries and its files row are
+    dropped then, so the next update_index sees it as a new file and tries it again.
+    """
+    path = os.path.abspath(file_path)
+    row = connection.execute("SELECT file_id FROM files WHERE path = ?", (path,)).fetchone()
+    if file_results is None:
+        logging.warning(f"Not indexing {file_path}: extraction failed, it will be retried on the next update")
+        if row:
+            remove_file_entries(connection, row[0])
+            connection.execute("DELETE FROM files WHERE file_id = ?", (row[0],))
+        return
+    stat = os.stat(file_path)
+    content_hash = content_hash or file_content_hash(file_path)
+    indexed_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if row:
+        file_id = row[0]
+        remove_file_entries(connection, file_id)
+        connection.execute("UPDATE files SET size = ?, mtime_ns = ?, content_hash = ?, indexed_at = ? WHERE file_id = ?",
+                           (stat.st_size, stat.st_mtime_ns, content_hash, indexed_at, file_id))
+    else:
+        file_id = connection.execute("INSERT INTO files (path, size, mtime_ns, content_hash, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                                     (path, stat.st_size, stat.st_mtime_ns, content_hash, indexed_at)).lastrowid
+
+    term_ids = {}
+    for kind, key, name, formula in block_entries(file_results):
+        block_id = connection.execute("INSERT INTO blocks (file_id, kind, block_key, name, formula) VALUES (?, ?, ?, ?, ?)",
+                                      (file_id, kind, key, name, formula)).lastrowid
+        postings = []
+        for term in formula_terms(formula):
+            if term not in term_ids:
+                connection.execute("INSERT OR IGNORE INTO terms (kind, term) VALUES (?, ?)", term)
+                term_ids[term] = connection.execute("SELECT term_id FROM terms WHERE kind = ? AND term = ?", term).fetchone()[0]
+            postings.append((term_ids[term], block_id))
+        connection.executemany("INSERT OR IGNORE INTO postings (term_id, block_id) VALUES (?, ?)", postings)
+
+def prune_terms(connection):
+    """Delete terms no longer referenced by any block."""
+    connection.execute("DELETE FROM terms WHERE NOT EXISTS (SELECT 1 FROM postings WHERE postings.term_id = terms.term_id)")
+
+def index_extracted_files(db_path, html_files, results):
+    """Store the extraction results of the given files in the index (used by extract_all --index-db)."""
+    connection = open_index(db_path)
+    try:
+        with connection:
+            for file_path, file_results in zip(html_files, results):
+                index_file_results(connection, file_path, file_results)
+            prune_terms(connection)
+    finally:
+        connection.close()
+    logging.info(f"Indexed {len(html_files)} files in {db_path}")
+
+def update_index(input_dir, db_path, parser='auto', workers=None):
+    """Bring the index up to date with the HTML files of a folder.
+
+    Only new files and files whose content changed are extracted again; entries of files that
+    were removed from the folder are dropped. Returns the (added or changed, removed) file counts.
+    """
+    html_files = find_html_files(input_dir)
+    connection = open_index(db_path)
+    try:
+        indexed = {path: (file_id, size, mtime_ns, content_hash) for file_id, path, size, mtime_ns, content_hash
+                   in connection.execute("SELECT file_id, path, size, mtime_ns, content_hash FROM files")}
+        changed_files = []
+        content_hashes = {}
+        with connection:
+            for file_path in html_files:
+                path = os.path.abspath(file_path)
+                stat = os.stat(file_path)
+                if path in indexed:
+                    file_id, size, mtime_ns, content_hash = indexed[path]
+                    if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    content_hashes[file_path] = file_content_hash(file_path)
+                    if content_hashes[file_path] == content_hash:
+                        # Touched but unchanged: remember the new timestamp and keep the entries
+                        connection.execute("UPDATE files SET mtime_ns = ? WHERE file_id = ?", (stat.st_mtime_ns, file_id))
+                        continue
+                changed_files.append(file_path)
+
+            current_paths = {os.path.abspath(file_path) for file_path in html_files}
+            removed = [(path, file_id) for path, (file_id, _, _, _) in indexed.items() if path not in current_paths]
+            for path, file_id in removed:
+                remove_file_entries(connection, file_id)
+                connection.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+        logging.info(f"Updating rule index: {len(changed_files)} new or changed files, {len(removed)} removed, "
+                     f"{len(html_files) - len(changed_files)} unchanged")
+        results = extract_files(changed_files, extract_blocks, None, parser, workers) if changed_files else []
+        with connection:
+            for file_path, file_results in zip(changed_files, results):
+                index_file_results(connection, file_path, file_results, content_hashes.get(file_path))
+            if changed_files or removed:
+                prune_terms(connection)
+        return len(changed_files), len(removed)
+    finally:
+        connection.close()
+
+def query_term(db_path, term, kind=None, prefix=False):
+    """Return (kind, block key, name, file, term kind, term) rows of the blocks whose formula contains a term."""
+    term = term.lower()
+    condition = "terms.term >= ? AND terms.term < ?" if prefix else "terms.term = ?"
+    parameters = [term, term + '\U0010ffff'] if prefix else [term]
+    if kind:
+        condition += " AND terms.kind = ?"
+        parameters.append(kind)
+    connection = open_index(db_path)
+    try:
+        return connection.execute(f"""
+            SELECT blocks.kind, blocks.block_key, blocks.name, files.path, terms.kind, terms.term
+            FROM terms JOIN postings ON postings.term_id = terms.term_id
+            JOIN blocks ON blocks.block_id = postings.block_id JOIN files ON files.file_id = blocks.file_id
+            WHERE {condition} ORDER BY files.path, blocks.block_id, terms.kind
+        """, parameters).fetchall()
+    finally:
+        connection.close()
+
+def function_callers(db_path, function):
+    """Return (kind, block key, name, file) rows of the blocks that reference a function (by name or F-id)."""
+    connection = open_index(db_path)
+    try:
+        names = [name for (name,) in connection.execute(
+            "SELECT DISTINCT name FROM blocks WHERE kind = 'function' AND (block_key = ? OR name = ? COLLATE NOCASE)",
+            (function.upper(), function))] or [function]
+        rows = []
+        for name in names:
+            rows.extend(connection.execute("""
+                SELECT blocks.kind, blocks.block_key, blocks.name, files.path
+                FROM terms JOIN postings ON postings.term_id = terms.term_id
+                JOIN blocks ON blocks.block_id = postings.block_id JOIN files ON files.file_id = blocks.file_id
+                WHERE terms.kind = 'identifier' AND terms.term = ? ORDER BY files.path, blocks.block_id
+            """, (name.lower(),)))
+        return rows
+    finally:
+        connection.close()
+
+def block_functions(db_path, block):
+    """Return (block key, function key, function name, function file) rows of the functions a rule or function references."""
+    connection = open_index(db_path)
+    try:
+        return connection.execute("""
+            SELECT DISTINCT blocks.block_key, functions.block_key, functions.name, files.path
+            FROM blocks JOIN postings ON postings.block_id = blocks.block_id
+            JOIN terms ON terms.term_id = postings.term_id AND terms.kind = 'identifier'
+            JOIN blocks AS functions ON functions.kind = 'function' AND functions.name = terms.term COLLATE NOCASE
+            JOIN files ON files.file_id = functions.file_id
+            WHERE blocks.block_key = ? OR blocks.name = ? COLLATE NOCASE
+            ORDER BY blocks.block_key, functions.name
+        """, (block.upper(), block)).fetchall()
+    finally:
+        connection.close()
+
+def index_stats(db_path):
+    """Return the number of files, rules, functions and terms in the index."""
+    connection = open_index(db_path)
+    try:
+        stats = {'files': connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]}
+        for kind in ('rule', 'function'):
+            stats[f'{kind}s'] = connection.execute("SELECT COUNT(*) FROM blocks WHERE kind = ?", (kind,)).fetchone()[0]
+        stats['terms'] = connection.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+        return stats
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Inverted index over the formulas of extracted rules and functions.")
+    arg_parser.add_argument('--index-db', default='./output/rule_index.sqlite', help="SQLite index file")
+    arg_parser.add_argument('--update', action='store_true', help="index new and changed files of --input-dir")
+    arg_parser.add_argument('--input-dir', default='./input_htm', help="folder searched recursively for .html/.htm files")
+    arg_parser.add_argument('--parser', choices=PARSERS, default='auto', help="HTML parser (auto uses lxml iterparse for large files)")
+    arg_parser.add_argument('--workers', type=int, help="worker processes (default: CPU count; 1 parses the files one after another)")
+    arg_parser.add_argument('--query', metavar='TERM', help="list the rules and functions whose formula contains TERM")
+    arg_parser.add_argument('--kind', choices=TERM_KINDS, help="restrict --query to identifiers, function calls or string literals")
+    arg_parser.add_argument('--prefix', action='store_true', help="match --query as a prefix")
+    arg_parser.add_argument('--callers', metavar='FUNCTION', help="list the rules and functions that reference FUNCTION (name or F-id)")
+    arg_parser.add_argument('--functions-of', metavar='BLOCK', help="list the functions a rule or function (name or id) references")
+    arg_parser.add_argument('--stats', action='store_true', help="print the size of the index")
+    args = arg_parser.parse_args()
+
+    if args.update:
+        update_index(args.input_dir, args.index_db, args.parser, args.workers)
+
+    start = time.perf_counter()
+    if args.query:
+        rows = query_term(args.index_db, args.query, args.kind, args.prefix)
+        for kind, key, name, path, term_kind, term in rows:
+            print(f"{key}\t{name}\t{path}\t{term_kind}:{term}")
+    elif args.callers:
+        rows = function_callers(args.index_db, args.callers)
+        for kind, key, name, path in rows:
+            print(f"{key}\t{name}\t{path}")
+    elif args.functions_of:
+        rows = block_functions(args.index_db, args.functions_of)
+        for key, function_key, function_name, path in rows:
+            print(f"{key} -> {function_key}\t{function_name}\t{path}")
+    elif args.stats:
+        rows = list(index_stats(args.index_db).items())
+        for name, count in rows:
+            print(f"{name}: {count}")
+    else:
+        rows = None
+    if rows is not None:
+        print(f"({len(rows)} results in {(time.perf_counter() - start) * 1000:.1f} ms)")
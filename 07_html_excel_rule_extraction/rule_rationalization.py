@@ -0,0 +1,252 @@
+import os
+import re
+import argparse
+import hashlib
+import logging
+import sqlite3
+import time
+import zlib
+from collections import defaultdict
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font
+
+from extract_rules import PARSERS, categorize_rule, extract_files, find_html_files
+from extract_all import extract_blocks
+from rule_index import KEYWORDS
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Formula tokens: string literals, numbers, identifiers, two-character comparison operators and
+# any other single non-space character
+TOKEN_PATTERN = re.compile(r'"[^"\n]*"|\d+(?:\.\d+)?|[A-Za-z_]\w*|<>|<=|>=|\S')
+# Estimated Jaccard similarity of formula shingles above which two rules are near duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# Tokens per shingle of the near-duplicate search
+SHINGLE_TOKENS = 4
+# MinHash/LSH settings: BANDS * ROWS permutations per signature. With 16 bands of 4 rows, pairs at
+# the 0.8 threshold become candidates with a probability above 99.9%.
+LSH_BANDS = 16
+LSH_ROWS = 4
+MINHASH_PRIME = np.uint64((1 << 61) - 1)
+# LSH buckets larger than this are chained instead of paired completely, so one huge family of
+# similar rules does not produce a quadratic number of candidate pairs
+LSH_MAX_BUCKET = 100
+# Report match types, from the strictest to the loosest
+MATCH_TYPES = ('exact', 'renamed', 'near')
+
+def canonical_tokens(formula):
+    """Tokenize a formula ignoring whitespace and case; string literals keep their case."""
+    return [token if token.startswith('"') else token.lower() for token in TOKEN_PATTERN.findall(formula)]
+
+def renamed_tokens(tokens):
+    """Replace variable names with placeholders in order of first use; keywords and called functions stay."""
+    names = {}
+    renamed = []
+    for index, token in enumerate(tokens):
+        is_variable = (token[0].isalpha() or token[0] == '_') and token not in KEYWORDS
+        if is_variable and not (index + 1 < len(tokens) and tokens[index + 1] == '('):
+            token = names.setdefault(token, f"v{len(names) + 1}")
+        renamed.append(token)
+    return renamed
+
+def fingerprint(tokens):
+    """Hash a token sequence into a short hex fingerprint."""
+    return hashlib.blake2b('\x1f'.join(tokens).encode('utf-8'), digest_size=8).hexdigest()
+
+def shingle_hashes(tokens, shingle_size=SHINGLE_TOKENS):
+    """Hash the token shingles of a formula to 32-bit integers."""
+    shingles = {'\x1f'.join(tokens[k:k + shingle_size]) for k in range(max(1, len(tokens) - shingle_size + 1))}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+def minhash_signatures(hash_sets, permutations, seed=0):
+    """Compute MinHash signatures of shingle hash sets, one vectorized pass per permutation."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 32, permutations, dtype=np.uint64)
+    b = rng.integers(0, 1 << 32, permutations, dtype=np.uint64)
+    lengths = np.array([len(hashes) for hashes in hash_sets], dtype=np.int64)
+    values = np.concatenate(hash_sets) if hash_sets else np.empty(0, dtype=np.uint64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) else lengths
+    signatures = np.empty((len(hash_sets), permutations), dtype=np.uint64)
+    for column in range(permutations):
+        permuted = (a[column] * values + b[column]) % MINHASH_PRIME
+        signatures[:, column] = np.minimum.reduceat(permuted, starts) if len(values) else permuted[:0]
+    return signatures
+
+def lsh_candidate_pairs(signatures, bands=LSH_BANDS, rows=LSH_ROWS, max_bucket=LSH_MAX_BUCKET):
+    """Find candidate pairs of rows that share at least one LSH band bucket."""
+    pairs = set()
+    for band in range(bands):
+        band_rows = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = band_rows.view(np.dtype((np.void, band_rows.dtype.itemsize * rows))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        bucket_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for start, count in zip(bucket_starts[counts > 1], counts[counts > 1]):
+            members = order[start:start + count].tolist()
+            if count <= max_bucket:
+                pairs.update((members[i], members[j]) for i in range(count) for j in range(i + 1, count))
+            else:
+                pairs.update(zip(members, members[1:]))
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+def find_root(parents, node):
+    """Find the union-find root of a node, halving the path on the way."""
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+def find_duplicate_rules(rules, threshold=NEAR_DUPLICATE_THRESHOLD, bands=LSH_BANDS, rows=LSH_ROWS):
+    """Group rules into duplicate families.
+
+    rules are (file, rule ID, rule name, formula, category) tuples. Rules with the same canonical
+    formula (whitespace and case ignored) share an exact fingerprint; exact groups whose formulas
+    only differ in variable names share a renamed fingerprint; renamed groups whose shingles have
+    an estimated Jaccard similarity of at least threshold are joined through MinHash LSH, so only
+    candidate pairs are compared. Returns the fingerprints of every rule and the groups with at
+    least two rules, largest first.
+    """
+    tokens = [canonical_tokens(rule[3]) for rule in rules]
+    exact_fingerprints = [fingerprint(rule_tokens) for rule_tokens in tokens]
+    renamed_fingerprints = [fingerprint(renamed_tokens(rule_tokens)) for rule_tokens in tokens]
+
+    # One representative per renamed fingerprint goes into the near-duplicate search
+    representatives = {}
+    for index, renamed in enumerate(renamed_fingerprints):
+        representatives.setdefault(renamed, index)
+    representative_rules = list(representatives.values())
+    signatures = minhash_signatures([shingle_hashes(tokens[index]) for index in representative_rules], bands * rows)
+    pairs = lsh_candidate_pairs(signatures, bands, rows)
+    similarities = np.empty(len(pairs))
+    for start in range(0, len(pairs), 100000):
+        chunk = pairs[start:start + 100000]
+        similarities[start:start + len(chunk)] = (signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1)
+    keep = similarities >= threshold
+    pairs, similarities = pairs[keep], similarities[keep]
+
+    parents = list(range(len(representative_rules)))
+    for left, right in pairs.tolist():
+        parents[find_root(parents, left)] = find_root(parents, right)
+    group_of_representative = {renamed: find_root(parents, position) for position, renamed in enumerate(representatives)}
+    min_similarity = defaultdict(lambda: 1.0)
+    for (left, right), similarity in zip(pairs.tolist(), similarities.tolist()):
+        root = find_root(parents, left)
+        min_similarity[root] = min(min_similarity[root], similarity)
+
+    members = defaultdict(list)
+    for index, renamed in enumerate(renamed_fingerprints):
+        members[group_of_representative[renamed]].append(index)
+
+    groups = []
+    for root, indices in members.items():
+        if len(indices) < 2:
+            continue
+        if len({exact_fingerprints[index] for index in indices}) == 1:
+            match_type = 'exact'
+        elif len({renamed_fingerprints[index] for index in indices}) == 1:
+            match_type = 'renamed'
+        else:
+            match_type = 'near'
+        groups.append({
+            'match_type': match_type,
+            'members': indices,
+            'files': len({rules[index][0] for index in indices}),
+            'distinct_formulas': len({exact_fingerprints[index] for index in indices}),
+            'min_similarity': round(min_similarity[root], 2) if match_type == 'near' else 1.0,
+        })
+    groups.sort(key=lambda group: (-len(group['members']), MATCH_TYPES.index(group['match_type'])))
+    return {'exact_fingerprints': exact_fingerprints, 'renamed_fingerprints': renamed_fingerprints,
+            'groups': groups, 'candidate_pairs': len(keep), 'near_pairs': len(pairs)}
+
+def load_rules_from_files(input_dir, parser='auto', workers=None):
+    """Extract the rules of every HTML file in a folder as (file, rule ID, rule name, formula, category) tuples."""
+    html_files = find_html_files(input_dir)
+    rules = []
+    for file_path, file_results in zip(html_files, extract_files(html_files, extract_blocks, None, parser, workers)):
+        if file_results is not None:
+            rules.extend((file_path,) + tuple(row) for row in file_results['rules'])
+    return rules
+
+def load_rules_from_index(db_path):
+    """Read the rules stored in a rule index (see rule_index.py) without parsing the HTML again."""
+    connection = sqlite3.connect(db_path)
+    try:
+        rows = connection.execute("""
+            SELECT files.path, blocks.block_key, blocks.name, blocks.formula FROM blocks
+            JOIN files ON files.file_id = blocks.file_id WHERE blocks.kind = 'rule' ORDER BY files.path, blocks.block_id
+        """).fetchall()
+    finally:
+        connection.close()
+    return [(path, rule_id, rule_name, formula, categorize_rule(rule_name)) for path, rule_id, rule_name, formula in rows]
+
+def write_duplicate_report(rules, duplicates, output_file):
+    """Write the duplicate groups and their member rules to an Excel workbook."""
+    workbook = Workbook(write_only=True)
+    wrap = Alignment(wrap_text=True, vertical='top')
+    code_font = Font(name='Courier New')
+
+    def formula_cell(sheet, formula):
+        cell = WriteOnlyCell(sheet, value=formula)
+        cell.alignment = wrap
+        cell.font = code_font
+        return cell
+
+    groups_sheet = workbook.create_sheet('Duplicate Groups')
+    for column, width in zip('ABCDEFGH', (8, 10, 8, 8, 10, 12, 40, 80)):
+        groups_sheet.column_dimensions[column].width = width
+    groups_sheet.append(['Group', 'Match Type', 'Rules', 'Files', 'Distinct Formulas', 'Min Similarity',
+                         'Example Rule', 'Example Formula'])
+    members_sheet = workbook.create_sheet('Group Members')
+    for column, width in zip('ABCDEFGH', (8, 10, 30, 12, 40, 24, 18, 18)):
+        members_sheet.column_dimensions[column].width = width
+    members_sheet.append(['Group', 'Match Type', 'File', 'Rule ID', 'Rule Name', 'Category', 'Exact Fingerprint',
+                          'Renamed Fingerprint'])
+
+    for group_number, group in enumerate(duplicates['groups'], start=1):
+        example = rules[group['members'][0]]
+        groups_sheet.append([group_number, group['match_type'], len(group['members']), group['files'],
+                             group['distinct_formulas'], group['min_similarity'], f"{example[1]} {example[2]}",
+                             formula_cell(groups_sheet, example[3].strip())])
+        for index in group['members']:
+            file_path, rule_id, rule_name, _, category = rules[index]
+            members_sheet.append([group_number, group['match_type'], file_path, rule_id, rule_name, category,
+                                  duplicates['exact_fingerprints'][index], duplicates['renamed_fingerprints'][index]])
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    workbook.save(output_file)
+    logging.info(f"Saved duplicate rules report to {output_file}")
+
+def rationalize_rules(rules, output_file, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """Find duplicate rules, log a summary and write the duplicate rules report."""
+    start = time.perf_counter()
+    duplicates = find_duplicate_rules(rules, threshold)
+    counts = {match_type: sum(1 for group in duplicates['groups'] if group['match_type'] == match_type) for match_type in MATCH_TYPES}
+    duplicate_rules = sum(len(group['members']) for group in duplicates['groups'])
+    logging.info(f"Fingerprinted {len(rules)} rules in {time.perf_counter() - start:.1f}s: {len(duplicates['groups'])} duplicate groups "
+                 f"({counts['exact']} exact, {counts['renamed']} renamed, {counts['near']} near) covering {duplicate_rules} rules; "
+                 f"{duplicates['near_pairs']} of {duplicates['candidate_pairs']} LSH candidate pairs were near duplicates")
+    if duplicates['groups']:
+        write_duplicate_report(rules, duplicates, output_file)
+    else:
+        logging.warning("No duplicate rules found.")
+    return duplicates
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Find duplicate and near-duplicate business rules across application reports.")
+    arg_parser.add_argument('--input-dir', default='./input_htm', help="folder searched recursively for .html/.htm files")
+    arg_parser.add_argument('--from-index', metavar='INDEX_DB', help="read the rules from a rule index (rule_index.py) instead of parsing HTML")
+    arg_parser.add_argument('--output-file', default='./output/duplicate_rules_report.xlsx')
+    arg_parser.add_argument('--threshold', type=float, default=NEAR_DUPLICATE_THRESHOLD,
+                            help="estimated shingle similarity (0-1) above which rules are near duplicates")
+    arg_parser.add_argument('--parser', choices=PARSERS, default='auto', help="HTML parser (auto uses lxml iterparse for large files)")
+    arg_parser.add_argument('--workers', type=int, help="worker processes (default: CPU count; 1 parses the files one after another)")
+    args = arg_parser.parse_args()
+
+    if args.from_index:
+        rules = load_rules_from_index(args.from_index)
+    else:
+        rules = load_rules_from_files(args.input_dir, args.parser, args.workers)
+    rationalize_rules(rules, args.output_file, args.threshold)